@@ -21,6 +21,9 @@ setup(name='SmartRPC',
     install_requires=[
         'pip',
     ],
+    extras_require={
+        'msgpack': ['msgpack'],
+    },
     classifiers=[
         'License :: OSI Approved :: MIT License',
         'Intended Audience :: Developers',
@@ -0,0 +1,302 @@
+import threading, time, sys, json, re, copy, weakref, asyncio
+from collections import OrderedDict
+
+CACHES = weakref.WeakSet()
+
+# таблицы, в которые пишет DML, и из которых читает запрос
+WRITES = re.compile(r'\b(?:insert\s+(?:or\s+\w+\s+)?into|update(?:\s+or\s+\w+)?|delete\s+from|truncate(?:\s+table)?'
+                    r'|replace\s+into|merge\s+into)\s+(?:only\s+)?([\w."]+)', re.I)
+READS = re.compile(r'\b(?:from|join)\s+(?:only\s+)?([\w."]+)', re.I)
+
+
+def table_name(x: str) -> str:
+    return x.replace('"', '').split('.')[-1].lower()
+
+
+def tables(query: str, pattern=WRITES) -> set:
+    return {table_name(x) for x in pattern.findall(query)}
+
+
+def invalidate(names):
+    """
+    Сбросить во всех кэшах результаты методов, читающих из таблиц names
+    """
+    names = {table_name(x) for x in names}
+    if names:
+        for x in list(CACHES):
+            x.invalidate(names)
+
+
+def sizeof(x, depth: int = 0) -> int:
+    # примерный объем результата в памяти
+    n = sys.getsizeof(x)
+    if depth > 8:
+        return n
+    if isinstance(x, dict):
+        for k, v in x.items():
+            n += sizeof(k, depth + 1) + sizeof(v, depth + 1)
+    elif isinstance(x, (list, tuple, set)):
+        for v in x:
+            n += sizeof(v, depth + 1)
+    return n
+
+
+def shared(value):
+    """
+    Копия результата для очередного вызова: список строк и строки (dict, list) копируются поверхностно,
+    чтобы изменение результата одним вызовом не было видно другим. Вложенные значения общие
+    """
+    if isinstance(value, list):
+        return [copy.copy(x) if isinstance(x, (dict, list)) else x for x in value]
+    if isinstance(value, dict):
+        return copy.copy(value)
+    return value
+
+
+class ResultCache:
+    """
+    Кэш результатов методов: TTL у каждого метода, общий лимит памяти с вытеснением давно не использованных,
+    одновременные одинаковые вызовы ждут первый вместо того, чтобы выполняться заново.
+    Записи привязаны к таблицам, из которых читает метод, и сбрасываются при записи в эти таблицы.
+    Каждый вызов получает свою копию результата (см. shared)
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.__max = max_bytes
+        self.__bytes = 0
+        self.__data = OrderedDict()  # ключ -> (результат, срок, объем, таблицы)
+        self.__tables = {}  # таблица -> ключи
+        self.__versions = {}  # таблица -> номер сброса
+        self.__flights = {}  # ключ -> Event выполняющегося вызова
+        self.__aflights = {}  # ключ -> Future выполняющегося вызова в цикле событий
+        self.__lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        CACHES.add(self)
+
+    @staticmethod
+    def key(name: str, params) -> str:
+        return name + ':' + json.dumps(params, sort_keys=True, default=str)
+
+    def get(self, key):
+        with self.__lock:
+            x = self.__data.get(key)
+            if x is None:
+                return False, None
+            if x[1] < time.monotonic():
+                self.__drop(key)
+                return False, None
+            self.__data.move_to_end(key)
+            return True, x[0]
+
+    def __versions_of(self, tables):
+        return tuple(self.__versions.get(x, 0) for x in tables)
+
+    def put(self, key, value, ttl: float, tables=(), versions=None):
+        size = sizeof(value)
+        if size > self.__max:
+            return
+        with self.__lock:
+            if versions is not None and versions != self.__versions_of(tables):
+                return  # таблицы изменились, пока метод выполнялся
+            if key in self.__data:
+                self.__drop(key)
+            while self.__data and self.__bytes + size > self.__max:
+                self.__drop(next(iter(self.__data)))
+                self.evictions += 1
+            self.__data[key] = (value, time.monotonic() + ttl, size, tables)
+            self.__bytes += size
+            for x in tables:
+                self.__tables.setdefault(x, set()).add(key)
+
+    def __drop(self, key):
+        value, expire, size, tables = self.__data.pop(key)
+        self.__bytes -= size
+        for x in tables:
+            keys = self.__tables.get(x)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.__tables[x]
+
+    def invalidate(self, tables):
+        with self.__lock:
+            for x in tables:
+                self.__versions[x] = self.__versions.get(x, 0) + 1
+                for key in list(self.__tables.get(x, ())):
+                    self.__drop(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+            self.__tables.clear()
+            self.__bytes = 0
+
+    def call(self, key, ttl: float, tables, fn):
+        """
+        Результат из кэша, либо результат fn(). Одинаковые вызовы, пришедшие во время выполнения fn, ждут его
+        """
+        tables = tuple(tables or ())
+        while True:
+            with self.__lock:
+                found, value = self.get(key)
+                if found:
+                    self.hits += 1
+                    return shared(value)
+                flight = self.__flights.get(key)
+                if flight is None:
+                    self.misses += 1
+                    flight = self.__flights[key] = threading.Event()
+                    versions = self.__versions_of(tables)
+                    break
+            flight.wait()
+            # после завершения первого вызова результат берется из кэша. если он не попал в кэш
+            # (ошибка, изменение таблиц) - вызов выполняется заново
+        try:
+            value = fn()
+            if not is_uncacheable(value):
+                # в кэше копия: результат первого вызова остается у него
+                self.put(key, shared(value), ttl, tables, versions)
+            return value
+        finally:
+            with self.__lock:
+                del self.__flights[key]
+            flight.set()
+
+    async def acall(self, key, ttl: float, tables, fn):
+        """
+        Асинхронный вариант call, fn возвращает корутину
+        """
+        tables = tuple(tables or ())
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.__lock:
+                found, value = self.get(key)
+                if found:
+                    self.hits += 1
+                    return shared(value)
+                flight = self.__aflights.get((loop, key))
+                if flight is None:
+                    self.misses += 1
+                    flight = self.__aflights[(loop, key)] = loop.create_future()
+                    versions = self.__versions_of(tables)
+                    break
+            await asyncio.shield(flight)
+        try:
+            value = await fn()
+            if not is_uncacheable(value):
+                self.put(key, shared(value), ttl, tables, versions)
+            return value
+        finally:
+            with self.__lock:
+                del self.__aflights[(loop, key)]
+            flight.set_result(None)
+
+    @property
+    def bytes(self) -> int:
+        return self.__bytes
+
+    def __len__(self):
+        return len(self.__data)
+
+
+class Flight:
+    # выполняющийся вызов: результат или ошибка для ожидающих
+    __slots__ = ('event', 'value', 'error', 'waiters')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = 0
+
+
+class Flights:
+    """
+    Объединение одновременных одинаковых вызовов без кэширования: пока вызов выполняется, такие же вызовы
+    ждут его и получают копию того же результата (см. shared) или ту же ошибку. Копия снимается до того,
+    как результат вернется первому вызову. Потоковые результаты не делятся - ожидавшие вызовы выполняются сами
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__flights = {}  # ключ -> Flight выполняющегося вызова
+        self.__aflights = {}  # (цикл событий, ключ) -> [Future выполняющегося вызова, число ожидающих]
+        self.shared = 0  # вызовов, получивших чужой результат
+
+    def call(self, key, fn):
+        while True:
+            with self.__lock:
+                flight = self.__flights.get(key)
+                if flight is None:
+                    flight = self.__flights[key] = Flight()
+                    break
+                flight.waiters += 1
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            if not is_uncacheable(flight.value):
+                with self.__lock:
+                    self.shared += 1
+                return shared(flight.value)
+        value = error = None
+        try:
+            value = fn()
+            return value
+        except BaseException as e:
+            error = e
+            raise e
+        finally:
+            with self.__lock:
+                del self.__flights[key]
+            # ожидающих больше не прибавится: их копия снимается до того, как результат получит первый вызов
+            if flight.waiters:
+                flight.error = error
+                flight.value = value if error is not None or is_uncacheable(value) else shared(value)
+            flight.event.set()
+
+    async def acall(self, key, fn):
+        """
+        Асинхронный вариант call, fn возвращает корутину. Вызовы объединяются в пределах цикла событий
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.__lock:
+                entry = self.__aflights.get((loop, key))
+                if entry is None:
+                    entry = self.__aflights[(loop, key)] = [loop.create_future(), 0]
+                    flight = entry[0]
+                    break
+                flight = entry[0]
+                entry[1] += 1
+            try:
+                value = await asyncio.shield(flight)
+            except asyncio.CancelledError as e:
+                if flight.cancelled():
+                    continue  # отменен первый вызов, а не этот - выполнить заново
+                raise e
+            if not is_uncacheable(value):
+                with self.__lock:
+                    self.shared += 1
+                return shared(value)
+        try:
+            value = await fn()
+            # копия для ожидающих снимается до того, как результат получит первый вызов
+            flight.set_result(shared(value) if entry[1] and not is_uncacheable(value) else value)
+            return value
+        except asyncio.CancelledError as e:
+            flight.cancel()
+            raise e
+        except Exception as e:
+            flight.set_exception(e)
+            flight.exception()  # ошибка отдана ожидающим, в лог asyncio она не пойдет
+            raise e
+        finally:
+            with self.__lock:
+                del self.__aflights[(loop, key)]
+
+
+def is_uncacheable(value) -> bool:
+    # потоковые результаты читаются один раз
+    return hasattr(value, '__next__') or hasattr(value, '__anext__')
@@ -0,0 +1,188 @@
+import abc, base64, datetime, decimal, uuid, json
+from collections import OrderedDict
+from .db import MODULES
+
+
+def default(x):
+    # типы из выборок БД, которых нет в JSON
+    if isinstance(x, (datetime.datetime, datetime.date, datetime.time)):
+        return x.isoformat()
+    if isinstance(x, decimal.Decimal):
+        return str(x)
+    if isinstance(x, uuid.UUID):
+        return str(x)
+    if isinstance(x, (bytes, bytearray, memoryview)):
+        return base64.b64encode(x).decode('ascii')
+    if isinstance(x, (set, frozenset, tuple)):
+        return list(x)
+    if hasattr(x, '_asdict'):
+        return x._asdict()
+    raise TypeError('Object of type %s is not JSON serializable' % x.__class__.__name__)
+
+
+class Codec:
+    """
+    Разбор запросов и кодирование ответов RPC. Реализации подбираются по имени модуля, как DBAdapter
+    """
+    content_type = 'application/json'
+    binary = False  # ответ только в байтах, потоковые результаты перед кодированием читаются целиком
+
+    @classmethod
+    def get(cls, module_name: str = 'json', **kwargs):
+        for x in cls.__subclasses__():
+            if x.module_name(x) == module_name:
+                return x(**kwargs)
+
+    @classmethod
+    def best(cls, **kwargs):
+        # самая быстрая из доступных реализаций
+        for x in ('orjson', 'ujson', 'json'):
+            try:
+                return cls.get(x, **kwargs)
+            except ImportError:
+                pass
+
+    @abc.abstractclassmethod
+    def module_name(cls):
+        pass
+
+    def __init__(self, ordered: bool = False):
+        """
+        :param ordered: разбирать объекты в OrderedDict. заметно медленнее, нужно только если важен порядок ключей
+        для кода, который сравнивает OrderedDict (обычный dict тоже сохраняет порядок)
+        """
+        n = self.__class__.module_name(self.__class__)
+        m = MODULES.get(n)
+        if not m:
+            m = __import__(n, globals())
+            MODULES[n] = m
+        self.__m = m
+        self.__ordered = ordered
+
+    @property
+    def module(self):
+        return self.__m
+
+    @property
+    def ordered(self) -> bool:
+        return self.__ordered
+
+    @abc.abstractmethod
+    def loads(self, data):
+        pass
+
+    @abc.abstractmethod
+    def dumps(self, obj) -> str:
+        pass
+
+    def dumpb(self, obj) -> bytes:
+        return self.dumps(obj).encode('utf-8')
+
+
+class JSONCodec(Codec):
+
+    def module_name(cls):
+        return 'json'
+
+    def __init__(self, ordered: bool = False):
+        Codec.__init__(self, ordered)
+        self.__decoder = json.JSONDecoder(object_pairs_hook=OrderedDict if ordered else None)
+        self.__encoder = json.JSONEncoder(default=default, ensure_ascii=False, separators=(',', ':'))
+
+    def loads(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode('utf-8')
+        return self.__decoder.decode(data)
+
+    def dumps(self, obj) -> str:
+        return self.__encoder.encode(obj)
+
+
+class OrJSONCodec(Codec):
+
+    def module_name(cls):
+        return 'orjson'
+
+    def loads(self, data):
+        ret = self.module.loads(data)
+        return to_ordered(ret) if self.ordered else ret
+
+    def dumps(self, obj) -> str:
+        return self.dumpb(obj).decode('utf-8')
+
+    def dumpb(self, obj) -> bytes:
+        return self.module.dumps(obj, default=default, option=self.module.OPT_NON_STR_KEYS)
+
+
+class UJSONCodec(Codec):
+
+    def module_name(cls):
+        return 'ujson'
+
+    def loads(self, data):
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        ret = self.module.loads(data)
+        return to_ordered(ret) if self.ordered else ret
+
+    def dumps(self, obj) -> str:
+        return self.module.dumps(obj, default=default, ensure_ascii=False)
+
+
+# тип расширения MessagePack для Decimal: строка с числом, без потери точности
+EXT_DECIMAL = 1
+
+
+class MsgPackCodec(Codec):
+    """
+    MessagePack: bytes и memoryview из выборок пишутся как bin без base64, datetime - как Timestamp,
+    Decimal - расширение EXT_DECIMAL. Выбирается транспортом по Content-Type запроса (см. HTTPApp)
+    """
+    content_type = 'application/msgpack'
+    binary = True
+
+    def module_name(cls):
+        return 'msgpack'
+
+    def __init__(self, ordered: bool = False):
+        Codec.__init__(self, ordered)
+        self.__utc = datetime.timezone.utc
+
+    def __default(self, x):
+        if isinstance(x, datetime.datetime):
+            # с часовым поясом msgpack пишет сам, наивное время из БД - как UTC
+            return self.module.Timestamp.from_datetime(x.replace(tzinfo=self.__utc))
+        if isinstance(x, decimal.Decimal):
+            return self.module.ExtType(EXT_DECIMAL, str(x).encode('ascii'))
+        if isinstance(x, (datetime.date, datetime.time)):
+            return x.isoformat()
+        if isinstance(x, uuid.UUID):
+            return str(x)
+        if isinstance(x, (set, frozenset)):
+            return list(x)
+        if hasattr(x, '_asdict'):
+            return x._asdict()
+        raise TypeError('Object of type %s is not MessagePack serializable' % x.__class__.__name__)
+
+    def __ext(self, code: int, data: bytes):
+        if code == EXT_DECIMAL:
+            return decimal.Decimal(data.decode('ascii'))
+        return self.module.ExtType(code, data)
+
+    def loads(self, data):
+        return self.module.unpackb(data, raw=False, timestamp=3, strict_map_key=False, ext_hook=self.__ext,
+                                   object_pairs_hook=OrderedDict if self.ordered else None)
+
+    def dumps(self, obj) -> str:
+        raise TypeError('MessagePack is a binary format, use dumpb')
+
+    def dumpb(self, obj) -> bytes:
+        return self.module.packb(obj, default=self.__default, use_bin_type=True, datetime=True)
+
+
+def to_ordered(x):
+    if isinstance(x, dict):
+        return OrderedDict((k, to_ordered(v)) for k, v in x.items())
+    if isinstance(x, list):
+        return [to_ordered(v) for v in x]
+    return x
@@ -1,9 +1,78 @@
-import abc, typing
+import abc, typing, asyncio, functools, itertools, re, weakref, datetime, json, contextvars
+from .err import *
+from .deadline import deadline, remaining, Guard, NO_GUARD
+from .statement import Statement, StatementCache
+from .cache import tables, table_name, invalidate
+from .rows import make_rows, row_factory
 
 MODULES = {}
 
+# форматы выборки: список словарей, либо имена и типы полей отдельно от значений
+FORMATS = ('dicts', 'rows', 'arrays')
+
+
+def columnar(d, f, arrays: bool = False) -> dict:
+    """
+    Выборка без повторения имен полей в каждой строке:
+    {"columns": [...], "types": [...], "rows": [[...], ...]}, либо при arrays значения по колонкам
+    {"columns": [...], "types": [...], "arrays": [[...], ...]}
+    """
+    ret = {
+        "columns": [x['name'] for x in f],
+        "types": [x.get('type', x.get('type_id')) for x in f],
+    }
+    if d and not isinstance(d[0], (tuple, list)):
+        d = [tuple(x) for x in d]
+    if arrays:
+        ret['arrays'] = [list(x) for x in zip(*d)] if d else [[] for x in f]
+    else:
+        ret['rows'] = d if isinstance(d, list) else list(d)
+    return ret
+
+
+def bulk_report() -> dict:
+    return {"rows": 0, "chunks": 0, "errors": []}
+
+
+def bulk_error(report: dict, offset: int, size: int, e: Exception, on_error: str):
+    """
+    Ошибка порции dml_many: при on_error=raise - исключение с номером порции, при skip - запись в отчет
+    """
+    if isinstance(e, ErrorRPC):
+        code, message = e.code, e.args[0]
+    else:
+        code, message = ERR_INTERNAL[0], e.__class__.__name__ + ': ' + '\n'.join(str(x) for x in e.args)
+    if on_error == 'raise':
+        raise ErrorRPC(code, 'Chunk %d at row %d: %s' % (report['chunks'], offset, message))
+    report['errors'].append({"chunk": report['chunks'], "offset": offset, "size": size, "message": message})
+
+
+def timed_out(e: Exception) -> Exception:
+    # asyncpg сам отменяет запрос на сервере по timeout и выбрасывает TimeoutError
+    if isinstance(e, asyncio.TimeoutError):
+        return ErrorRPC(ERR_TIMEOUT, '+Query cancelled')
+    return e
+
+
+def check_on_error(on_error: str) -> str:
+    if on_error not in ('raise', 'skip'):
+        raise ErrorRPC(ERR_BAD_PARAMS, '+Unknown on_error ' + str(on_error))
+    return on_error
+
+
+def chunks(rows, size: int):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
 
 class DBAdapter:
+    fetch_size = 1000  # размер порции строк для stream
+    bulk_size = 1000  # строк в одной порции dml_many
+    paramstyle = 'format'  # как драйвер принимает параметры запроса, см. statement.STYLES
 
     @classmethod
     def get(cls, module_name: str, *args, **kwargs):
@@ -25,7 +94,7 @@ class DBAdapter:
             return args[0]
         return args if args != () else kwargs
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, pool=None, member=None, limiter=None, **kwargs):
         global MODULES
         n = self.__class__.module_name(self.__class__)
         m = MODULES.get(n)
@@ -35,19 +104,111 @@ class DBAdapter:
         self.__m = m
         self.__p = self.prepare_conn_params(args, kwargs)
         self.__conn = None
+        self.__pool = pool
+        self.__member = member  # replicas.Member, если алиас выбран из группы реплик
+        self.__limiter = limiter  # limits.Limiter алиаса: число одновременно выданных соединений
+        self.__discard = False  # запрос на соединении отменялся - соединение не возвращается в пул
+        self.__written = set()  # таблицы, измененные dml в текущей транзакции
+
+    @property
+    def module(self):
+        return self.__m
+
+    @property
+    def params(self):
+        return self.__p
+
+    @property
+    def pool(self):
+        return self.__pool
+
+    def open_connection(self):
+        # новое соединение в обход пула
+        if isinstance(self.__p, dict):
+            return self.__m.connect(**self.__p)
+        return self.__m.connect(*self.__p)
+
+    def check_connection(self, conn) -> bool:
+        # проверка живости соединения перед выдачей из пула
+        cursor = conn.cursor()
+        cursor.execute('select 1')
+        cursor.fetchall()
+        cursor.close()
+        return True
+
+    def commit_connection(self, conn):
+        conn.commit()
+
+    def reset_connection(self, conn):
+        # вернуть соединение в чистое состояние перед возвратом в пул
+        conn.rollback()
+
+    def close_connection(self, conn):
+        conn.close()
+
+    def cancel_connection(self, conn):
+        # прервать выполняющийся запрос, вызывается из другого потока
+        pass
+
+    def guard(self):
+        """
+        Срок для запроса (см. deadline): в срок запрос прерывается через cancel_connection и вызов получает
+        ERR_TIMEOUT, а соединение после отката закрывается
+        """
+        if deadline.get() is None:
+            return NO_GUARD
+        conn = self.connection
+        return Guard(lambda: self.__cancel(conn))
+
+    def __cancel(self, conn):
+        self.__discard = True
+        self.cancel_connection(conn)
 
     @property
     def connection(self):
         if not self.__conn:
-            if isinstance(self.__p, dict):
-                self.__conn = self.__m.connect(**self.__p)
-            else:
-                self.__conn = self.__m.connect(*self.__p)
+            if self.__limiter is not None:
+                self.__limiter.acquire()
+            try:
+                if self.__pool is not None:
+                    conn = self.__pool.acquire()
+                else:
+                    conn = self.open_connection()
+            except Exception as e:
+                if self.__limiter is not None:
+                    self.__limiter.release()
+                # очередь или таймаут пула (ErrorRPC) - перегрузка, а не отказ БД
+                if self.__member is not None and not isinstance(e, ErrorRPC):
+                    self.__member.failed()
+                raise e
+            if self.__member is not None:
+                self.__member.acquired()
+            self.__conn = conn
         return self.__conn
 
+    def __released(self):
+        if self.__member is not None:
+            self.__member.released()
+        if self.__limiter is not None:
+            self.__limiter.release()
+
+    def bind(self, query: typing.Union[str, Statement], args: tuple, kwargs: dict):
+        """
+        Текст запроса и аргументы для cursor.execute. Именованные параметры %(name)s
+        передаются драйверу отдельно от текста в его paramstyle
+        """
+        if not isinstance(query, Statement):
+            if kwargs == {} and args != ():
+                # позиционные параметры - в paramstyle драйвера, текст передается как есть
+                return query, args
+            query = Statement.get(query)
+        query, params = query.bind(self.paramstyle, kwargs)
+        return query, args if params is None else (params,)
+
     def cursor(self, query: str, *args, **kwargs):
+        query, args = self.bind(query, args, kwargs)
         cursor = self.connection.cursor()
-        cursor.execute(query, *args, **kwargs)
+        cursor.execute(query, *args)
         return cursor
 
     @abc.abstractmethod
@@ -57,33 +218,77 @@ class DBAdapter:
 
     def sql(self, query: str, *args, **kwargs):
         try:
-            cursor = self.cursor(query, *args, **kwargs)
-            return cursor.fetchall(), self.get_fields(cursor)
+            with self.guard():
+                cursor = self.cursor(query, *args, **kwargs)
+                return cursor.fetchall(), self.get_fields(cursor)
         except Exception as e:
             self.rollback()
             raise e
 
     def __call__(self, query: str, *args, **kwargs):
         try:
-            cursor = self.cursor(query, *args, **kwargs)
-            return cursor.fetchall()
+            with self.guard():
+                cursor = self.cursor(query, *args, **kwargs)
+                return cursor.fetchall()
         except Exception as e:
             self.rollback()
             raise e
 
     def dicts(self, query: str, *args, **kwargs):
         d, f = self.sql(query, *args, **kwargs)
-        ret = []
+        return make_rows(d, f) if f else []
+
+    def table(self, query: str, *args, **kwargs) -> dict:
+        """
+        Выборка в формате columnar
+        """
+        d, f = self.sql(query, *args, **kwargs)
+        return columnar(d or [], f or [])
+
+    def stream_cursor(self, query: str, *args, **kwargs):
+        # курсор, который не вычитывает всю выборку при execute
+        return self.cursor(query, *args, **kwargs)
+
+    def has_rows(self, cursor) -> bool:
+        return cursor.description is not None
+
+    def stream(self, query: str, *args, **kwargs):
+        """
+        Потоковая выборка через fetchmany(fetch_size). Запрос выполняется сразу,
+        возвращается генератор строк и описание полей
+        """
+        try:
+            with self.guard():
+                cursor = self.stream_cursor(query, *args, **kwargs)
+                first = cursor.fetchmany(self.fetch_size) if self.has_rows(cursor) else []
+            return self.__fetch(cursor, first), self.get_fields(cursor)
+        except Exception as e:
+            self.rollback()
+            raise e
+
+    def __fetch(self, cursor, first):
+        try:
+            d = first
+            while d:
+                yield from d
+                if len(d) < self.fetch_size:
+                    break
+                d = cursor.fetchmany(self.fetch_size)
+            cursor.close()
+        except Exception as e:
+            self.rollback()
+            raise e
+
+    def stream_dicts(self, query: str, *args, **kwargs):
+        d, f = self.stream(query, *args, **kwargs)
         if f:
-            for x in d:
-                rec = {f[n]['name']: v for n, v in enumerate(x)}
-                ret.append(rec)
-        return ret
+            yield from map(row_factory(f), d)
 
     def one(self, query: str, *args, **kwargs):
         try:
-            cursor = self.cursor(query, *args, **kwargs)
-            ret = tuple(cursor.fetchone())
+            with self.guard():
+                cursor = self.cursor(query, *args, **kwargs)
+                ret = tuple(cursor.fetchone())
             return ret[0] if len(ret) == 1 else ret
         except Exception as e:
             self.rollback()
@@ -91,46 +296,150 @@ class DBAdapter:
 
     def dml(self, query: str, *args, **kwargs):
         try:
-            self.cursor(query, *args, **kwargs)
+            with self.guard():
+                self.cursor(query, *args, **kwargs)
+            self.__written |= tables(str(query))
+        except Exception as e:
+            self.rollback()
+            raise e
+
+    def _written(self, names):
+        self.__written |= names
+
+    def bind_many(self, query: typing.Union[str, Statement], chunk: list):
+        """
+        Текст запроса и список параметров для executemany. Строки - словари для %(name)s, либо
+        последовательности значений в paramstyle драйвера
+        """
+        if not isinstance(chunk[0], dict):
+            return str(query), chunk
+        if not isinstance(query, Statement):
+            query = Statement.get(query)
+        return query.compile(self.paramstyle)[0], [query.bind(self.paramstyle, x)[1] or () for x in chunk]
+
+    def execute_many(self, cursor, query, chunk: list):
+        query, params = self.bind_many(query, chunk)
+        cursor.executemany(query, params)
+
+    def begin(self, conn):
+        # явное начало транзакции, чтобы первый savepoint не открыл и не зафиксировал собственную
+        pass
+
+    def dml_many(self, query: typing.Union[str, Statement], rows, chunk_size: int = None,
+                 on_error: str = 'raise') -> dict:
+        """
+        Запрос для каждой строки rows порциями по chunk_size (executemany). rows может быть итератором -
+        в памяти одновременно одна порция
+        :param on_error: raise - ошибка в порции откатывает транзакцию и выбрасывается с номером порции,
+        skip - откатывается только порция с ошибкой (через savepoint), остальные пишутся
+        :return: {"rows": записано строк, "chunks": число порций, "errors": [{"chunk", "offset", "size", "message"}]}
+        """
+        check_on_error(on_error)
+        ret, offset = bulk_report(), 0
+        try:
+            conn = self.connection
+            cursor = conn.cursor()
+            if on_error == 'skip':
+                self.begin(conn)
+            for chunk in chunks(rows, chunk_size or self.bulk_size):
+                try:
+                    if on_error == 'skip':
+                        cursor.execute('SAVEPOINT smartrpc_bulk')
+                    with self.guard():
+                        self.execute_many(cursor, query, chunk)
+                    ret['rows'] += len(chunk)
+                except ErrorRPC as e:
+                    if e.code == ERR_TIMEOUT[0]:
+                        raise e  # по сроку прерывается вся загрузка, а не порция
+                    if on_error == 'skip':
+                        cursor.execute('ROLLBACK TO SAVEPOINT smartrpc_bulk')
+                    bulk_error(ret, offset, len(chunk), e, on_error)
+                except Exception as e:
+                    if on_error == 'skip':
+                        cursor.execute('ROLLBACK TO SAVEPOINT smartrpc_bulk')
+                    bulk_error(ret, offset, len(chunk), e, on_error)
+                if on_error == 'skip':
+                    cursor.execute('RELEASE SAVEPOINT smartrpc_bulk')
+                ret['chunks'] += 1
+                offset += len(chunk)
+            self.__written |= tables(str(query))
+            return ret
         except Exception as e:
             self.rollback()
             raise e
 
     def rollback(self):
-        if self.__conn:
+        conn, self.__conn = self.__conn, None
+        self.__written = set()
+        if not conn:
+            return
+        self.__released()
+        discard, self.__discard = self.__discard, False
+        if self.__pool is None:
             try:
-                self.__conn.close()
+                self.close_connection(conn)
             except Exception as e:
                 pass
-        self.__conn = None
+            return
+        if discard:
+            self.__pool.release(conn, True)
+            return
+        try:
+            self.reset_connection(conn)
+        except Exception as e:
+            self.__pool.release(conn, True)
+        else:
+            self.__pool.release(conn)
 
     def commit(self):
         if self.__conn:
-            self.__conn.commit()
             try:
-                self.__conn.close()
+                self.commit_connection(self.__conn)
             except Exception as e:
-                pass
-            self.__conn = None
+                self.rollback()
+                raise e
+            conn, self.__conn = self.__conn, None
+            self.__released()
+            discard, self.__discard = self.__discard, False
+            if self.__pool is None:
+                try:
+                    self.close_connection(conn)
+                except Exception as e:
+                    pass
+            else:
+                self.__pool.release(conn, discard)
+            if self.__written:
+                # кэш сбрасывается только после фиксации, иначе в него может попасть старое состояние
+                written, self.__written = self.__written, set()
+                invalidate(written)
 
 
 class SQLiteAdapter(DBAdapter):
-
-    def cursor(self, query: str, *args, **kwargs):
-        if kwargs != {}:
-            query = query % kwargs
-            kwargs = {}
-        cursor = self.connection.cursor()
-        cursor.execute(query, *args, **kwargs)
-        return cursor
+    paramstyle = 'named'
 
     def module_name(self):
         return 'sqlite3'
 
+    def open_connection(self):
+        # соединение из пула может достаться другому потоку
+        p = self.params
+        if isinstance(p, dict):
+            return self.module.connect(**dict(p, check_same_thread=p.get('check_same_thread', False)))
+        if len(p) < 5:
+            return self.module.connect(*p, check_same_thread=False)
+        return self.module.connect(*p)
+
     def get_fields(self, cursor):
         if cursor.description is None: return
         return [{"n": n, "name": x[0]} for n, x in enumerate(cursor.description)]
 
+    def cancel_connection(self, conn):
+        conn.interrupt()
+
+    def begin(self, conn):
+        if not conn.in_transaction:
+            conn.execute('BEGIN')
+
     def prepare_conn_params(self, args, kwargs):
         if args == () and kwargs == {}:
             return [':memory:']
@@ -139,10 +448,82 @@ class SQLiteAdapter(DBAdapter):
 
 
 class PostgreSQLAdapter(DBAdapter):
+    paramstyle = 'pyformat'
+    prepared_size = 100  # по умолчанию сколько запросов держать подготовленными на каждом соединении
+    statements = weakref.WeakKeyDictionary()  # соединение -> StatementCache
+
+    def __init__(self, *args, prepared: int = None, **kwargs):
+        """
+        :param prepared: размер кэша prepared statements на соединении из пула, 0 - не подготавливать запросы
+        """
+        DBAdapter.__init__(self, *args, **kwargs)
+        self.__prepared = self.prepared_size if prepared is None else prepared
 
     def module_name(cls):
         return 'psycopg2'
 
+    @classmethod
+    def prepared_stats(cls) -> dict:
+        ret = {'statements': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+        for x in list(cls.statements.values()):
+            ret['statements'] += len(x)
+            ret['hits'] += x.hits
+            ret['misses'] += x.misses
+            ret['evictions'] += x.evictions
+        return ret
+
+    def check_connection(self, conn) -> bool:
+        if conn.closed:
+            return False
+        super().check_connection(conn)
+        conn.rollback()
+        return True
+
+    def cancel_connection(self, conn):
+        # то же, что pg_cancel_backend для серверного процесса соединения
+        conn.cancel()
+
+    def commit_connection(self, conn):
+        conn.commit()
+        cache = self.statements.get(conn)
+        if cache is not None:
+            cache.committed()
+
+    def reset_connection(self, conn):
+        conn.rollback()
+        cache = self.statements.get(conn)
+        if cache is not None and cache.dirty:
+            cache.clear()
+            cursor = conn.cursor()
+            cursor.execute('DEALLOCATE ALL')
+            conn.commit()
+
+    def cursor(self, query: str, *args, **kwargs):
+        """
+        Запросы узлов SQLMethod (Statement) на соединениях из пула выполняются через PREPARE/EXECUTE,
+        план запроса строится один раз на соединение
+        """
+        if not (self.__prepared > 0 and self.pool is not None and isinstance(query, Statement) and args == ()):
+            return super().cursor(query, *args, **kwargs)
+        conn = self.connection
+        cache = self.statements.get(conn)
+        if cache is None:
+            ref = weakref.ref(conn)  # кэш не должен держать соединение
+            cache = self.statements[conn] = StatementCache(
+                self.__prepared, lambda name: ref().cursor().execute('DEALLOCATE ' + name)
+            )
+        text, params = query.bind('dollar', kwargs)
+        cursor = conn.cursor()
+        name = cache.get(text)
+        if name is None:
+            name = cache.add(text)
+            cursor.execute('PREPARE %s AS %s' % (name, text))
+        if params:
+            cursor.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(params))), params)
+        else:
+            cursor.execute('EXECUTE ' + name)
+        return cursor
+
     def get_fields(self, cursor):
         if cursor.description is None: return
         return [
@@ -154,24 +535,140 @@ class PostgreSQLAdapter(DBAdapter):
             for n, x in enumerate(cursor.description)
         ]
 
-    def cursor(self, query: str, *args, **kwargs):
-        if kwargs != {}:
-            query = query % kwargs
-            kwargs = {}
-        cursor = self.connection.cursor()
-        cursor.execute(query, *args, **kwargs)
+    def stream_cursor(self, query: str, *args, **kwargs):
+        # серверный курсор: обычный курсор psycopg2 забирает всю выборку на клиента при execute
+        if not re.match(r'\s*(select|with|values)\b', str(query), re.I):
+            return self.cursor(query, *args, **kwargs)
+        query, args = self.bind(query, args, kwargs)
+        cursor = self.connection.cursor(name='smartrpc_%x' % id(self))
+        cursor.itersize = self.fetch_size
+        cursor.execute(query, *args)
         return cursor
 
+    def has_rows(self, cursor) -> bool:
+        # у серверного курсора description появляется только после первого fetch
+        return cursor.name is not None or cursor.description is not None
+
+    def execute_many(self, cursor, query, chunk: list):
+        """
+        INSERT ... VALUES (%(a)s, ...) из одних параметров пишется через COPY, остальное - execute_batch
+        """
+        plan = copy_plan(str(query))
+        if plan is not None and isinstance(chunk[0], dict):
+            table, columns, names = plan
+            cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)),
+                               CopyReader([x[n] for n in names] for x in chunk))
+            return
+        query, params = self.bind_many(query, chunk)
+        __import__('psycopg2.extras', globals()).extras.execute_batch(cursor, query, params, page_size=len(chunk))
+
+    def copy_from(self, table: str, rows, columns: list = None) -> int:
+        """
+        COPY table FROM STDIN из итератора строк. Строки - последовательности значений в порядке columns,
+        либо словари (тогда columns обязательны). Строки кодируются по мере чтения драйвером
+        :return: число записанных строк
+        """
+        if columns:
+            rows = ([x[n] for n in columns] if isinstance(x, dict) else x for x in rows)
+        reader = CopyReader(rows)
+        try:
+            cursor = self.connection.cursor()
+            with self.guard():
+                cursor.copy_expert('COPY %s%s FROM STDIN' % (table, ' (%s)' % ', '.join(columns) if columns else ''),
+                                   reader)
+            self._written({table_name(table)})
+            return reader.count
+        except Exception as e:
+            self.rollback()
+            raise e
+
+
+# INSERT INTO t (a, b) VALUES (%(a)s, %(b)s)
+COPY_INSERT = re.compile(r'\s*insert\s+into\s+([\w."]+)\s*\(([^)]*)\)\s*values\s*'
+                         r'\(\s*(%\(\w+\)s(?:\s*,\s*%\(\w+\)s)*)\s*\)\s*;?\s*$', re.I)
+
+
+@functools.lru_cache(maxsize=256)
+def copy_plan(query: str):
+    """
+    Таблица, колонки и имена параметров, если запрос можно заменить на COPY
+    """
+    m = COPY_INSERT.match(query)
+    if not m:
+        return None
+    columns = [x.strip() for x in m.group(2).split(',')]
+    names = re.findall(r'%\((\w+)\)s', m.group(3))
+    if len(columns) != len(names):
+        return None
+    return m.group(1), tuple(columns), tuple(names)
+
+
+def copy_value(x) -> str:
+    # значение в текстовом формате COPY
+    if x is None:
+        return '\\N'
+    if isinstance(x, bool):
+        return 't' if x else 'f'
+    if isinstance(x, (datetime.datetime, datetime.date, datetime.time)):
+        x = x.isoformat()
+    elif isinstance(x, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(x).hex()
+    elif isinstance(x, (dict, list)):
+        x = json.dumps(x, ensure_ascii=False)
+    elif not isinstance(x, str):
+        return str(x)
+    return x.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyReader:
+    """
+    Файл для cursor.copy_expert: строки итератора в текстовом формате COPY, кодируются по мере чтения
+    """
+
+    def __init__(self, rows):
+        self.__rows = iter(rows)
+        self.__buf = ''
+        self.count = 0
+
+    def __line(self):
+        row = next(self.__rows, None)
+        if row is None:
+            return ''
+        self.count += 1
+        return '\t'.join(copy_value(x) for x in row) + '\n'
+
+    def read(self, size: int = -1) -> str:
+        buf = [self.__buf]
+        n = len(self.__buf)
+        while size < 0 or n < size:
+            line = self.__line()
+            if not line:
+                break
+            buf.append(line)
+            n += len(line)
+        buf = ''.join(buf)
+        if size < 0:
+            self.__buf = ''
+            return buf
+        self.__buf = buf[size:]
+        return buf[:size]
+
+    def readline(self, size: int = -1) -> str:
+        if self.__buf:
+            line, self.__buf = self.__buf, ''
+            return line
+        return self.__line()
+
 
 class TarantoolAdapter(DBAdapter):
+    paramstyle = 'named'
 
     def module_name(cls):
         return 'tarantool'
 
     def cursor(self, query: str, *args, **kwargs):
-        if kwargs != {}:
-            args = kwargs
-        return self.connection.execute(query, args)
+        query, params = self.bind(query, (), kwargs)
+        return self.connection.execute(str(query), params[0] if params else args)
 
     def prepare_conn_params(self, args, kwargs):
         if len(args) > 0 and isinstance(args[0], dict):
@@ -195,6 +692,11 @@ class TarantoolAdapter(DBAdapter):
             self.rollback()
             raise e
 
+    def stream(self, query: str, *args, **kwargs):
+        # tarantool отдает выборку целиком
+        d, f = self.sql(query, *args, **kwargs)
+        return iter(d or ()), f
+
     def one(self, query: str, *args, **kwargs):
         try:
             cursor = self.cursor(query, *args, **kwargs)
@@ -215,7 +717,365 @@ class TarantoolAdapter(DBAdapter):
             for n, x in enumerate(cursor.body[l])
         ]
 
+    def check_connection(self, conn) -> bool:
+        conn.ping()
+        return True
+
+    def reset_connection(self, conn):
+        pass
+
     def commit(self):
         # fake !!
         self.rollback()
 
+
+
+class AsyncDBAdapter:
+    """
+    Асинхронный адаптер. Потомки с собственным async драйвером подбираются по имени синхронного модуля алиаса,
+    для остальных драйверов вызовы синхронного адаптера уходят в пул потоков (ThreadedAsyncAdapter)
+    """
+    fetch_size = DBAdapter.fetch_size
+    bulk_size = DBAdapter.bulk_size
+    paramstyle = DBAdapter.paramstyle
+
+    @classmethod
+    def find(cls, module_name: str):
+        for x in cls.__subclasses__():
+            if x.sync_module_name(x) == module_name and x.module(x) is not None:
+                return x
+
+    @abc.abstractclassmethod
+    def module_name(cls):
+        pass
+
+    def sync_module_name(self):
+        pass
+
+    def module(self):
+        global MODULES
+        n = self.module_name(self)
+        if n not in MODULES:
+            try:
+                MODULES[n] = __import__(n, globals())
+            except ImportError:
+                MODULES[n] = None
+        return MODULES[n]
+
+    @classmethod
+    async def create_pool(cls, params, **options):
+        pass
+
+    def bind(self, query: typing.Union[str, Statement], args: tuple, kwargs: dict):
+        """
+        Текст запроса и позиционные параметры для async драйвера
+        """
+        if len(args) == 1 and isinstance(args[0], (list, tuple)):
+            args = args[0]
+        if not isinstance(query, Statement):
+            if kwargs == {} and args != ():
+                # позиционные параметры - в paramstyle драйвера, текст передается как есть
+                return query, args
+            query = Statement.get(query)
+        query, params = query.bind(self.paramstyle, kwargs)
+        return query, args if params is None else params
+
+    async def sql(self, query: str, *args, **kwargs):
+        return None, None
+
+    async def dicts(self, query: str, *args, **kwargs):
+        d, f = await self.sql(query, *args, **kwargs)
+        return make_rows(d, f) if f else []
+
+    async def one(self, query: str, *args, **kwargs):
+        d, f = await self.sql(query, *args, **kwargs)
+        ret = tuple(d[0])
+        return ret[0] if len(ret) == 1 else ret
+
+    async def stream(self, query: str, *args, **kwargs):
+        """
+        Асинхронный генератор строк и описание полей
+        """
+        d, f = await self.sql(query, *args, **kwargs)
+
+        async def rows():
+            for x in d or ():
+                yield x
+        return rows(), f
+
+    async def dml(self, query: str, *args, **kwargs):
+        await self.sql(query, *args, **kwargs)
+
+    async def dml_many(self, query: str, rows, chunk_size: int = None, on_error: str = 'raise') -> dict:
+        """
+        См. DBAdapter.dml_many. Без собственной реализации у драйвера - по запросу на строку и без savepoint,
+        поэтому только on_error=raise
+        """
+        if check_on_error(on_error) != 'raise':
+            raise ErrorRPC(ERR_BAD_PARAMS, '+on_error=%s is not supported by %s' % (on_error, self.module_name()))
+        ret, offset = bulk_report(), 0
+        for chunk in chunks(rows, chunk_size or DBAdapter.bulk_size):
+            try:
+                for x in chunk:
+                    if isinstance(x, dict):
+                        await self.dml(query, **x)
+                    else:
+                        await self.dml(query, *x)
+            except Exception as e:
+                bulk_error(ret, offset, len(chunk), e, on_error)
+            ret['rows'] += len(chunk)
+            ret['chunks'] += 1
+            offset += len(chunk)
+        return ret
+
+    async def rollback(self):
+        pass
+
+    async def commit(self):
+        pass
+
+
+class ThreadedAsyncAdapter(AsyncDBAdapter):
+    """
+    Синхронный адаптер, вызовы которого выполняются в пуле потоков
+    """
+
+    def module_name(cls):
+        pass
+
+    def __init__(self, adapter: DBAdapter, executor=None):
+        self.__adapter = adapter
+        self.__executor = executor
+
+    @property
+    def adapter(self) -> DBAdapter:
+        return self.__adapter
+
+    async def connection(self):
+        return await self.__run(lambda: self.__adapter.connection)
+
+    async def __run(self, fn, *args, **kwargs):
+        # с контекстом в поток переходит срок вызова
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(self.__executor, functools.partial(ctx.run, fn, *args, **kwargs))
+
+    async def sql(self, query: str, *args, **kwargs):
+        return await self.__run(self.__adapter.sql, query, *args, **kwargs)
+
+    async def dicts(self, query: str, *args, **kwargs):
+        return await self.__run(self.__adapter.dicts, query, *args, **kwargs)
+
+    async def one(self, query: str, *args, **kwargs):
+        return await self.__run(self.__adapter.one, query, *args, **kwargs)
+
+    async def dml(self, query: str, *args, **kwargs):
+        return await self.__run(self.__adapter.dml, query, *args, **kwargs)
+
+    async def dml_many(self, query: str, rows, chunk_size: int = None, on_error: str = 'raise') -> dict:
+        return await self.__run(self.__adapter.dml_many, query, rows, chunk_size, on_error)
+
+    async def stream(self, query: str, *args, **kwargs):
+        d, f = await self.__run(self.__adapter.stream, query, *args, **kwargs)
+        return self.__pull(d), f
+
+    async def __pull(self, rows):
+        # строки вычитываются из синхронного генератора порциями в пуле потоков
+        size = self.__adapter.fetch_size
+        while True:
+            chunk = await self.__run(lambda: list(itertools.islice(rows, size)))
+            for x in chunk:
+                yield x
+            if len(chunk) < size:
+                break
+
+    async def rollback(self):
+        return await self.__run(self.__adapter.rollback)
+
+    async def commit(self):
+        return await self.__run(self.__adapter.commit)
+
+
+class AsyncPGAdapter(AsyncDBAdapter):
+    """
+    asyncpg для алиасов psycopg2. Строка соединения должна быть в формате URL (postgresql://...)
+    """
+    paramstyle = 'dollar'
+
+    def module_name(cls):
+        return 'asyncpg'
+
+    def sync_module_name(cls):
+        return 'psycopg2'
+
+    @classmethod
+    async def create_pool(cls, params, min_size: int = 0, max_size: int = 10, idle_timeout: float = 300.0,
+                          **options):
+        m = cls.module(cls)
+        kwargs = {
+            'min_size': min_size,
+            'max_size': max_size,
+            'max_inactive_connection_lifetime': idle_timeout or 0
+        }
+        if isinstance(params, dict):
+            params = dict(params)
+            if 'dbname' in params:
+                params['database'] = params.pop('dbname')
+            return await m.create_pool(**params, **kwargs)
+        return await m.create_pool(*params, **kwargs)
+
+    def __init__(self, pool, wait_timeout: float = 30.0, member=None, limiter=None, **options):
+        self.__pool = pool
+        self.__wait_timeout = wait_timeout
+        self.__member = member
+        self.__limiter = limiter
+        self.__conn = None
+        self.__tr = None
+
+    async def connection(self):
+        if self.__conn is None:
+            if self.__limiter is not None:
+                await self.__limiter.aacquire()
+            try:
+                conn = await self.__pool.acquire(timeout=self.__wait_timeout)
+            except asyncio.TimeoutError as e:
+                if self.__limiter is not None:
+                    self.__limiter.release()
+                raise ErrorRPC(ERR_BUSY, '+Pool timeout')
+            except BaseException as e:
+                if self.__limiter is not None:
+                    self.__limiter.release()
+                if self.__member is not None and isinstance(e, Exception):
+                    self.__member.failed()
+                raise e
+            try:
+                tr = conn.transaction()
+                await tr.start()
+            except BaseException as e:
+                await self.__pool.release(conn)
+                if self.__limiter is not None:
+                    self.__limiter.release()
+                raise e
+            if self.__member is not None:
+                self.__member.acquired()
+            self.__conn, self.__tr = conn, tr
+        return self.__conn
+
+    def get_fields(self, statement):
+        attrs = statement.get_attributes()
+        if not attrs: return
+        return [
+            {
+                "n": n,
+                "name": x.name,
+                'type_id': x.type.oid
+            }
+            for n, x in enumerate(attrs)
+        ]
+
+    async def sql(self, query: str, *args, **kwargs):
+        try:
+            query, args = self.bind(query, args, kwargs)
+            conn = await self.connection()
+            statement = await conn.prepare(query, timeout=remaining())
+            return await statement.fetch(*args, timeout=remaining()), self.get_fields(statement)
+        except Exception as e:
+            await self.rollback()
+            raise timed_out(e)
+
+    async def stream(self, query: str, *args, **kwargs):
+        try:
+            query, args = self.bind(query, args, kwargs)
+            conn = await self.connection()
+            statement = await conn.prepare(query, timeout=remaining())
+            return statement.cursor(*args, prefetch=self.fetch_size), self.get_fields(statement)
+        except Exception as e:
+            await self.rollback()
+            raise timed_out(e)
+
+    async def dml_many(self, query: str, rows, chunk_size: int = None, on_error: str = 'raise') -> dict:
+        """
+        См. DBAdapter.dml_many: executemany порциями, INSERT из одних параметров - через COPY.
+        При on_error=skip каждая порция - во вложенной транзакции (savepoint)
+        """
+        check_on_error(on_error)
+        ret, offset = bulk_report(), 0
+        try:
+            conn = await self.connection()
+            plan = copy_plan(str(query))
+            for chunk in chunks(rows, chunk_size or self.bulk_size):
+                try:
+                    if on_error == 'skip':
+                        async with conn.transaction():
+                            await self.__execute_many(conn, query, plan, chunk)
+                    else:
+                        await self.__execute_many(conn, query, plan, chunk)
+                    ret['rows'] += len(chunk)
+                except asyncio.TimeoutError as e:
+                    raise e
+                except Exception as e:
+                    bulk_error(ret, offset, len(chunk), e, on_error)
+                ret['chunks'] += 1
+                offset += len(chunk)
+            return ret
+        except Exception as e:
+            await self.rollback()
+            raise timed_out(e)
+
+    async def __execute_many(self, conn, query, plan, chunk):
+        if plan is not None and isinstance(chunk[0], dict):
+            table, columns, names = plan
+            await conn.copy_records_to_table(table, records=[[x[n] for n in names] for x in chunk],
+                                             columns=list(columns), timeout=remaining())
+        elif isinstance(chunk[0], dict):
+            statement = query if isinstance(query, Statement) else Statement.get(query)
+            await conn.executemany(statement.compile(self.paramstyle)[0],
+                                   [statement.bind(self.paramstyle, x)[1] or () for x in chunk], timeout=remaining())
+        else:
+            await conn.executemany(str(query), chunk, timeout=remaining())
+
+    async def copy_from(self, table: str, rows, columns: list = None) -> int:
+        """
+        См. PostgreSQLAdapter.copy_from. Строки передаются драйверу порциями по bulk_size
+        """
+        n = 0
+        try:
+            conn = await self.connection()
+            for chunk in chunks(rows, self.bulk_size):
+                if columns:
+                    chunk = [[x[c] for c in columns] if isinstance(x, dict) else x for x in chunk]
+                await conn.copy_records_to_table(table, records=chunk, columns=columns, timeout=remaining())
+                n += len(chunk)
+            return n
+        except Exception as e:
+            await self.rollback()
+            raise timed_out(e)
+
+    async def __release(self, finish):
+        conn, tr = self.__conn, self.__tr
+        self.__conn, self.__tr = None, None
+        if conn is None:
+            return
+        self.__released()
+        try:
+            await finish(tr)
+        except Exception as e:
+            conn.terminate()
+            await self.__pool.release(conn)
+            raise e
+        await self.__pool.release(conn)
+
+    def __released(self):
+        if self.__member is not None:
+            self.__member.released()
+        if self.__limiter is not None:
+            self.__limiter.release()
+
+    async def rollback(self):
+        try:
+            await self.__release(lambda tr: tr.rollback())
+        except Exception as e:
+            pass
+
+    async def commit(self):
+        await self.__release(lambda tr: tr.commit())
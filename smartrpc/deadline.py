@@ -0,0 +1,160 @@
+import threading, contextvars, heapq, itertools, os, time
+from .err import *
+
+# срок текущего вызова по time.monotonic, см. RPC: параметр метода timeout и поле запроса "timeout"
+deadline = contextvars.ContextVar('deadline', default=None)
+
+
+def remaining() -> float:
+    """
+    Секунд до срока вызова, None - срока нет. Если срок прошел - ERR_TIMEOUT
+    """
+    d = deadline.get()
+    if d is None:
+        return None
+    left = d - time.monotonic()
+    if left <= 0:
+        raise ErrorRPC(ERR_TIMEOUT)
+    return left
+
+
+def within(timeout: float):
+    """
+    Токен contextvar со сроком через timeout секунд, но не позже уже действующего срока. None - срок не меняется
+    """
+    if timeout is None:
+        return None
+    d = time.monotonic() + timeout
+    outer = deadline.get()
+    return deadline.set(d if outer is None or d < outer else outer)
+
+
+class Watchdog:
+    """
+    Один поток на процесс, который в срок вызывает отмену зарегистрированных запросов к БД
+    """
+
+    def __init__(self):
+        self.__cond = threading.Condition(threading.Lock())
+        self.__heap = []  # (срок, номер, Timer)
+        self.__seq = itertools.count()
+        self.__cancelled = 0
+        self.__pid = None
+
+    def __start(self):
+        # вызывается под блокировкой. поток не переживает fork, в дочернем процессе он запускается заново
+        if self.__pid != os.getpid():
+            self.__pid = os.getpid()
+            self.__heap = []
+            threading.Thread(target=self.__run, name='smartrpc-watchdog', daemon=True).start()
+
+    def add(self, when: float, fn) -> 'Timer':
+        timer = Timer(fn)
+        with self.__cond:
+            self.__start()
+            heapq.heappush(self.__heap, (when, next(self.__seq), timer))
+            if self.__heap[0][2] is timer:
+                self.__cond.notify()
+        return timer
+
+    def discard(self, timer: 'Timer') -> bool:
+        """
+        Снять таймер, True - отмена уже вызвана. Снятые таймеры убираются из очереди пачкой,
+        иначе при длинных сроках очередь растет с каждым запросом
+        """
+        fired = timer.cancel()
+        with self.__cond:
+            self.__cancelled += 1
+            if self.__cancelled > 1024 and self.__cancelled * 2 > len(self.__heap):
+                self.__heap = [x for x in self.__heap if not x[2].done]
+                heapq.heapify(self.__heap)
+                self.__cancelled = 0
+        return fired
+
+    def after_fork(self):
+        self.__cond = threading.Condition(threading.Lock())
+        self.__heap = []
+        self.__cancelled = 0
+
+    def __run(self):
+        pid = os.getpid()
+        while True:
+            due = []
+            with self.__cond:
+                if self.__pid != pid:
+                    return
+                now = time.monotonic()
+                while self.__heap and (self.__heap[0][0] <= now or self.__heap[0][2].done):
+                    due.append(heapq.heappop(self.__heap)[2])
+                if not due:
+                    self.__cond.wait(self.__heap[0][0] - now if self.__heap else None)
+            for x in due:
+                x.fire()
+
+
+class Timer:
+    __slots__ = ('fn', 'done', 'fired', 'lock')
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.done = False
+        self.fired = False
+        self.lock = threading.Lock()
+
+    def fire(self):
+        # под блокировкой: cancel вернется только после того, как отмена отправлена
+        with self.lock:
+            if self.done:
+                return
+            self.done = self.fired = True
+            try:
+                self.fn()
+            except Exception:
+                pass
+
+    def cancel(self) -> bool:
+        # True - отмена запроса уже вызвана
+        with self.lock:
+            self.done = True
+            return self.fired
+
+
+WATCHDOG = Watchdog()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=WATCHDOG.after_fork)
+
+
+class Guard:
+    """
+    Запрос к БД со сроком: в срок вызывается cancel, ошибка драйвера от отмены превращается в ERR_TIMEOUT
+    """
+    __slots__ = ('cancel', 'timer')
+
+    def __init__(self, cancel):
+        self.cancel = cancel
+        self.timer = None
+
+    def __enter__(self):
+        remaining()
+        self.timer = WATCHDOG.add(deadline.get(), self.cancel)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # отмена могла прийти и после конца запроса - вызов все равно завершается по сроку
+        if WATCHDOG.discard(self.timer):
+            raise ErrorRPC(ERR_TIMEOUT, '+Query cancelled') from exc
+        return False
+
+
+class NoGuard:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NO_GUARD = NoGuard()
@@ -1,30 +1,153 @@
 from abc import abstractclassmethod
-from .db import DBAdapter
+import asyncio, weakref
+from .db import DBAdapter, AsyncDBAdapter, ThreadedAsyncAdapter
+from .pool import ConnectionPool
+from .replicas import ReplicaGroup
+from .limits import Limiter
 from .err import *
 
 class BaseEnv:
 
     def __init__(self):
         self.__aliases = {}
+        self.__groups = {}
 
-    def set_db_alias(self, alias_name, type='sqlite3', *args, **kwargs):
-        if DBAdapter.get(type, *args, **kwargs) is None:
+    def set_db_alias(self, alias_name, type='sqlite3', *args, pool: dict = None, limit: dict = None, **kwargs):
+        """
+        :param pool: параметры пула соединений (см. ConnectionPool), False - соединяться на каждый вызов
+        :param limit: ограничение одновременно занятых соединений алиаса, параметры Limiter: max_inflight,
+        max_queue, queue_timeout. сверх него вызовы сразу получают ERR_BUSY, а не ждут в очереди пула
+        """
+        adapter = DBAdapter.get(type, *args, **kwargs)
+        if adapter is None:
             raise ErrorRPC(ERR_SERVER, 'Bad alias %s %s' % (alias_name, type))
+        if alias_name in self.__groups:
+            raise ErrorRPC(ERR_SERVER, 'Alias %s is a replica group' % alias_name)
+        old = self.__aliases.get(alias_name)
+        if old and old['pool'] is not None:
+            old['pool'].close()
         self.__aliases[alias_name] = {
             "type": type,
             "args": args,
-            "kwargs":kwargs
+            "kwargs":kwargs,
+            "pool": None if pool is False else ConnectionPool(adapter, **(pool or {})),
+            "pool_options": pool or {},
+            "adapter": adapter,
+            "limiter": Limiter(name='Alias %s' % alias_name, **limit) if limit else None,
+            "async_pools": weakref.WeakKeyDictionary()  # пулы async драйвера по циклам событий
         }
 
+    def set_db_group(self, group_name, primary, replicas=(), balance: str = 'round_robin', max_failures: int = 1,
+                     retry_after: float = 30.0):
+        """
+        Алиас из основного алиаса и реплик (см. ReplicaGroup). Алиасы должны быть заданы через set_db_alias,
+        SQL методы только для чтения идут в реплики, остальные - в основной алиас
+        :param balance: round_robin или least_outstanding
+        """
+        for x in (primary,) + tuple(replicas):
+            if x not in self.__aliases:
+                raise ErrorRPC(ERR_SERVER, 'Bad alias %s in group %s' % (x, group_name))
+        if group_name in self.__aliases:
+            raise ErrorRPC(ERR_SERVER, 'Group %s conflicts with alias' % group_name)
+        self.__groups[group_name] = ReplicaGroup(primary, replicas, balance, max_failures, retry_after)
+
+    def group(self, group_name) -> ReplicaGroup:
+        return self.__groups.get(group_name)
+
     def check_alias(self, alias_name):
-        return alias_name in self.__aliases
+        return alias_name in self.__aliases or alias_name in self.__groups
+
+    def pool(self, alias_name=None) -> ConnectionPool:
+        group = self.__groups.get(alias_name)
+        if group is not None:
+            alias_name = group.primary.alias
+        return self.__defs(alias_name)['pool']
+
+    def limiter(self, alias_name=None) -> Limiter:
+        return self.__defs(alias_name)['limiter']
+
+    def __member(self, alias_name, readonly):
+        group = self.__groups.get(alias_name)
+        if group is None:
+            return alias_name, None
+        member = group.choose(readonly)
+        return member.alias, member
 
-    def connect(self, alias_name=None):
+    def __defs(self, alias_name):
         defs = self.__aliases.get(alias_name)
         if defs:
-            return DBAdapter.get(defs['type'], *defs['args'])
-        if alias_name is None and len(defs.keys()) == 1:
-            defs = self.__aliases[tuple(defs.keys())[0]]
-            return DBAdapter.get(defs['type'], *defs['args'])
+            return defs
+        if alias_name is None and len(self.__aliases) == 1:
+            return self.__aliases[tuple(self.__aliases.keys())[0]]
         raise ErrorRPC(ERR_SERVER, 'Bad alias %s' % alias_name)
 
+    @staticmethod
+    def __failover(member):
+        # реплика отказала: следующая исправная реплика, иначе основной алиас
+        x = member.group.choose(True)
+        return x if x is not member else member.group.primary
+
+    def connect(self, alias_name=None, readonly: bool = False):
+        """
+        :param readonly: только чтение - для группы реплик соединение с репликой. Оно открывается сразу:
+        если реплика отказала, соединение один раз повторяется с другой исправной репликой или основным алиасом
+        """
+        alias_name, member = self.__member(alias_name, readonly)
+        adapter = self.__connect(alias_name, member)
+        if member is None or member.primary:
+            return adapter
+        try:
+            adapter.connection
+        except ErrorRPC as e:
+            raise e  # очередь или таймаут пула - перегрузка, а не отказ реплики
+        except Exception:
+            member = self.__failover(member)
+            return self.__connect(member.alias, member)
+        return adapter
+
+    def __connect(self, alias_name, member):
+        defs = self.__defs(alias_name)
+        return DBAdapter.get(defs['type'], *defs['args'], pool=defs['pool'], member=member,
+                             limiter=defs['limiter'], **defs['kwargs'])
+
+    async def aconnect(self, alias_name=None, executor=None, readonly: bool = False):
+        """
+        Асинхронный адаптер алиаса. Если у драйвера нет async варианта, запросы пойдут в пул потоков executor.
+        Отказ реплики при чтении - как в connect
+        """
+        alias_name, member = self.__member(alias_name, readonly)
+        if member is None or member.primary:
+            return await self.__aconnect(alias_name, member, executor)
+        try:
+            adapter = await self.__aconnect(alias_name, member, executor)
+            await adapter.connection()
+        except ErrorRPC as e:
+            raise e
+        except Exception:
+            member = self.__failover(member)
+            return await self.__aconnect(member.alias, member, executor)
+        return adapter
+
+    async def __aconnect(self, alias_name, member, executor):
+        defs = self.__defs(alias_name)
+        cls = AsyncDBAdapter.find(defs['type'])
+        if cls is None:
+            adapter = DBAdapter.get(defs['type'], *defs['args'], pool=defs['pool'], member=member,
+                                    limiter=defs['limiter'], **defs['kwargs'])
+            return ThreadedAsyncAdapter(adapter, executor)
+
+        pools = defs['async_pools']
+        loop = asyncio.get_running_loop()
+        pool = pools.get(loop)
+        if pool is None:
+            pool = pools[loop] = asyncio.ensure_future(
+                cls.create_pool(defs['adapter'].params, **defs['pool_options'])
+            )
+        try:
+            return cls(await pool, member=member, limiter=defs['limiter'], **defs['pool_options'])
+        except Exception as e:
+            if pools.get(loop) is pool:
+                del pools[loop]
+            if member is not None:
+                member.failed()
+            raise e
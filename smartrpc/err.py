@@ -34,6 +34,8 @@ ERR_INTERNAL =  (-32603, "Internal error")
 ERR_SERVER =    (-32000, "Server error")
 
 ERR_CONNECT =   (-32701, "Connection error")
+ERR_BUSY =      (-32702, "Server busy")
+ERR_TIMEOUT =   (-32703, "Timeout")
 
 def error(code=ERR_INTERNAL, message=None, json_msg=None):
     if isinstance(code, tuple):
@@ -0,0 +1,126 @@
+import threading, asyncio
+from collections import deque
+from .err import *
+
+
+class Waiter:
+    # вызов в очереди Limiter: поток ждет Event, корутина - future своего цикла событий
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def grant(self):
+        # вызывается под блокировкой Limiter, слот переходит ожидающему
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.__wake)
+
+    def __wake(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class Limiter:
+    """
+    Ограничение числа одновременных вызовов метода или соединений алиаса.
+    Сверх max_inflight вызовы ждут в очереди не дольше queue_timeout секунд, если очередь длиннее max_queue -
+    сразу получают ERR_BUSY. Общий для потоков и циклов событий
+    """
+
+    def __init__(self, max_inflight: int, max_queue: int = 0, queue_timeout: float = 1.0, name: str = ''):
+        """
+        :param max_inflight: сколько вызовов выполняется одновременно
+        :param max_queue: сколько вызовов может ждать свободного места, 0 - отказывать сразу
+        :param queue_timeout: сколько секунд вызов ждет в очереди
+        """
+        if max_inflight < 1 or max_queue < 0:
+            raise ErrorRPC(ERR_SERVER, '+Bad limit %s, queue %s' % (max_inflight, max_queue))
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.name = name
+        self.rejected = 0
+        self.__lock = threading.Lock()
+        self.__inflight = 0
+        self.__waiters = deque()
+
+    def __busy(self, reason: str):
+        # вызывается под блокировкой
+        self.rejected += 1
+        return ErrorRPC(ERR_BUSY, '+%s %s' % (self.name or 'Limit', reason))
+
+    def __enqueue(self, loop=None):
+        # None - слот получен сразу, иначе Waiter в очереди
+        with self.__lock:
+            if self.__inflight < self.max_inflight and not self.__waiters:
+                self.__inflight += 1
+                return None
+            if len(self.__waiters) >= self.max_queue:
+                raise self.__busy('queue is full')
+            w = Waiter(loop)
+            self.__waiters.append(w)
+            return w
+
+    def __dequeue(self, w: Waiter) -> bool:
+        # ожидание прервано. True - слот все же успел достаться
+        with self.__lock:
+            if w.granted:
+                return True
+            self.__waiters.remove(w)
+            self.rejected += 1
+            return False
+
+    def acquire(self):
+        w = self.__enqueue()
+        if w is None or w.event.wait(self.queue_timeout) or self.__dequeue(w):
+            return
+        raise ErrorRPC(ERR_BUSY, '+%s queue timeout' % (self.name or 'Limit'))
+
+    async def aacquire(self):
+        w = self.__enqueue(asyncio.get_running_loop())
+        if w is None:
+            return
+        try:
+            await asyncio.wait_for(w.future, self.queue_timeout)
+            return
+        except asyncio.TimeoutError:
+            if self.__dequeue(w):
+                return
+        except asyncio.CancelledError as e:
+            if self.__dequeue(w):
+                self.release()
+            raise e
+        raise ErrorRPC(ERR_BUSY, '+%s queue timeout' % (self.name or 'Limit'))
+
+    def release(self):
+        with self.__lock:
+            if self.__waiters:
+                self.__waiters.popleft().grant()
+            else:
+                self.__inflight -= 1
+
+    def call(self, fn):
+        self.acquire()
+        try:
+            return fn()
+        finally:
+            self.release()
+
+    async def acall(self, fn):
+        await self.aacquire()
+        try:
+            return await fn()
+        finally:
+            self.release()
+
+    def state(self) -> dict:
+        return {
+            "inflight": self.__inflight,
+            "queued": len(self.__waiters),
+            "rejected": self.rejected
+        }
@@ -1,6 +1,26 @@
 from .env import BaseEnv
 from .err import *
-import abc
+from .stream import ResultStream, AsyncResultStream
+from .statement import Statement
+from .cache import table_name, tables, READS, WRITES
+from .db import FORMATS, columnar, check_on_error
+from .rows import make_rows, row_factory
+from .metrics import clock
+from .replicas import readonly as is_readonly
+from .limits import Limiter
+from . import script
+from . import transaction
+import abc, asyncio, functools, contextvars, importlib, threading
+
+
+# расширения JSON-RPC из текущего запроса (например format), см. RPC.REQUEST_OPTIONS
+call_options = contextvars.ContextVar('call_options', default={})
+
+
+def check_format(format: str) -> str:
+    if format not in FORMATS:
+        raise ErrorRPC(ERR_BAD_PARAMS, '+Unknown format ' + str(format))
+    return format
 
 
 class RPCBase:
@@ -16,12 +36,44 @@ class RPCBase:
     def env(self) -> BaseEnv:
         return self.__env
 
+    @property
+    def metrics(self):
+        return None
+
+    @property
+    def script_cache(self):
+        return None
 
-class Method:
 
-    def __init__(self, rpc: RPCBase, mapping):
+class Method:
+    cancels_queries = False  # сам прерывает свои запросы к БД в срок вызова (см. deadline)
+
+    def __init__(self, rpc: RPCBase, mapping, name: str = None, cache: float = None, reads=None, writes=None,
+                 limit: dict = None, single_flight: bool = False, timeout: float = None):
+        """
+        :param name: имя метода в АПИ
+        :param cache: кэшировать результат на столько секунд (см. ResultCache)
+        :param reads: таблицы, из которых читает метод. запись в них сбрасывает кэш метода
+        :param writes: таблицы, в которые пишет метод. после успешного вызова сбрасывается кэш читающих их методов
+        :param limit: ограничение одновременных вызовов, параметры Limiter: max_inflight, max_queue, queue_timeout.
+        результаты из кэша выдаются без ограничения
+        :param single_flight: одновременные вызовы с одинаковыми параметрами ждут один вызов и получают его
+        результат или ошибку (см. Flights). только для методов, которые читают. с cache не нужен - кэш делает то же
+        :param timeout: срок вызова в секундах, запрос может сократить его полем "timeout". запросы к БД
+        в срок прерываются, вызов получает ERR_TIMEOUT
+        """
         self.__rpc = rpc
         self.__map = mapping
+        self.__name = name
+        self.__cache = cache
+        self.__limiter = Limiter(name='Method %s' % name, **limit) if limit else None
+        self.__single_flight = single_flight
+        self.__timeout = timeout
+        metrics = getattr(rpc, 'metrics', None)
+        # счетчики метода (MethodStats), None - метрики выключены. атрибут, а не свойство: читается на каждом вызове
+        self.stats = metrics.method(name) if metrics is not None else None
+        self.__reads = tuple(sorted({table_name(x) for x in reads or ()}))
+        self.__writes = tuple(sorted({table_name(x) for x in writes or ()}))
         self._max_to = -1
         if isinstance(self.__map, dict):
             for n, x in enumerate(self.__map):
@@ -37,25 +89,92 @@ class Method:
                     if self._max_to >= 0:
                         raise ErrorRPC(ERR_PARSE, '+Bad map for ' + x)
                 self.__map[x] = param
+        self.__mapper = self.__compile()
+
+    def __compile(self):
+        """
+        План маппинга, собранный при регистрации метода: при вызове не нужно разбирать описание маппинга
+        """
+        mapping = self.__map
+        if mapping is None:
+            mapping = RPCBase.MAP_ARGS
+        if isinstance(mapping, int):
+            return lambda args, kwargs: mapping
+        elif callable(mapping):
+            return lambda args, kwargs: mapping(args[0])
+
+        slots = tuple((x, y['to'], y.get('default')) for x, y in mapping.items())
+        if self._max_to < 0:
+            return lambda args, kwargs: {to: kwargs.get(x, default) for x, to, default in slots}
+
+        size = self._max_to + 1
+        if sorted(x[1] for x in slots) == list(range(size)):
+            # номера параметров идут подряд - список собирается сразу в нужном порядке
+            slots = tuple(sorted(slots, key=lambda x: x[1]))
+            return lambda args, kwargs: [kwargs.get(x, default) for x, to, default in slots]
+
+        def mapper(args, kwargs):
+            ret = [None] * size
+            for x, to, default in slots:
+                ret[to] = kwargs.get(x, default)
+            return ret
+        return mapper
 
     def map(self, args, kwargs):
-        if isinstance(self.__map, int):
-            return self.__map
-        elif callable(self.__map):
-            return self.__map(args[0])
-        if self._max_to < 0:
-            args = {}
-        else:
-            args = [None] * (self._max_to + 1)
-        for x in self.__map:
-            f = self.__map[x]
-            args[self.__map[x]['to']] = kwargs.get(x, self.__map[x].get('default'))
-        return args
+        return self.__mapper(args, kwargs)
+
+    def params(self, args, kwargs):
+        # параметры вызова после маппинга, по ним строится ключ кэша
+        map = self.map(args, kwargs) if self.__map is not None else RPCBase.MAP_ARGS
+        if isinstance(map, int):
+            return [list(args), kwargs]
+        return map
+
+    async def acall(self, *args, **kwargs):
+        # блокирующий вызов уходит в пул потоков RPC
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(self.rpc.executor, functools.partial(ctx.run, self, *args, **kwargs))
 
     @property
     def mapping(self):
         return self.__map
 
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def cache(self) -> float:
+        return self.__cache
+
+    @property
+    def limiter(self) -> Limiter:
+        return self.__limiter
+
+    @property
+    def single_flight(self) -> bool:
+        return self.__single_flight
+
+    @property
+    def timeout(self) -> float:
+        return self.__timeout
+
+    @property
+    def reads(self) -> tuple:
+        return self.__reads
+
+    @property
+    def writes(self) -> tuple:
+        return self.__writes
+
+    def _tables(self, reads, writes):
+        # таблицы, определенные по тексту запросов, если они не заданы явно
+        if not self.__reads:
+            self.__reads = tuple(sorted(reads))
+        if not self.__writes:
+            self.__writes = tuple(sorted(writes))
+
     @property
     def rpc(self):
         return self.__rpc
@@ -63,29 +182,130 @@ class Method:
 
 class PythonMethod(Method):
 
-    def __init__(self, rpc: RPCBase, func, mapping):
-        Method.__init__(self, rpc, mapping)
+    def __init__(self, rpc: RPCBase, func, mapping, **options):
+        Method.__init__(self, rpc, mapping, **options)
         self.__func = func
+        self.__async = asyncio.iscoroutinefunction(func)
+        self.__invoke = self.__compile(func)
+        self.__prepare = self.__compile(lambda *args, **kwargs: (args, kwargs))
+
+    def __compile(self, func):
+        # вызов функции под вид маппинга выбирается при регистрации, а не перебором MAP_* на каждом вызове
+        mapping = self.mapping
+        if mapping is None or mapping == RPCBase.MAP_ARGS:
+            return lambda args, kwargs: func(*args, **kwargs)
+        elif mapping == RPCBase.MAP_JSON:
+            return lambda args, kwargs: func(args if args != () else kwargs)
+        elif mapping == RPCBase.MAP_JSON_ENV:
+            env = self.rpc.env
+            return lambda args, kwargs: func(args if args != () else kwargs, env)
+
+        map = self.map
+        if callable(mapping) and not isinstance(mapping, dict):
+            def invoke(args, kwargs):
+                x = map(args, kwargs)
+                return func(**x) if isinstance(x, dict) else func(*x)
+            return invoke
+        elif self._max_to < 0:
+            return lambda args, kwargs: func(**map(args, kwargs))
+        return lambda args, kwargs: func(*map(args, kwargs))
+
+    def __timed(self, stats, args, kwargs):
+        # то же, что __invoke, но время маппинга и функции пишется в метрики отдельно
+        t = clock()
+        args, kwargs = self.__prepare(args, kwargs)
+        m = clock()
+        try:
+            return self.__func(*args, **kwargs)
+        finally:
+            stats.timed(m - t, clock() - m)
+
+    async def __atimed(self, stats, args, kwargs):
+        t = clock()
+        args, kwargs = self.__prepare(args, kwargs)
+        m = clock()
+        try:
+            return await self.__func(*args, **kwargs)
+        finally:
+            stats.timed(m - t, clock() - m)
 
     def __call__(self, *args, **kwargs):
-        map = self.map(args, kwargs)
-        if map == RPCBase.MAP_ARGS:
-            return self.__func(*args, **kwargs)
-        elif map == RPCBase.MAP_JSON:
-            if args != ():
-                return self.__func(args)
-            else:
-                return self.__func(kwargs)
-        elif map == RPCBase.MAP_JSON_ENV:
-            if args != ():
-                return self.__func(args, self.rpc.env)
-            else:
-                return self.__func(kwargs, self.rpc.env)
-        else:
-            if isinstance(map, dict):
-                return self.__func(**map)
-            else:
-                return self.__func(*map)
+        stats = self.stats
+        if self.__async:
+            if stats is None or not stats.sampled_stages():
+                return asyncio.run(self.__invoke(args, kwargs))
+            return asyncio.run(self.__atimed(stats, args, kwargs))
+        if stats is None or not stats.sampled_stages():
+            return self.__invoke(args, kwargs)
+        return self.__timed(stats, args, kwargs)
+
+    async def acall(self, *args, **kwargs):
+        if self.__async:
+            stats = self.stats
+            if stats is None or not stats.sampled_stages():
+                return await self.__invoke(args, kwargs)
+            return await self.__atimed(stats, args, kwargs)
+        return await Method.acall(self, *args, **kwargs)
+
+
+class LazyMethod(Method):
+    """
+    Python функция, заданная строкой "пакет.модуль:функция". Модуль импортируется при первом вызове,
+    либо заранее через RPC.preload
+    """
+
+    def __init__(self, rpc: RPCBase, target: str, mapping, **options):
+        Method.__init__(self, rpc, mapping, **options)
+        self.__target = target
+        self.__options = options
+        self.__method = None
+        self.__lock = threading.Lock()
+
+    @property
+    def target(self) -> str:
+        return self.__target
+
+    @property
+    def loaded(self) -> bool:
+        return self.__method is not None
+
+    def load(self) -> PythonMethod:
+        # одновременные первые вызовы ждут один импорт
+        if self.__method is None:
+            with self.__lock:
+                if self.__method is None:
+                    # ограничение вызовов действует на этом методе, у загруженной функции его нет
+                    self.__method = PythonMethod(self.rpc, resolve(self.__target), self.mapping,
+                                                 **dict(self.__options, limit=None))
+        return self.__method
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    async def acall(self, *args, **kwargs):
+        method = self.__method
+        if method is None:
+            # импорт блокирующий, цикл событий его не ждет
+            method = await asyncio.get_running_loop().run_in_executor(self.rpc.executor, self.load)
+        return await method.acall(*args, **kwargs)
+
+
+def resolve(target: str):
+    """
+    Объект по строке "пакет.модуль:функция" или "пакет.модуль.функция"
+    """
+    module, sep, attr = target.partition(':')
+    if not sep:
+        module, sep, attr = target.rpartition('.')
+    try:
+        ret = importlib.import_module(module)
+        for x in attr.split('.'):
+            ret = getattr(ret, x)
+    except (ImportError, AttributeError, ValueError) as e:
+        raise ErrorRPC(ERR_SERVER, '+Cannot load %s: %s' % (target, e))
+    if not callable(ret):
+        raise ErrorRPC(ERR_SERVER, '+%s is not callable' % target)
+    return ret
 
 
 class nBaseSQL:
@@ -94,6 +314,7 @@ class nBaseSQL:
         self.__prev = prev_node
         self.__next = None
         self.__data = data
+        self.label = None  # имя узла в метриках: alias#N, sql#N
 
     def add_next(self, cls, data=None):
         if cls in nBaseSQL.__subclasses__():
@@ -112,8 +333,19 @@ class nBaseSQL:
     def run(self, sql_method, local_env):
         pass
 
+    async def arun(self, sql_method, local_env):
+        return self.run(sql_method, local_env)
+
     def __call__(self, sql_method, local_env):
-        x = self.run(sql_method, local_env)
+        stats = local_env.get('stats')
+        if stats is None:
+            x = self.run(sql_method, local_env)
+        else:
+            t = clock()
+            try:
+                x = self.run(sql_method, local_env)
+            finally:
+                stats.observe(self.label, clock() - t)
         if isinstance(x, nBaseSQL):
             return x(sql_method, local_env)
         elif self.next:
@@ -123,6 +355,25 @@ class nBaseSQL:
             local_env['result'] = x
             return x
 
+    async def acall(self, sql_method, local_env):
+        stats = local_env.get('stats')
+        if stats is None:
+            x = await self.arun(sql_method, local_env)
+        else:
+            t = clock()
+            try:
+                x = await self.arun(sql_method, local_env)
+            finally:
+                stats.observe(self.label, clock() - t)
+        if isinstance(x, nBaseSQL):
+            return await x.acall(sql_method, local_env)
+        elif self.next:
+            local_env['result'] = x
+            return await self.next.acall(sql_method, local_env)
+        else:
+            local_env['result'] = x
+            return x
+
 
 class nAlias(nBaseSQL):
 
@@ -130,9 +381,17 @@ class nAlias(nBaseSQL):
         aliases = local_env.get('aliases', {})
         alias = aliases.get(self.data)
         if not alias:
-            alias = sql_method.rpc.env.connect(self.data)
+            alias = sql_method.rpc.env.connect(self.data, local_env['readonly'])
+            aliases[self.data] = alias
+        local_env['alias'] = alias
+
+    async def arun(self, sql_method, local_env):
+        aliases = local_env.get('aliases', {})
+        alias = aliases.get(self.data)
+        if not alias:
+            alias = await sql_method.rpc.env.aconnect(self.data, sql_method.rpc.executor, local_env['readonly'])
             aliases[self.data] = alias
-            local_env['alias'] = alias
+        local_env['alias'] = alias
 
 
 class nSQL(nBaseSQL):
@@ -142,32 +401,178 @@ class nSQL(nBaseSQL):
         if data.startswith('*'):
             data = 'select * from ' + data[1:]
         nBaseSQL.__init__(self, prev_node, data)
+        self.__statement = Statement(data)
+
+    @property
+    def statement(self) -> Statement:
+        return self.__statement
+
+    def __format(self, local_env):
+        # формат задается только для результата метода, промежуточные выборки остаются списками словарей
+        return local_env.get('format', 'dicts') if self.next is None else 'dicts'
 
     def run(self, sql_method, local_env):
-        alias = local_env.get('alias', local_env['aliases'].get(None))
+        alias = local_env.get('alias') or local_env['aliases'].get(sql_method.alias)
         if not alias:
-            alias = sql_method.rpc.env.connect(self.data)
-            local_env['aliases'][None] = alias
+            alias = sql_method.rpc.env.connect(sql_method.alias, local_env['readonly'])
+            local_env['aliases'][sql_method.alias] = alias
         args = local_env.get('args',())
         kwargs = local_env.get('kwargs', {})
-        d, f = alias.sql(self.data, *args, **kwargs)
-        ret = []
-        if f:
-            for x in d:
-                rec = {f[n]['name']: v for n, v in enumerate(x)}
-                ret.append(rec)
-        else:
-            ret = d
+        if local_env.get('bulk'):
+            return alias.dml_many(self.__statement, self.records(args, kwargs), on_error=local_env['bulk'])
+        if local_env.get('stream') and self.next is None:
+            return self.stream_rows(*alias.stream(self.__statement, *args, **kwargs))
+        return self.rows(*alias.sql(self.__statement, *args, **kwargs), self.__format(local_env))
+
+    async def arun(self, sql_method, local_env):
+        alias = local_env.get('alias') or local_env['aliases'].get(sql_method.alias)
+        if not alias:
+            alias = await sql_method.rpc.env.aconnect(sql_method.alias, sql_method.rpc.executor,
+                                                      local_env['readonly'])
+            local_env['aliases'][sql_method.alias] = alias
+        args = local_env.get('args',())
+        kwargs = local_env.get('kwargs', {})
+        if local_env.get('bulk'):
+            return await alias.dml_many(self.__statement, self.records(args, kwargs), on_error=local_env['bulk'])
+        if local_env.get('stream') and self.next is None:
+            return self.astream_rows(*await alias.stream(self.__statement, *args, **kwargs))
+        return self.rows(*await alias.sql(self.__statement, *args, **kwargs), self.__format(local_env))
+
+    @staticmethod
+    def records(args, kwargs):
+        # строки bulk метода: params - массив записей, либо {"rows": [...]}
+        ret = args if args != () else kwargs.get('rows', ())
+        if not isinstance(ret, (list, tuple)) or not all(isinstance(x, (dict, list, tuple)) for x in ret):
+            raise ErrorRPC(ERR_BAD_PARAMS, '+Bulk method expects an array of records')
         return ret
 
+    @staticmethod
+    def rows(d, f, format: str = 'dicts'):
+        if f and format != 'dicts':
+            return columnar(d, f, format == 'arrays')
+        return make_rows(d, f) if f else d
 
-class SQLMethod(Method):
+    @staticmethod
+    def stream_rows(d, f):
+        if not f:
+            yield from d
+            return
+        yield from map(row_factory(f), d)
 
-    def __init__(self, rpc: RPCBase, query, alias, mapping, postproc=None):
-        Method.__init__(self, rpc, mapping)
+    @staticmethod
+    async def astream_rows(d, f):
+        make = row_factory(f) if f else None
+        async for x in d:
+            yield make(x) if make else x
+
+
+class nParallel(nBaseSQL):
+    """
+    Секция @@parallel ... @@end: блоки @@alias внутри нее выполняются одновременно, каждый на своем соединении.
+    Результат - словарь алиас -> результат последнего запроса блока
+    """
+
+    def __init__(self, prev_node, data=None):
+        nBaseSQL.__init__(self, prev_node, {})  # алиас -> первый узел блока
+        self.__last = None
+
+    def add_branch(self, alias):
+        if alias in self.data:
+            raise ErrorRPC(ERR_PARSE, '+Duplicate alias %s in @@parallel' % alias)
+        self.__last = self.data[alias] = nAlias(None, alias)
+
+    def add(self, cls, data=None):
+        if self.__last is None:
+            raise ErrorRPC(ERR_PARSE, '+Query without alias in @@parallel')
+        self.__last = self.__last.add_next(cls, data)
+
+    def __branches(self, local_env):
+        # у каждого блока свои соединения и свой result. в общей транзакции соединения берутся из нее:
+        # алиасы блоков разные, так что блоки не делят одно соединение
+        format = local_env.get('format', 'dicts') if self.next is None else 'dicts'
+        shared = local_env.get('transaction') is not None
+        return [(name, node, dict(local_env, alias=None, aliases=local_env['aliases'] if shared else {},
+                                  result=None, stream=False, format=format))
+                for name, node in self.data.items()]
+
+    def __join(self, local_env, branches):
+        # соединения блоков фиксируются и откатываются вместе с остальными соединениями метода
+        if local_env.get('transaction') is not None:
+            return
+        for name, node, env in branches:
+            for key, alias in env['aliases'].items():
+                local_env['aliases'][(self.label, name, key)] = alias
+
+    def run(self, sql_method, local_env):
+        branches = self.__branches(local_env)
+        if not branches:
+            return {}
+        executor = sql_method.rpc.fanout
+        futures = [executor.submit(contextvars.copy_context().run, node, sql_method, env)
+                   for name, node, env in branches[1:]]
+        ret, error = [], None
+        try:
+            ret.append(branches[0][1](sql_method, branches[0][2]))
+        except Exception as e:
+            error = e
+        for f in futures:
+            try:
+                ret.append(f.result())
+            except Exception as e:
+                error = error or e
+        self.__join(local_env, branches)
+        if error is not None:
+            raise error
+        return {x[0]: y for x, y in zip(branches, ret)}
+
+    async def arun(self, sql_method, local_env):
+        branches = self.__branches(local_env)
+        ret = await asyncio.gather(*(node.acall(sql_method, env) for name, node, env in branches),
+                                   return_exceptions=True)
+        self.__join(local_env, branches)
+        for x in ret:
+            if isinstance(x, Exception):
+                raise x
+        return {x[0]: y for x, y in zip(branches, ret)}
+
+
+class SQLMethod(Method):
+    cancels_queries = True
+
+    def __init__(self, rpc: RPCBase, query, alias, mapping, postproc=None, stream=False, format: str = None,
+                 bulk: bool = False, on_error: str = 'raise', readonly: bool = None, **options):
+        """
+        :param stream: вернуть результат последнего запроса итератором строк (ResultStream), не вычитывая
+        выборку целиком. Транзакции фиксируются, когда строки закончатся
+        :param format: формат результата (db.FORMATS): dicts - список словарей, rows и arrays - см. db.columnar.
+        запрос может переопределить его полем "format"
+        :param bulk: params метода - массив записей, каждый запрос скрипта выполняется для всех записей
+        через dml_many. результат - отчет dml_many последнего запроса
+        :param on_error: для bulk: raise - ошибка откатывает все, skip - откатывается только порция с ошибкой
+        :param readonly: метод только читает, и для групп реплик (BaseEnv.set_db_group) идет в реплики.
+        по умолчанию определяется по тексту запросов, False - всегда в основной алиас
+        :param options: параметры Method. reads и writes, если не заданы, определяются по тексту запросов
+
+        Блоки разных алиасов, не зависящие друг от друга, можно выполнить одновременно:
+            @@parallel
+            @@db1
+            select ...
+            @@db2
+            select ...
+            @@end
+        результат секции - {"db1": [...], "db2": [...]} (см. nParallel)
+        """
+        Method.__init__(self, rpc, mapping, **options)
+        self.__alias = alias
+        self.__stream = stream
+        self.__format = check_format(format or 'dicts')
+        self.__bulk = check_on_error(on_error) if bulk else None
         pool = {}
 
         def newnode(pool, cls, data=None):
+            if 'parallel' in pool:
+                pool['parallel'].add(cls, data)
+                return
             last = pool.get('last')
             if last:
                 last = last.add_next(cls, data)
@@ -178,76 +583,140 @@ class SQLMethod(Method):
             pool['last'] = last
 
         def addnode(pool, cmd):
-            cmd = cmd[1:]
-            newnode(pool, nAlias,cmd)
-            return True # не ждем @@
+            if cmd.strip() == 'parallel':
+                if 'parallel' in pool:
+                    raise ErrorRPC(ERR_PARSE, '+Nested @@parallel')
+                newnode(pool, nParallel)
+                pool['parallel'] = pool['last']
+            elif cmd.strip() == 'end' and 'parallel' in pool:
+                del pool['parallel']
+            elif 'parallel' in pool:
+                pool['parallel'].add_branch(cmd)
+            else:
+                newnode(pool, nAlias,cmd)
 
         def addquery(pool, qry):
             qry = qry.strip()
             if qry.strip() == '': return
             newnode(pool, nSQL, qry)
 
-        ###################################################
-        txt, wait, nextn, newline, ext = '', '', -1, True, ''
-        query += '\n'
-        for n, x in enumerate(query):
-            if n == len(query) - 1: break
-            if n == nextn: continue
-            if wait != '':
-                if wait == "'":
-                    txt += x
-                    if x == wait: wait = ''
-                elif wait == "\n":
-                    if x == wait:
-                        wait = ''
-                        newline = True
-                        if ext:
-                            if addnode(pool, ext):
-                                ext = ''
-                            else:
-                                wait = '@@'
-                    elif ext != '':
-                        ext += x
-                    continue
-                elif wait == '*/' and x == '/' and query[n - 1] == '*':
-                    wait = ''
+        for kind, data in script.compile(query, rpc.script_cache):
+            if kind == '@':
+                addnode(pool, data)
             else:
-                if newline and x == '@' and query[n + 1] == '@':
-                    nextn = n + 1
-                    wait = '\n'
-                    ext = '@'
-                    if txt:
-                        addquery(pool, txt)
-                        txt = ''
-                elif x == '/' and query[n + 1] == '*':
-                    nextn = n + 1
-                    wait = '*/'
-                elif x == '-' and query[n + 1] == '-':
-                    nextn = n + 1
-                    wait = '\n'
-                elif x in ('\t', '\f', ' ') and newline:
-                    continue
-                else:
-                    newline = x == '\n'
-                    txt += x
-                    continue
-        if ext:
-            addnode(pool, ext)
-        elif txt:
-            addquery(pool, txt)
+                addquery(pool, data)
         self.__nodes = pool.get('nodes')
 
-    def __call__(self, *args, **kwargs):
-        local_env = {
+        reads, writes, selects = set(), set(), True
+        for node in self.__walk(self.__nodes, ''):
+            if isinstance(node, nSQL):
+                reads |= tables(node.data, READS)
+                writes |= tables(node.data, WRITES)
+                selects = selects and is_readonly(node.data)
+        self._tables(reads - writes, writes)
+        if readonly is None:
+            readonly = selects and not self.writes and not bulk
+        self.__readonly = readonly
+
+    @classmethod
+    def __walk(cls, node, prefix):
+        # все узлы скрипта, включая блоки @@parallel. заодно узлам даются имена для метрик
+        n = 0
+        while node:
+            kind = 'sql' if isinstance(node, nSQL) else 'parallel' if isinstance(node, nParallel) else 'alias'
+            node.label = '%s%s#%d' % (prefix, kind, n)
+            yield node
+            if isinstance(node, nParallel):
+                for name, x in node.data.items():
+                    yield from cls.__walk(x, '%s/%s/' % (node.label, name))
+            node = node.next
+            n += 1
+
+    def __local_env(self, args, kwargs):
+        tx = transaction.current.get()
+        if tx is not None:
+            tx.check()
+        return {
+            'stats': self.stats,
+            'transaction': tx,
             'alias': None,
-            'aliases': {},
+            'aliases': tx.aliases if tx is not None else {},
             'result': None,
             'args': args,
-            'kwargs': kwargs
+            'kwargs': kwargs,
+            'stream': self.__stream and tx is None,
+            'readonly': self.__readonly and tx is None,
+            'bulk': self.__bulk,
+            'format': check_format(call_options.get().get('format') or self.__format)
         }
-        ret = self.__nodes(self, local_env)
 
-        for x in local_env['aliases']:
-            local_env['aliases'][x].commit()
+    def __call__(self, *args, **kwargs):
+        local_env = self.__local_env(args, kwargs)
+        try:
+            ret = self.__nodes(self, local_env)
+        except Exception as e:
+            # соединения надо вернуть в пул и при ошибке
+            self.__finish(local_env, e)
+            raise e
+
+        if local_env['stream']:
+            return ResultStream(ret, lambda error: self.__finish(local_env, error))
+        self.__finish(local_env, None)
+        return ret
+
+    def __finish(self, local_env, error):
+        aliases, stats, tx = local_env['aliases'], local_env['stats'], local_env['transaction']
+        if tx is not None:
+            # фиксирует область транзакции, ошибка откатит ее целиком
+            if error is not None:
+                tx.fail(error)
+                raise error
+            return
+        if stats is None:
+            return transaction.close(aliases, error)
+        t = clock()
+        try:
+            transaction.close(aliases, error)
+        finally:
+            stats.observe('commit', clock() - t)
+
+    async def acall(self, *args, **kwargs):
+        local_env = self.__local_env(args, kwargs)
+        try:
+            ret = await self.__nodes.acall(self, local_env)
+        except BaseException as e:
+            # и при отмене задачи: соединения вернутся в пул
+            await self.__afinish(local_env, e)
+            raise e
+
+        if local_env['stream']:
+            return AsyncResultStream(ret, lambda error: self.__afinish(local_env, error))
+        await self.__afinish(local_env, None)
+        return ret
+
+    async def __afinish(self, local_env, error):
+        aliases, stats, tx = local_env['aliases'], local_env['stats'], local_env['transaction']
+        if tx is not None:
+            if error is not None:
+                tx.fail(error)
+                raise error
+            return
+        if stats is None:
+            return await transaction.aclose(aliases, error)
+        t = clock()
+        try:
+            await transaction.aclose(aliases, error)
+        finally:
+            stats.observe('commit', clock() - t)
 
-        return ret
\ No newline at end of file
+    @property
+    def stream(self) -> bool:
+        return self.__stream
+
+    @property
+    def readonly(self) -> bool:
+        return self.__readonly
+
+    @property
+    def alias(self):
+        return self.__alias
\ No newline at end of file
@@ -0,0 +1,222 @@
+import threading, time, bisect, itertools
+from collections import deque
+
+# границы корзин гистограмм задержек, в секундах
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# сколько замеров метода копится до разноски по гистограммам
+FOLD_AFTER = 1024
+
+# время вызова (call) и этапы python метода (mapping, function) замеряются у каждого SAMPLE-го вызова
+SAMPLE = 16
+
+clock = time.perf_counter
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # последняя корзина - больше BUCKETS[-1]
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def add(self, values: list):
+        # пачка замеров: сортировка и поиск границ корзин вместо bisect на каждый замер
+        values.sort()
+        prev = 0
+        for i, edge in enumerate(BUCKETS):
+            n = bisect.bisect_right(values, edge, prev)
+            self.counts[i] += n - prev
+            prev = n
+        self.counts[-1] += len(values) - prev
+        self.count += len(values)
+        self.sum += sum(values)
+
+    def quantile(self, q: float) -> float:
+        # верхняя граница корзины, в которую попадает квантиль
+        if self.count == 0:
+            return 0.0
+        edge, n = q * self.count, 0
+        for i, x in enumerate(self.counts):
+            n += x
+            if n >= edge:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+def sampler():
+    # True у первого и далее у каждого SAMPLE-го вызова, next у cycle атомарен
+    return itertools.cycle((True,) + (False,) * (SAMPLE - 1)).__next__
+
+
+class MethodStats:
+    """
+    Счетчики одного метода: вызовы, ошибки по кодам ERR_*, гистограммы времени по этапам вызова.
+    Вызовы считаются на каждом вызове (count - next у itertools.count, без блокировки), время вызова и этапов
+    python метода - выборочно (sampled, sampled_stages). Замеры без блокировки складываются в очереди этапов
+    (append в deque атомарен) и разносятся по гистограммам пачкой - при чтении счетчиков или когда замеров этапа
+    больше FOLD_AFTER. Методы держат ссылку на свои счетчики (Method.stats), поэтому Metrics.reset обнуляет их
+    на месте
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pending = {}  # этап -> deque секунд
+        self.__counter = itertools.count()
+        self.__reads = 0  # значений counter, взятых при чтении, а не вызовами
+        self.count = self.__counter.__next__
+        self.sampled = sampler()
+        self.sampled_stages = sampler()
+        self.calls = 0
+        self.errors = {}
+        self.stages = {}
+
+    def __queue(self, stage: str) -> deque:
+        q = self.__pending.get(stage)
+        if q is None:
+            q = self.__pending.setdefault(stage, deque())
+        return q
+
+    def observe(self, stage: str, seconds: float):
+        q = self.__pending.get(stage) or self.__queue(stage)
+        q.append(seconds)
+        if len(q) > FOLD_AFTER:
+            self.fold()
+
+    def timed(self, mapping: float, function: float):
+        # этапы python метода, разносятся вместе с call
+        (self.__pending.get('mapping') or self.__queue('mapping')).append(mapping)
+        (self.__pending.get('function') or self.__queue('function')).append(function)
+
+    def fold(self):
+        """
+        Разнести накопленные замеры по гистограммам
+        """
+        with self.__lock:
+            for stage, q in list(self.__pending.items()):
+                if not q:
+                    continue
+                pop = q.popleft
+                values = [pop() for _ in range(len(q))]
+                h = self.stages.get(stage)
+                if h is None:
+                    h = self.stages[stage] = Histogram()
+                h.add(values)
+            # next у counter дает число вызовов count и прошлых чтений
+            self.calls = self.__counter.__next__() - self.__reads
+            self.__reads += 1
+
+    def error(self, code: int):
+        with self.__lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+
+    def reset(self):
+        with self.__lock:
+            for x in self.__pending.values():
+                x.clear()
+            self.__counter = itertools.count()
+            self.__reads = 0
+            self.count = self.__counter.__next__
+            self.calls = 0
+            self.errors = {}
+            self.stages = {}
+
+    def state(self):
+        # согласованная копия счетчиков для экспорта
+        self.fold()
+        with self.__lock:
+            return self.calls, dict(self.errors), {x: (list(y.counts), y.sum, y.count) for x, y in self.stages.items()}
+
+    def snapshot(self) -> dict:
+        self.fold()
+        with self.__lock:
+            return {
+                "calls": self.calls,
+                "errors": {str(x): y for x, y in self.errors.items()},
+                "stages": {x: y.snapshot() for x, y in self.stages.items()},
+            }
+
+
+class Metrics:
+    """
+    Метрики RPC по методам. Этапы вызова:
+    parse - разбор запроса (метод ""), call - весь вызов, mapping - маппинг параметров,
+    function - время python функции (call, mapping и function - выборочно, см. SAMPLE),
+    alias#N/sql#N - узлы SQL скрипта, commit - фиксация транзакций
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__methods = {}
+
+    def method(self, name: str) -> MethodStats:
+        x = self.__methods.get(name)
+        if x is None:
+            with self.__lock:
+                x = self.__methods.get(name)
+                if x is None:
+                    x = self.__methods[name] = MethodStats()
+        return x
+
+    def observe(self, name: str, stage: str, seconds: float):
+        self.method(name).observe(stage, seconds)
+
+    def error(self, name: str, code: int):
+        self.method(name).error(code)
+
+    def snapshot(self) -> dict:
+        return {x: y.snapshot() for x, y in list(self.__methods.items())}
+
+    def reset(self):
+        for x in list(self.__methods.values()):
+            x.reset()
+
+    def prometheus(self, prefix: str = 'smartrpc') -> str:
+        """
+        Метрики в текстовом формате Prometheus
+        """
+        calls, errors, stages = [], [], []
+        for name, stats in sorted(list(self.__methods.items())):
+            m = escape(name)
+            n_calls, n_errors, n_stages = stats.state()
+            calls.append('%s_calls_total{method="%s"} %d' % (prefix, m, n_calls))
+            for code, n in sorted(n_errors.items()):
+                errors.append('%s_errors_total{method="%s",code="%s"} %d' % (prefix, m, code, n))
+            for stage, (counts, total, count) in sorted(n_stages.items()):
+                labels = 'method="%s",stage="%s"' % (m, escape(stage))
+                n = 0
+                for i, x in enumerate(counts):
+                    n += x
+                    le = repr(BUCKETS[i]) if i < len(BUCKETS) else '+Inf'
+                    stages.append('%s_seconds_bucket{%s,le="%s"} %d' % (prefix, labels, le, n))
+                stages.append('%s_seconds_sum{%s} %r' % (prefix, labels, total))
+                stages.append('%s_seconds_count{%s} %d' % (prefix, labels, count))
+        ret = [
+            '# HELP %s_calls_total RPC method calls' % prefix,
+            '# TYPE %s_calls_total counter' % prefix,
+        ] + calls + [
+            '# HELP %s_errors_total RPC errors by JSON-RPC error code' % prefix,
+            '# TYPE %s_errors_total counter' % prefix,
+        ] + errors + [
+            '# HELP %s_seconds Time spent in RPC call stages' % prefix,
+            '# TYPE %s_seconds histogram' % prefix,
+        ] + stages
+        return '\n'.join(ret) + '\n'
+
+
+def escape(x: str) -> str:
+    return x.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
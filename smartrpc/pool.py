@@ -0,0 +1,176 @@
+import threading, time, weakref, os
+from collections import deque
+from .err import *
+
+POOLS = weakref.WeakSet()
+
+
+class ConnectionPool:
+    """
+    Пул соединений для одного алиаса БД.
+    Соединения создает, проверяет и закрывает адаптер, пул только хранит их и раздает потокам
+    """
+
+    def __init__(self, adapter, min_size: int = 0, max_size: int = 10, idle_timeout: float = 300.0,
+                 check_after: float = 1.0, wait_timeout: float = 30.0, max_waiting: int = 100):
+        """
+        :param adapter: DBAdapter, через который открываются, проверяются и закрываются соединения
+        :param min_size: сколько соединений держать открытыми даже после idle_timeout
+        :param max_size: максимальное число открытых соединений
+        :param idle_timeout: через сколько секунд простоя закрывать лишнее соединение
+        :param check_after: проверять соединение при выдаче, если оно простаивало дольше стольких секунд
+        :param wait_timeout: сколько ждать свободного соединения, когда открыто max_size
+        :param max_waiting: максимальная длина очереди ожидающих соединение
+        """
+        if max_size < 1 or min_size > max_size:
+            raise ErrorRPC(ERR_SERVER, '+Bad pool size %s..%s' % (min_size, max_size))
+        self.__adapter = adapter
+        self.__min = min_size
+        self.__max = max_size
+        self.__idle_timeout = idle_timeout
+        self.__check_after = check_after
+        self.__wait_timeout = wait_timeout
+        self.__max_waiting = max_waiting
+        self.__cond = threading.Condition(threading.Lock())
+        self.__idle = deque()  # (соединение, время возврата в пул)
+        self.__size = 0
+        self.__waiting = 0
+        self.__inherited = []
+        POOLS.add(self)
+
+    def __expired(self):
+        # вызывается под блокировкой. старые соединения лежат в начале очереди
+        ret = []
+        if self.__idle_timeout is None:
+            return ret
+        edge = time.monotonic() - self.__idle_timeout
+        while self.__idle and self.__size > self.__min and self.__idle[0][1] < edge:
+            ret.append(self.__idle.popleft()[0])
+            self.__size -= 1
+        return ret
+
+    def __close(self, conns):
+        for x in conns:
+            try:
+                self.__adapter.close_connection(x)
+            except Exception:
+                pass
+
+    def acquire(self, timeout: float = None):
+        if timeout is None:
+            timeout = self.__wait_timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            conn, new = None, False
+            with self.__cond:
+                expired = self.__expired()
+                while not self.__idle and self.__size >= self.__max:
+                    if self.__waiting >= self.__max_waiting:
+                        self.__close(expired)
+                        raise ErrorRPC(ERR_BUSY, '+Pool queue is full')
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        self.__close(expired)
+                        raise ErrorRPC(ERR_BUSY, '+Pool timeout')
+                    self.__waiting += 1
+                    try:
+                        self.__cond.wait(left)
+                    finally:
+                        self.__waiting -= 1
+                if self.__idle:
+                    conn, released = self.__idle.pop()
+                else:
+                    self.__size += 1
+                    new = True
+            self.__close(expired)
+
+            if new:
+                try:
+                    return self.__adapter.open_connection()
+                except Exception:
+                    self.__discarded()
+                    raise
+
+            if time.monotonic() - released < self.__check_after:
+                return conn
+            try:
+                if self.__adapter.check_connection(conn):
+                    return conn
+            except Exception:
+                pass
+            self.release(conn, True)
+
+    def __discarded(self):
+        with self.__cond:
+            self.__size -= 1
+            self.__cond.notify()
+
+    def release(self, conn, discard: bool = False):
+        if discard:
+            self.__close((conn,))
+            self.__discarded()
+            return
+        with self.__cond:
+            self.__idle.append((conn, time.monotonic()))
+            expired = self.__expired()
+            self.__cond.notify()
+        self.__close(expired)
+
+    def fill(self):
+        """
+        Открыть соединения до min_size
+        """
+        while True:
+            with self.__cond:
+                if self.__size >= self.__min:
+                    return
+                self.__size += 1
+            try:
+                conn = self.__adapter.open_connection()
+            except Exception:
+                self.__discarded()
+                raise
+            self.release(conn)
+
+    def close(self):
+        """
+        Закрыть все свободные соединения
+        """
+        with self.__cond:
+            conns = [x[0] for x in self.__idle]
+            self.__idle.clear()
+            self.__size -= len(conns)
+            self.__cond.notify_all()
+        self.__close(conns)
+
+    def forget(self):
+        """
+        Забыть соединения без закрытия - в процессе, созданном fork. Закрытие (например, Terminate у PostgreSQL)
+        ушло бы по общему с родителем сокету, поэтому объекты соединений просто остаются жить
+        """
+        self.__inherited.extend(x[0] for x in self.__idle)
+        self.__cond = threading.Condition(threading.Lock())
+        self.__idle = deque()
+        self.__size = 0
+        self.__waiting = 0
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    @property
+    def idle(self) -> int:
+        return len(self.__idle)
+
+    @property
+    def waiting(self) -> int:
+        return self.__waiting
+
+
+def after_fork():
+    for x in list(POOLS):
+        x.forget()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=after_fork)
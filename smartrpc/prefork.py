@@ -0,0 +1,168 @@
+import os, gc, time, signal, threading, traceback
+from .rpc import RPC
+from .transport import HTTPServer, WSGIApp
+
+
+class PreforkServer:
+    """
+    Несколько процессов-воркеров с общим слушающим сокетом - по процессу на ядро.
+    Родитель до fork импортирует функции методов (RPC.preload) и замораживает сборщик мусора, чтобы память
+    с методами оставалась общей (copy-on-write). Соединения с БД открываются в воркерах: пулы, унаследованные
+    от родителя, в воркере очищаются без закрытия соединений (см. ConnectionPool.forget).
+    Упавший воркер перезапускается. SIGHUP - поочередный перезапуск воркеров, SIGTERM и SIGINT - остановка,
+    воркеры при этом дожидаются выполняющихся запросов и закрывают простаивающие keep-alive соединения
+    """
+
+    def __init__(self, rpc_or_app, host: str = '127.0.0.1', port: int = 8000, workers: int = None,
+                 graceful_timeout: float = 30.0, **options):
+        """
+        :param rpc_or_app: RPC (тогда options - параметры WSGIApp), либо WSGI приложение
+        :param workers: число процессов, по умолчанию по числу ядер
+        :param graceful_timeout: сколько воркер ждет выполняющиеся запросы при остановке
+        """
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('PreforkServer needs os.fork')
+        self.app = WSGIApp(rpc_or_app, **options) if isinstance(rpc_or_app, RPC) else rpc_or_app
+        self.workers = workers or os.cpu_count() or 1
+        self.graceful_timeout = graceful_timeout
+        # сокет открывается до fork и общий у всех воркеров
+        self.__server = HTTPServer((host, port), self.app)
+        self.__children = {}  # pid -> время запуска
+        self.__stopping = False
+        self.__reload = False
+        self.__backoff = 0.0
+
+    @property
+    def address(self):
+        return self.__server.server_address
+
+    @property
+    def children(self) -> list:
+        return list(self.__children)
+
+    def run(self):
+        rpc = getattr(self.app, 'rpc', None)
+        if rpc is not None:
+            rpc.preload()
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        signal.signal(signal.SIGTERM, self.__stop)
+        signal.signal(signal.SIGINT, self.__stop)
+        signal.signal(signal.SIGHUP, self.__restart)
+        try:
+            while not self.__stopping:
+                self.__reap()
+                if self.__reload:
+                    self.__reload = False
+                    self.__rolling()
+                while len(self.__children) < self.workers and not self.__stopping:
+                    if time.monotonic() < self.__backoff:
+                        break
+                    self.__spawn()
+                time.sleep(0.1)
+        finally:
+            self.__shutdown()
+            self.__server.server_close()
+
+    def stop(self):
+        self.__stopping = True
+
+    def restart(self):
+        self.__reload = True
+
+    def __stop(self, signum, frame):
+        self.__stopping = True
+
+    def __restart(self, signum, frame):
+        self.__reload = True
+
+    def __spawn(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.__worker()
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        self.__children[pid] = time.monotonic()
+        return pid
+
+    def __reap(self):
+        while self.__children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.__children.clear()
+                return
+            if pid == 0:
+                return
+            started = self.__children.pop(pid, None)
+            if started is not None and time.monotonic() - started < 1.0 and not self.__stopping:
+                # воркер падает сразу после запуска - не перезапускать его в цикле без паузы
+                self.__backoff = time.monotonic() + 1.0
+
+    def __wait(self, pids, timeout: float):
+        deadline = time.monotonic() + timeout
+        while any(x in self.__children for x in pids) and time.monotonic() < deadline:
+            time.sleep(0.05)
+            self.__reap()
+        for x in pids:
+            if x in self.__children:
+                try:
+                    os.kill(x, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        while any(x in self.__children for x in pids):
+            time.sleep(0.01)
+            self.__reap()
+
+    def __rolling(self):
+        # новый воркер запускается до остановки старого, так что принимающих запросы процессов не становится меньше
+        for pid in list(self.__children):
+            if self.__stopping:
+                return
+            self.__spawn()
+            self.__signal(pid, signal.SIGTERM)
+            self.__wait([pid], self.graceful_timeout + 1.0)
+
+    def __shutdown(self):
+        pids = list(self.__children)
+        for x in pids:
+            self.__signal(x, signal.SIGTERM)
+        self.__wait(pids, self.graceful_timeout + 1.0)
+
+    @staticmethod
+    def __signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def __worker(self):
+        server = self.__server
+
+        def stopping():
+            # ответы сразу идут с Connection: close, простаивающие соединения закрываются
+            server.close_idle()
+            server.shutdown()
+
+        def stop(signum, frame):
+            # shutdown ждет выхода из serve_forever, а он - в этом же потоке
+            threading.Thread(target=stopping, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server.serve_forever(poll_interval=0.5)
+        deadline = time.monotonic() + self.graceful_timeout
+        while server.active > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+
+def serve_prefork(rpc_or_app, host: str = '127.0.0.1', port: int = 8000, workers: int = None, **options):
+    PreforkServer(rpc_or_app, host, port, workers, **options).run()
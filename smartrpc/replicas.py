@@ -0,0 +1,99 @@
+import threading, time, re
+from .err import *
+
+BALANCE = ('round_robin', 'least_outstanding')
+
+# запрос только читает, если это выборка без блокировок строк, последовательностей и select into
+SELECT = re.compile(r'\s*(?:select|with|values|table|show|explain)\b', re.I)
+WRITE_HINTS = re.compile(r'\b(?:for\s+(?:no\s+key\s+)?update|for\s+(?:key\s+)?share|into|nextval|setval|lastval'
+                         r'|insert|update|delete|merge|truncate|create|drop|alter|grant|call|do|lock)\b', re.I)
+
+
+def readonly(query: str) -> bool:
+    return SELECT.match(query) is not None and WRITE_HINTS.search(query) is None
+
+
+class Member:
+    """
+    Алиас в группе реплик: число выданных соединений и отказы при соединении
+    """
+
+    def __init__(self, group, alias: str, primary: bool = False):
+        self.group = group
+        self.alias = alias
+        self.primary = primary
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def acquired(self):
+        with self.group.lock:
+            self.outstanding += 1
+            self.failures = 0
+            self.ejected_until = 0.0
+
+    def released(self):
+        with self.group.lock:
+            self.outstanding -= 1
+
+    def failed(self):
+        with self.group.lock:
+            self.failures += 1
+            if self.failures >= self.group.max_failures and not self.primary:
+                self.ejected_until = time.monotonic() + self.group.retry_after
+
+    def healthy(self, now: float = None) -> bool:
+        return self.ejected_until <= (time.monotonic() if now is None else now)
+
+    def state(self) -> dict:
+        return {
+            "alias": self.alias,
+            "outstanding": self.outstanding,
+            "failures": self.failures,
+            "healthy": self.healthy()
+        }
+
+
+class ReplicaGroup:
+    """
+    Алиас из основного алиаса и реплик. Запись - всегда в основной, чтение - в реплики: по кругу (round_robin)
+    или в ту, где меньше выданных соединений (least_outstanding). Реплика, к которой max_failures раз подряд
+    не удалось соединиться, исключается на retry_after секунд, после этого к ней снова пробуют соединиться.
+    Если исправных реплик нет, чтение идет в основной алиас. Чтение с реплики, к которой не удалось соединиться,
+    один раз повторяется на следующей исправной реплике или на основном алиасе (BaseEnv.connect)
+    """
+
+    def __init__(self, primary: str, replicas: list, balance: str = 'round_robin', max_failures: int = 1,
+                 retry_after: float = 30.0):
+        if balance not in BALANCE:
+            raise ErrorRPC(ERR_SERVER, '+Bad balance %s, expected one of %s' % (balance, ', '.join(BALANCE)))
+        self.lock = threading.Lock()
+        self.balance = balance
+        self.max_failures = max(max_failures, 1)
+        self.retry_after = retry_after
+        self.primary = Member(self, primary, True)
+        self.replicas = [Member(self, x) for x in replicas]
+        self.__next = 0
+
+    def choose(self, readonly: bool = False) -> Member:
+        if not readonly or not self.replicas:
+            return self.primary
+        now = time.monotonic()
+        with self.lock:
+            healthy = [x for x in self.replicas if x.healthy(now)]
+            if not healthy:
+                return self.primary
+            # при равной загрузке реплики тоже берутся по кругу, а не всегда первая
+            self.__next += 1
+            n = self.__next % len(healthy)
+            healthy = healthy[n:] + healthy[:n]
+            if self.balance == 'least_outstanding':
+                return min(healthy, key=lambda x: x.outstanding)
+            return healthy[0]
+
+    @property
+    def members(self) -> list:
+        return [self.primary] + self.replicas
+
+    def state(self) -> list:
+        return [x.state() for x in self.members]
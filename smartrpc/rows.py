@@ -0,0 +1,55 @@
+import threading, keyword
+
+# сколько разных наборов полей помнить: запросы с произвольными именами полей не должны копить классы без конца
+MAX_FACTORIES = 4096
+FACTORIES = {}  # имена полей -> функция строки
+LOCK = threading.Lock()
+
+
+def dict_row(names: tuple):
+    # обычный dict, если имена полей нельзя сделать атрибутами
+    return lambda values: dict(zip(names, values))
+
+
+def shared_row(names: tuple):
+    """
+    Строки - __dict__ объектов класса, один класс на набор имен полей. Атрибуты присваиваются всегда
+    в одном порядке, поэтому такие dict делят одну таблицу ключей (PEP 412): в строке хранятся только значения.
+    Снаружи это обычный dict - изменяемый, с обычным кодированием в JSON
+    """
+    local = ['_%d' % n for n in range(len(names))]
+    body = ''.join(
+        '    o.%s = %s\n' % (x, y) if x.isidentifier() and not keyword.iskeyword(x) else
+        '    setattr(o, %r, %s)\n' % (x, y)
+        for x, y in zip(names, local)
+    )
+    scope = {'new': object.__new__, 'cls': type('Row', (), {})}
+    exec('def row(values):\n    %s, = values\n    o = new(cls)\n%s    return o.__dict__\n'
+         % (', '.join(local), body), scope)
+    return scope['row']
+
+
+def row_factory(f):
+    """
+    Функция строки формата dicts для описания полей выборки f (get_fields адаптера), одна на набор имен полей
+    """
+    names = tuple(x['name'] for x in f)
+    ret = FACTORIES.get(names)
+    if ret is not None:
+        return ret
+    # имена вида __x__ совпадают с атрибутами объекта
+    if names and all(isinstance(x, str) and not x.startswith('__') for x in names):
+        ret = shared_row(names)
+    else:
+        ret = dict_row(names)
+    with LOCK:
+        if len(FACTORIES) >= MAX_FACTORIES:
+            FACTORIES.clear()
+        return FACTORIES.setdefault(names, ret)
+
+
+def make_rows(d, f) -> list:
+    """
+    Строки выборки в формате dicts
+    """
+    return list(map(row_factory(f), d))
@@ -1,15 +1,33 @@
-from typing import Callable, Any, Union
+from typing import Callable, Any, Union, Iterator, AsyncIterator
 from .env import BaseEnv
-from collections import OrderedDict
 from .err import *
-from .methods import RPCBase, PythonMethod, SQLMethod
-import json
+from .methods import RPCBase, PythonMethod, SQLMethod, LazyMethod, call_options
+from .stream import iterencode, aiterencode, has_streams, collect, acollect
+from .codec import Codec, JSONCodec
+from .cache import ResultCache, Flights, invalidate
+from .metrics import Metrics, clock
+from .script import ScriptCache
+from .transaction import Transaction, current as current_transaction
+from .deadline import deadline, within, remaining
+import threading, asyncio, weakref, os
+from concurrent.futures import ThreadPoolExecutor
+
+
+# параметры метода, которые можно вернуть из функции, декорированной sql_method
+METHOD_OPTIONS = ('cache', 'reads', 'writes', 'format', 'bulk', 'on_error', 'readonly', 'limit', 'single_flight',
+                  'timeout')
+# расширения JSON-RPC: поля запроса рядом с method и params, которые действуют на один вызов.
+# кроме них - "timeout" (срок вызова, см. deadline) и "transaction" у вызовов пакета
+REQUEST_OPTIONS = ('format',)
+
+INSTANCES = weakref.WeakSet()
 
 
 class RPC(RPCBase):
 
     def python_method(self, name: str = None,
-                      mapping: Union[dict, int, Callable[[dict], Union[tuple, dict]]] = RPCBase.MAP_ARGS):
+                      mapping: Union[dict, int, Callable[[dict], Union[tuple, dict]]] = RPCBase.MAP_ARGS,
+                      **options):
         """
         Декоратор для регистрации функций
         :param name: имя метода в АПИ. если не задано, то будет использовано имя функции
@@ -20,11 +38,12 @@ class RPC(RPCBase):
         либо одно из значений PythonMethod.MAP_...
 
         если в to указвн ноинр паратетра, то номера должны быть указаны для всех to
+        :param options: параметры метода: cache, reads, writes, limit, single_flight, timeout (см. Method)
         :return:
         """
 
         def decorator(fnc):
-            self.add_python_method(fnc, name, mapping)
+            self.add_python_method(fnc, name, mapping, **options)
 
         if callable(name):
             self.add_python_method(name)
@@ -32,17 +51,47 @@ class RPC(RPCBase):
             return decorator
 
     def add_python_method(self, func: Union[Callable[..., Any], str], name: str = None,
-                          mapping: Union[dict, int, Callable[[dict], Union[tuple, dict]]] = RPCBase.MAP_ARGS):
+                          mapping: Union[dict, int, Callable[[dict], Union[tuple, dict]]] = RPCBase.MAP_ARGS,
+                          **options):
+        """
+        :param func: функция, либо строка "пакет.модуль:функция" - тогда модуль импортируется при первом вызове
+        (см. LazyMethod, preload)
+        """
         if isinstance(func, str):
-            # todo тут подгрузить модуль и функцию по имени
-            pass
+            if name is None:
+                name = func.replace(':', '.').split('.')[-1]
+            self.__methods[name] = LazyMethod(self, func, mapping, name=name, **options)
+            return
         if name is None:
             name = func.__name__
-        self.__methods[name] = PythonMethod(self, func, mapping)
+        self.__methods[name] = PythonMethod(self, func, mapping, name=name, **options)
+
+    def preload(self, background: bool = False):
+        """
+        Импорт функций, зарегистрированных строкой.
+        :param background: импортировать в фоновом потоке, не задерживая старт. ошибки импорта в фоне
+        не выбрасываются - они повторятся при вызове метода
+        :return: фоновый поток, если background
+        """
+        lazy = [x for x in self.__methods.values() if isinstance(x, LazyMethod) and not x.loaded]
+        if not background:
+            for x in lazy:
+                x.load()
+            return
+
+        def load():
+            for x in lazy:
+                try:
+                    x.load()
+                except Exception:
+                    pass
+        ret = threading.Thread(target=load, name='smartrpc-preload', daemon=True)
+        ret.start()
+        return ret
 
     def sql_method(self, name: str = None, alias: Union[str, dict] = None,
                        mapping: Union[dict, int, Callable[[dict], Union[tuple, dict]]] = RPCBase.MAP_ARGS,
-                       postproc = None):
+                       postproc = None, stream: bool = False, **options):
         """
         Декоратор для регистрации SQL. Декорируемая функция должна вернуть строку с запросом, либо словарь,
         содержащий те же параметры, что у декоратора + обязательный параметр query. Функция выполняется только
@@ -51,35 +100,43 @@ class RPC(RPCBase):
         :param alias: имя или параметры соединения по умолчанию
         :param mapping: описание мапинга параметров, если нужно
         :param postproc: процедура постобработки данных. на входе получит выборку данных и описание полей
+        :param stream: возвращать строки итератором по мере чтения из БД (см. SQLMethod, RPC.stream)
+        :param options: параметры метода: cache, reads, writes, limit, single_flight, timeout (см. Method), format,
+        bulk, on_error, readonly (см. SQLMethod)
         :return:
         """
         def decorator(fnc):
             query = fnc()
-            args = {'rpc': self}
+            args = dict(options, rpc=self)
             if isinstance(query, dict):
+                args.update({x: query[x] for x in METHOD_OPTIONS if x in query})
                 fn = query.get('name', name)
                 args['alias'] = query.get('alias', alias)
                 args['mapping'] = query.get('mapping', mapping)
                 args['postproc'] = query.get('postproc', postproc)
+                args['stream'] = query.get('stream', stream)
                 args['query'] = query['query']
             else:
                 fn =  name
                 args['alias'] =  alias
                 args['mapping'] = mapping
                 args['postproc'] = postproc
+                args['stream'] = stream
                 args['query'] = query
             if fn is None:
                 fn = fnc.__name__
-            self.__methods[fn] = SQLMethod(**args)
+            self.__methods[fn] = SQLMethod(name=fn, **args)
 
         if callable(name):
             query = name()
             args = {'rpc': self}
             if isinstance(query, dict):
+                args.update({x: query[x] for x in METHOD_OPTIONS if x in query})
                 fn = query.get('name')
                 args['alias'] = query.get('alias')
                 args['mapping'] = query.get('mapping')
                 args['postproc'] = query.get('postproc')
+                args['stream'] = query.get('stream', False)
                 args['query'] = query['query']
             else:
                 fn = None
@@ -89,22 +146,141 @@ class RPC(RPCBase):
                 args['query'] = query
             if fn is None:
                 fn = name.__name__
-            self.__methods[fn] = SQLMethod(**args)
+            self.__methods[fn] = SQLMethod(name=fn, **args)
         else:
             return decorator
 
     def add_sql_method(self, name: str, query: str, alias: Union[str, dict] = None,
                        mapping: Union[dict, int, Callable[[dict], Union[tuple, dict]]] = RPCBase.MAP_ARGS,
-                       postproc = None):
-        self.__methods[name] = SQLMethod(self, query, alias, mapping, postproc)
+                       postproc = None, stream: bool = False, **options):
+        self.__methods[name] = SQLMethod(self, query, alias, mapping, postproc, stream, name=name, **options)
 
-    def __init__(self, env: BaseEnv = None, simple_format=False):
+    def __init__(self, env: BaseEnv = None, simple_format=False, batch_workers: int = 8,
+                 cache_size: int = 64 * 1024 * 1024, codec: Codec = None, metrics: bool = False,
+                 fanout_workers: int = 16, script_cache: str = None):
+        """
+        :param env: окружение с алиасами БД
+        :param simple_format: не требовать "jsonrpc": "2.0" в запросе
+        :param batch_workers: число потоков для параллельного выполнения вызовов из batch-запроса.
+        1 - выполнять вызовы пакета по очереди
+        :param cache_size: лимит памяти кэша результатов методов, в байтах
+        :param codec: разбор запросов и кодирование ответов. по умолчанию json с OrderedDict,
+        быстрее - Codec.best() или JSONCodec(ordered=False)
+        :param fanout_workers: число потоков для одновременного выполнения блоков @@parallel SQL методов
+        :param metrics: собирать метрики вызовов по методам (см. Metrics), доступны методом rpc.stats.
+        по умолчанию выключены: на самом коротком пути вызова они заметны даже с выборочными замерами
+        :param script_cache: каталог для разобранных скриптов SQL методов (см. ScriptCache)
+        """
         RPCBase.__init__(self, env)
         self.__methods = {}
         self.__simple = simple_format
         self.__env = env if env else BaseEnv()
+        self.__batch_workers = batch_workers
+        self.__executor = None
+        self.__fanout_workers = fanout_workers
+        self.__fanout = None
+        self.__lock = threading.Lock()
+        self.__cache = ResultCache(cache_size)
+        self.__flights = Flights()
+        self.__codec = codec if codec else JSONCodec(ordered=True)
+        self.__metrics = Metrics() if metrics else None
+        self.__script_cache = ScriptCache(script_cache) if script_cache else None
+        INSTANCES.add(self)
+        if self.__metrics is not None:
+            self.__methods['rpc.stats'] = PythonMethod(self, self.__metrics.snapshot, RPCBase.MAP_ARGS,
+                                                       name='rpc.stats')
+
+    def __call__(self, *args, **kwargs) -> Union[dict, list, None]:
+        message, is_func = self.__parse(args, kwargs)
+        if message is None:
+            return self.__parse_error()
+        if isinstance(message, list):
+            return self.__batch(message)
+        return self.__dispatch(message, is_func)
+
+    async def acall(self, *args, **kwargs) -> Union[dict, list, None]:
+        """
+        Асинхронный вариант __call__. async def функции выполняются в текущем цикле событий,
+        обычные функции и драйверы БД без async варианта - в пуле потоков
+        """
+        message, is_func = self.__parse(args, kwargs)
+        if message is None:
+            return self.__parse_error()
+        if isinstance(message, list):
+            if message == []:
+                return error(ERR_REQUEST)
+            if self.__transactional(message):
+                return self.__batch_result(message, await self.__atransaction_batch(message))
+            calls = (self.__adispatch(x, False) if isinstance(x, dict) else self.__invalid() for x in message)
+            if current_transaction.get() is not None:
+                # соединение транзакции одно на алиас - вызовы по очереди
+                ret = [await x for x in calls]
+            else:
+                ret = await asyncio.gather(*calls)
+            return self.__batch_result(message, ret)
+        return await self.__adispatch(message, is_func)
+
+    def stream(self, *args, **kwargs) -> Iterator[str]:
+        """
+        Вызов с кодированием ответа в JSON по частям. Потоковые результаты SQL методов пишутся
+        по мере чтения из БД, не собираясь в памяти
+        """
+        return iterencode(self(*args, **kwargs), self.__codec.dumps)
+
+    async def astream(self, *args, **kwargs) -> AsyncIterator[str]:
+        async for x in aiterencode(await self.acall(*args, **kwargs), self.__codec.dumps):
+            yield x
+
+    def handle_bytes(self, payload: bytes, codec: Codec = None) -> bytes:
+        """
+        Запрос в байтах -> ответ в байтах. Для уведомлений - пустая строка.
+        codec - формат запроса и ответа вместо codec RPC, транспорт выбирает его по Content-Type
+        """
+        return self.__encode(self(self.__load(payload, codec)), codec)
+
+    async def ahandle_bytes(self, payload: bytes, codec: Codec = None) -> bytes:
+        response = await self.acall(self.__load(payload, codec))
+        if (codec or self.__codec).binary:
+            response = await acollect(response)
+        return self.__encode(response, codec)
+
+    @staticmethod
+    def __load(payload, codec):
+        # запрос, который не удалось разобрать, - None, на него вернется ошибка разбора
+        if codec is None:
+            return payload
+        try:
+            message = codec.loads(payload)
+        except Exception:
+            return None
+        return message if isinstance(message, (dict, list)) else None
 
-    def __call__(self, *args, **kwargs) -> dict:
+    def __encode(self, response, codec: Codec = None) -> bytes:
+        codec = codec or self.__codec
+        if response is None:
+            return b''
+        if has_streams(response):
+            if codec.binary:
+                return codec.dumpb(collect(response))
+            return ''.join(iterencode(response, codec.dumps)).encode('utf-8')
+        return codec.dumpb(response)
+
+    def __parse_error(self):
+        if self.__metrics is not None:
+            self.__metrics.error('', ERR_PARSE[0])
+        return error(ERR_PARSE)
+
+    def __parse(self, args, kwargs):
+        # разбор замеряется, только если он есть: запрос строкой или байтами
+        if self.__metrics is None or len(args) != 1 or not isinstance(args[0], (str, bytes, bytearray, memoryview)):
+            return self.__decode(args, kwargs)
+        t = clock()
+        try:
+            return self.__decode(args, kwargs)
+        finally:
+            self.__metrics.observe('', 'parse', clock() - t)
+
+    def __decode(self, args, kwargs):
         is_func = True
         if len(args) == 1 and kwargs == {}:
             is_func = False
@@ -125,22 +301,151 @@ class RPC(RPCBase):
         try:
             if isinstance(message, str):
                 message = message.strip()
-                if not message.startswith('{') and message in self.__methods:
+                if not message.startswith(('{', '[')) and message in self.__methods:
                     message = {
                         "jsonrpc": "2.0",
                         "method": message
                     }
                     is_func = True
                 else:
-                    message = json.loads(message, object_pairs_hook=OrderedDict)
-            if not isinstance(message, dict):
+                    message = self.__codec.loads(message)
+            elif isinstance(message, (bytes, bytearray, memoryview)):
+                message = self.__codec.loads(message)
+            if not isinstance(message, (dict, list)):
                 raise Exception('Parse error')
         except Exception as e:
             if is_func:
                 raise e
             else:
-                return error(ERR_PARSE)
+                return None, False
+        return message, is_func
+
+    def __batch(self, messages: list) -> Union[list, None]:
+        """
+        Пакетный вызов по JSON-RPC 2.0. Вызовы выполняются параллельно (внутри rpc.transaction() - по очереди),
+        ответы возвращаются в порядке запроса.
+        На уведомления (вызовы без id) ответ не возвращается, если в пакете только уведомления - вернется None
+        """
+        if messages == []:
+            return error(ERR_REQUEST)
+        if self.__transactional(messages):
+            return self.__batch_result(messages, self.__transaction_batch(messages))
+
+        def call(message):
+            if not isinstance(message, dict):
+                return error(ERR_REQUEST)
+            return self.__dispatch(message, False)
+
+        # внутри rpc.transaction() вызовы идут по очереди в этом потоке: потоки пула не видят транзакцию,
+        # а соединение транзакции одно на алиас
+        if len(messages) == 1 or self.__batch_workers <= 1 or current_transaction.get() is not None:
+            ret = [call(x) for x in messages]
+        else:
+            ret = list(self.executor.map(call, messages))
+        return self.__batch_result(messages, ret)
+
+    def transaction(self) -> Transaction:
+        """
+        Область общей транзакции для вызовов SQL методов (см. Transaction):
+            with rpc.transaction():
+                ...
+        """
+        return Transaction()
+
+    @staticmethod
+    def __transactional(messages: list) -> bool:
+        return any(isinstance(x, dict) and x.get('transaction') is True for x in messages)
+
+    def __transaction_batch(self, messages: list) -> list:
+        """
+        Пакет, в котором у вызова есть "transaction": true, выполняется в одной транзакции по порядку.
+        После первой ошибки вызовы не выполняются, все откатывается, и ошибку получают все вызовы пакета
+        """
+        ret, tx = [], Transaction()
+        try:
+            with tx:
+                for x in messages:
+                    ret.append(self.__dispatch(x, False) if isinstance(x, dict) else error(ERR_REQUEST))
+                    if self.__aborted(tx, ret[-1]):
+                        break
+        except Exception as e:
+            tx.fail(e)
+        return self.__transaction_result(messages, ret, tx)
+
+    async def __atransaction_batch(self, messages: list) -> list:
+        ret, tx = [], Transaction()
+        try:
+            async with tx:
+                for x in messages:
+                    ret.append(await self.__adispatch(x, False) if isinstance(x, dict) else error(ERR_REQUEST))
+                    if self.__aborted(tx, ret[-1]):
+                        break
+        except Exception as e:
+            tx.fail(e)
+        return self.__transaction_result(messages, ret, tx)
+
+    @staticmethod
+    def __aborted(tx: Transaction, response: dict) -> bool:
+        if response.get('error'):
+            tx.fail(ErrorRPC(response['error']['code'], response['error']['message']))
+        return tx.error is not None
 
+    @staticmethod
+    def __transaction_result(messages: list, ret: list, tx: Transaction) -> list:
+        if tx.error is None:
+            return ret
+        failed = ErrorRPC(ERR_SERVER, '+Transaction is rolled back: %s' % tx.error)
+        return [
+            ret[n] if n < len(ret) and ret[n].get('error') else
+            failed.message(x.get('id') if isinstance(x, dict) else None)
+            for n, x in enumerate(messages)
+        ]
+
+    @staticmethod
+    def __batch_result(messages, ret):
+        ret = [
+            x for n, x in enumerate(ret)
+            if not isinstance(messages[n], dict) or 'id' in messages[n]
+        ]
+        return ret if ret != [] else None
+
+    @staticmethod
+    async def __invalid():
+        return error(ERR_REQUEST)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """
+        Пул потоков для batch-запросов и для блокирующих вызовов из acall
+        """
+        if self.__executor is None:
+            with self.__lock:
+                if self.__executor is None:
+                    self.__executor = ThreadPoolExecutor(max_workers=max(self.__batch_workers, 1),
+                                                         thread_name_prefix='smartrpc')
+        return self.__executor
+
+    def after_fork(self):
+        # потоки пулов не переживают fork, в дочернем процессе пулы создаются заново
+        self.__lock = threading.Lock()
+        self.__executor = None
+        self.__fanout = None
+
+    @property
+    def fanout(self) -> ThreadPoolExecutor:
+        """
+        Пул потоков для блоков @@parallel. Отдельный от executor: вызов, занявший поток executor,
+        не должен ждать свободного потока в нем же
+        """
+        if self.__fanout is None:
+            with self.__lock:
+                if self.__fanout is None:
+                    self.__fanout = ThreadPoolExecutor(max_workers=max(self.__fanout_workers, 1),
+                                                       thread_name_prefix='smartrpc-fanout')
+        return self.__fanout
+
+    def __method(self, message: dict, is_func: bool):
+        # метод для вызова, либо готовый ответ с ошибкой
         f = message.get('method')
 
         if ((not self.__simple) and str(message.get('jsonrpc', '')) != "2.0") or not isinstance(f, str):
@@ -149,42 +454,204 @@ class RPC(RPCBase):
         f = self.__methods.get(f)
         if not f:
             if is_func:
+                self.__rejected(error(ERR_NOT_FOUND))
                 raise ErrorRPC(ERR_NOT_FOUND)
             else:
-                return error(ERR_NOT_FOUND)
+                return error(ERR_NOT_FOUND, json_msg=message)
+        return f
 
-        try:
-            if callable(f.mapping):
-                f = f(message)
+    @staticmethod
+    def __params(f, message: dict):
+        if callable(f.mapping):
+            return (message,), {}
+        p = message.get('params')
+        if isinstance(p, (list, tuple)) and len(p) > 0:
+            return p, {}
+        elif isinstance(p, dict) and p != {}:
+            return (), p
+        return (), {}
+
+    @staticmethod
+    def __result(f, message: dict, is_func: bool):
+        if is_func:
+            return f
+
+        return {
+            "jsonrpc": "2.0",
+            "result": f,
+            "id": message.get('id'),
+            "error": None
+        }
+
+    def __failure(self, e: Exception, message: dict, is_func: bool):
+        if self.__metrics is not None:
+            if isinstance(e, ErrorRPC):
+                code = e.code
             else:
-                p = message.get('params')
-                if isinstance(p, list) and p != []:
-                    f = f(*p)
-                elif isinstance(p, dict) and p != {}:
-                    f = f(**p)
-                else:
-                    f = f()
+                code = ERR_BAD_PARAMS[0] if isinstance(e, TypeError) else ERR_INTERNAL[0]
+            self.__metrics.error(message['method'], code)
+        if is_func:
+            raise e
+        if isinstance(e, ErrorRPC):
+            return e.message(message.get('id'))
+        x = '\n'.join((str(x) for x in e.args))
+        if isinstance(e, TypeError):
+            return error(ERR_BAD_PARAMS, json_msg=message)
+        else:
+            return error(ERR_INTERNAL, e.__class__.__name__ + ': ' + x, message)
 
-            if is_func:
-                return f
+    @staticmethod
+    def __key(name: str, f, args, kwargs):
+        options = call_options.get()
+        if options:
+            return ResultCache.key(name, [f.params(args, kwargs), options])
+        return ResultCache.key(name, f.params(args, kwargs))
 
-            return {
-                "jsonrpc": "2.0",
-                "result": f,
-                "id": message.get('id'),
-                "error": None
-            }
+    def __invoke(self, name: str, f, args, kwargs):
+        tx = current_transaction.get()
+        if f.cache and tx is None:
+            ret = self.__cache.call(self.__key(name, f, args, kwargs), f.cache, f.reads,
+                                    lambda: self.__limited(f, args, kwargs))
+        elif f.single_flight and tx is None:
+            ret = self.__flights.call(self.__key(name, f, args, kwargs), lambda: self.__limited(f, args, kwargs))
+        else:
+            ret = self.__limited(f, args, kwargs)
+        if f.writes:
+            self.__written(tx, f.writes)
+        return ret
+
+    async def __ainvoke(self, name: str, f, args, kwargs):
+        tx = current_transaction.get()
+        if f.cache and tx is None:
+            ret = await self.__cache.acall(self.__key(name, f, args, kwargs), f.cache, f.reads,
+                                           lambda: self.__alimited(f, args, kwargs))
+        elif f.single_flight and tx is None:
+            ret = await self.__flights.acall(self.__key(name, f, args, kwargs),
+                                             lambda: self.__alimited(f, args, kwargs))
+        else:
+            ret = await self.__alimited(f, args, kwargs)
+        if f.writes:
+            self.__written(tx, f.writes)
+        return ret
+
+    @staticmethod
+    def __limited(f, args, kwargs):
+        if f.limiter is None:
+            return f(*args, **kwargs)
+        return f.limiter.call(lambda: f(*args, **kwargs))
+
+    @staticmethod
+    def __alimited(f, args, kwargs):
+        if f.limiter is None:
+            return f.acall(*args, **kwargs)
+        return f.limiter.acall(lambda: f.acall(*args, **kwargs))
+
+    @staticmethod
+    def __written(tx, writes):
+        # в транзакции кэш сбрасывается после ее фиксации
+        if tx is None:
+            invalidate(writes)
+        else:
+            tx.writes.update(writes)
+
+    def __dispatch(self, message: dict, is_func: bool):
+        f = self.__method(message, is_func)
+        if isinstance(f, dict):
+            return self.__rejected(f)
+        token = call_options.set({x: message[x] for x in REQUEST_OPTIONS if x in message})
+        expires = None
+        stats = f.stats
+        t = clock() if stats is not None and stats.sampled() else None
+        try:
+            expires = within(self.__timeout(f, message))
+            args, kwargs = self.__params(f, message)
+            return self.__result(self.__invoke(message['method'], f, args, kwargs), message, is_func)
         except Exception as e:
-            if is_func:
-                raise e
-            if isinstance(e, ErrorRPC):
-                return e.message(message.get('id'))
-            x = '\n'.join((str(x) for x in e.args))
-            if isinstance(e, TypeError):
-                return error(ERR_BAD_PARAMS)
+            return self.__failure(e, message, is_func)
+        finally:
+            call_options.reset(token)
+            if expires is not None:
+                deadline.reset(expires)
+            if stats is not None:
+                stats.count()
+                if t is not None:
+                    stats.observe('call', clock() - t)
+
+    async def __adispatch(self, message: dict, is_func: bool):
+        f = self.__method(message, is_func)
+        if isinstance(f, dict):
+            return self.__rejected(f)
+        token = call_options.set({x: message[x] for x in REQUEST_OPTIONS if x in message})
+        expires = None
+        stats = f.stats
+        t = clock() if stats is not None and stats.sampled() else None
+        try:
+            expires = within(self.__timeout(f, message))
+            args, kwargs = self.__params(f, message)
+            if expires is None or f.cancels_queries:
+                ret = await self.__ainvoke(message['method'], f, args, kwargs)
             else:
-                return error(ERR_INTERNAL, e.__class__.__name__ + ': ' + x)
+                # async функция отменяется по сроку вместе с задачей
+                try:
+                    ret = await asyncio.wait_for(self.__ainvoke(message['method'], f, args, kwargs), remaining())
+                except asyncio.TimeoutError:
+                    raise ErrorRPC(ERR_TIMEOUT)
+            return self.__result(ret, message, is_func)
+        except Exception as e:
+            return self.__failure(e, message, is_func)
+        finally:
+            call_options.reset(token)
+            if expires is not None:
+                deadline.reset(expires)
+            if stats is not None:
+                stats.count()
+                if t is not None:
+                    stats.observe('call', clock() - t)
+
+    @staticmethod
+    def __timeout(f, message: dict) -> float:
+        # срок вызова: меньший из timeout метода и поля "timeout" запроса
+        x = message.get('timeout')
+        if x is not None and (isinstance(x, bool) or not isinstance(x, (int, float)) or x <= 0):
+            raise ErrorRPC(ERR_BAD_PARAMS, '+Bad timeout')
+        if f.timeout is None or (x is not None and x < f.timeout):
+            return x
+        return f.timeout
+
+    def __rejected(self, response: dict) -> dict:
+        # неверный запрос или неизвестный метод, в метриках - под пустым именем
+        if self.__metrics is not None:
+            self.__metrics.error('', response['error']['code'])
+        return response
+
+    @property
+    def cache(self) -> ResultCache:
+        return self.__cache
+
+    @property
+    def flights(self) -> Flights:
+        return self.__flights
+
+    @property
+    def codec(self) -> Codec:
+        return self.__codec
+
+    @property
+    def metrics(self) -> Metrics:
+        return self.__metrics
+
+    @property
+    def script_cache(self) -> ScriptCache:
+        return self.__script_cache
 
     @property
     def env(self) -> BaseEnv:
-        return self.__env
\ No newline at end of file
+        return self.__env
+
+def after_fork():
+    for x in list(INSTANCES):
+        x.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=after_fork)
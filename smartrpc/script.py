@@ -0,0 +1,109 @@
+import re, os, json, hashlib, threading
+
+# меняется вместе с правилами разбора, чтобы не брать из кэша скрипты, разобранные по-старому
+VERSION = '1'
+
+TOKEN = re.compile(r"""
+    (?P<quote>'[^']*(?:'|\Z)|"[^"]*(?:"|\Z))
+  | (?P<line_comment>--[^\n]*(?:\n[ \t\f]*)?)
+  | (?P<comment>/\*.*?(?:\*/|\Z))
+  | (?P<newline>\n[ \t\f]*)
+  | (?P<directive>@@[^\n]*(?:\n[ \t\f]*)?)
+  | (?P<text>[^'"\n@/-]+)
+  | (?P<char>.)
+""", re.S | re.X)
+
+
+def tokenize(query: str) -> list:
+    """
+    Разбор скрипта SQL метода за один проход: [("@", директива), ("sql", запрос), ...].
+    Директивы @@ - в начале строки, комментарии -- и /* */ выбрасываются, отступы строк тоже,
+    внутри строк в кавычках текст не меняется
+    """
+    ret, txt, newline, pos, size = [], [], True, 0, len(query)
+    match = TOKEN.match
+    while pos < size:
+        m = match(query, pos)
+        kind, x = m.lastgroup, m.group()
+        pos = m.end()
+        if kind == 'text':
+            if newline:
+                x = x.lstrip(' \t\f')
+                if not x:
+                    continue
+            txt.append(x)
+            newline = False
+        elif kind == 'newline':
+            txt.append('\n')
+            newline = True
+        elif kind == 'line_comment':
+            if '\n' in x:
+                newline = True
+        elif kind == 'comment':
+            pass
+        elif kind == 'directive' and newline:
+            flush(ret, txt)
+            ret.append(('@', x[2:].split('\n', 1)[0]))
+        elif kind == 'directive':
+            # @@ не в начале строки - обычный текст
+            txt.append('@')
+            pos = m.start() + 1
+            newline = False
+        else:
+            txt.append(x)
+            newline = False
+    flush(ret, txt)
+    return ret
+
+
+def flush(ret: list, txt: list):
+    x = ''.join(txt).strip()
+    if x:
+        ret.append(('sql', x))
+    txt.clear()
+
+
+class ScriptCache:
+    """
+    Разобранные скрипты SQL методов на диске, файл на скрипт по хэшу его текста.
+    При повторном запуске сервиса скрипты берутся из кэша без разбора
+    """
+
+    def __init__(self, path: str):
+        self.__path = path
+        os.makedirs(path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    def file(self, query: str) -> str:
+        key = hashlib.sha1((VERSION + '\n' + query).encode('utf-8')).hexdigest()
+        return os.path.join(self.__path, key + '.json')
+
+    def get(self, query: str) -> list:
+        name = self.file(query)
+        try:
+            with open(name, encoding='utf-8') as f:
+                ret = [tuple(x) for x in json.load(f)]
+            self.hits += 1
+            return ret
+        except (OSError, ValueError):
+            pass
+        self.misses += 1
+        ret = tokenize(query)
+        # запись через временный файл: параллельно стартующие процессы не прочитают недописанный
+        tmp = '%s.%d.%d.tmp' % (name, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(ret, f, ensure_ascii=False)
+            os.replace(tmp, name)
+        except OSError:
+            pass
+        return ret
+
+
+def compile(query: str, cache: ScriptCache = None) -> list:
+    return cache.get(query) if cache is not None else tokenize(query)
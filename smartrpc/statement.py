@@ -0,0 +1,168 @@
+import re, functools
+from collections import OrderedDict
+from .err import *
+
+# %(name)s, он же в кавычках (так параметры писали, когда они подставлялись в текст запроса), %%,
+# строковые литералы и комментарии - в них параметров нет
+PARAM = re.compile(r"'%\((\w+)\)s'|%\((\w+)\)s|%%|('(?:[^']|'')*'|--[^\n]*|/\*.*?\*/)", re.S)
+INNER = re.compile(r'%\(\w+\)s')
+
+# как записывается n-ый параметр name в тексте для paramstyle драйвера
+STYLES = {
+    'pyformat': lambda n, name: '%%(%s)s' % name,
+    'named': lambda n, name: ':' + name,
+    'qmark': lambda n, name: '?',
+    'format': lambda n, name: '%s',
+    'numeric': lambda n, name: ':%d' % (n + 1),
+    'dollar': lambda n, name: '$%d' % (n + 1),
+}
+
+# стили, в которых значения передаются словарем
+NAMED_STYLES = ('pyformat', 'named')
+
+
+class Statement:
+    """
+    Запрос с именованными параметрами %(name)s. Разбирается один раз, текст для paramstyle драйвера
+    тоже строится один раз, значения параметров передаются драйверу отдельно от текста
+    """
+
+    def __init__(self, query: str):
+        self.__query = query
+        self.__parts = []  # куски текста и имена параметров через один
+        self.__styles = {}
+        pos, txt = 0, ''
+        for m in PARAM.finditer(query):
+            txt += query[pos:m.start()]
+            pos = m.end()
+            if m.group(3) is not None:
+                if m.group(3).startswith("'") and INNER.search(m.group(3)):
+                    # раньше значение подставлялось в литерал, теперь драйвер подставил бы его в кавычках
+                    raise ErrorRPC(ERR_PARSE, '+Param inside string literal %s, use concatenation' % m.group(3))
+                txt += m.group(3).replace('%%', '%')
+                continue
+            name = m.group(1) or m.group(2)
+            if name is None:
+                txt += '%'
+                continue
+            self.__parts.append(txt)
+            self.__parts.append(name)
+            txt = ''
+        self.__parts.append(txt + query[pos:])
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def get(cls, query: str):
+        # для запросов, которые передаются в адаптер строкой
+        return cls(query)
+
+    @property
+    def query(self) -> str:
+        return self.__query
+
+    @property
+    def names(self) -> tuple:
+        return tuple(self.__parts[1::2])
+
+    def compile(self, paramstyle: str):
+        """
+        Текст запроса для paramstyle и имена параметров в порядке передачи драйверу
+        """
+        ret = self.__styles.get(paramstyle)
+        if ret:
+            return ret
+        if len(self.__parts) == 1:
+            # без параметров драйвер не разбирает текст, %% уже заменены на %
+            ret = self.__parts[0], ()
+        else:
+            style = STYLES[paramstyle]
+            names = []
+            if paramstyle in ('pyformat', 'format'):
+                # знаки % в тексте остаются экранированными
+                txt = [x.replace('%', '%%') for x in self.__parts[0::2]]
+            else:
+                txt = self.__parts[0::2]
+            query = txt[0]
+            for n, name in enumerate(self.__parts[1::2]):
+                if paramstyle in ('numeric', 'dollar') and name in names:
+                    query += style(names.index(name), name)
+                else:
+                    query += style(len(names), name)
+                    names.append(name)
+                query += txt[n + 1]
+            ret = query, tuple(names)
+        self.__styles[paramstyle] = ret
+        return ret
+
+    def bind(self, paramstyle: str, kwargs: dict):
+        """
+        Текст запроса и параметры для cursor.execute. Для запроса без параметров вместо них None
+        """
+        query, names = self.compile(paramstyle)
+        if not names:
+            return query, None
+        try:
+            if paramstyle in NAMED_STYLES:
+                return query, {x: kwargs[x] for x in names}
+            return query, [kwargs[x] for x in names]
+        except KeyError as e:
+            raise ErrorRPC(ERR_BAD_PARAMS, '+Missing param ' + e.args[0])
+
+    def __str__(self):
+        return self.__query
+
+
+class StatementCache:
+    """
+    LRU кэш подготовленных на сервере запросов одного соединения: текст запроса -> имя prepared statement.
+    Вытесненные запросы освобождаются на сервере через deallocate(name)
+    """
+
+    def __init__(self, capacity: int, deallocate):
+        self.__capacity = capacity
+        self.__deallocate = deallocate
+        self.__names = OrderedDict()
+        self.__pending = set()  # подготовлены в текущей транзакции
+        self.__counter = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, query: str):
+        name = self.__names.get(query)
+        if name is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.__names.move_to_end(query)
+        return name
+
+    def add(self, query: str) -> str:
+        """
+        Имя для нового prepared statement. Если кэш полон, самый старый запрос освобождается
+        """
+        while len(self.__names) >= self.__capacity:
+            old, name = self.__names.popitem(last=False)
+            self.__pending.discard(name)
+            self.evictions += 1
+            self.__deallocate(name)
+        self.__counter += 1
+        name = 'smartrpc_%d' % self.__counter
+        self.__names[query] = name
+        self.__pending.add(name)
+        return name
+
+    def committed(self):
+        self.__pending.clear()
+
+    @property
+    def dirty(self) -> bool:
+        # после отката неизвестно, какие из подготовленных в транзакции запросов остались на сервере
+        return len(self.__pending) > 0
+
+    def clear(self):
+        self.__names.clear()
+        self.__pending.clear()
+
+    def __len__(self):
+        return len(self.__names)
@@ -0,0 +1,232 @@
+import json, asyncio
+from .err import *
+
+
+class ResultStream:
+    """
+    Итератор по строкам потокового результата SQLMethod.
+    finish(error) вызывается один раз: с None, когда строки закончились, либо с исключением при ошибке или
+    досрочном закрытии. В нем SQLMethod фиксирует или откатывает транзакции и возвращает соединения в пул
+    """
+
+    def __init__(self, rows, finish):
+        self.__rows = iter(rows if rows is not None else ())
+        self.__finish = finish
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.__finish is None:
+            raise StopIteration
+        try:
+            return next(self.__rows)
+        except StopIteration:
+            self.__done(None)
+            raise
+        except BaseException as e:
+            self.__done(e)
+            raise e
+
+    def __done(self, error):
+        finish, self.__finish = self.__finish, None
+        if finish is not None:
+            finish(error)
+
+    def close(self):
+        if self.__finish is None:
+            return
+        try:
+            close = getattr(self.__rows, 'close', None)
+            if close:
+                close()
+        finally:
+            self.__done(GeneratorExit())
+
+    def __del__(self):
+        self.close()
+
+
+class AsyncResultStream:
+    """
+    Асинхронный вариант ResultStream для RPC.acall. finish - корутина
+    """
+
+    def __init__(self, rows, finish):
+        if rows is not None and not hasattr(rows, '__aiter__'):
+            rows = self.__wrap(rows)
+        self.__rows = rows.__aiter__() if rows is not None else None
+        self.__finish = finish
+
+    @staticmethod
+    async def __wrap(rows):
+        for x in rows:
+            yield x
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.__finish is None or self.__rows is None:
+            await self.__done(None)
+            raise StopAsyncIteration
+        try:
+            return await self.__rows.__anext__()
+        except StopAsyncIteration:
+            await self.__done(None)
+            raise
+        except BaseException as e:
+            await self.__done(e)
+            raise e
+
+    async def __done(self, error):
+        finish, self.__finish = self.__finish, None
+        if finish is not None:
+            await finish(error)
+
+    async def aclose(self):
+        if self.__finish is None:
+            return
+        try:
+            close = getattr(self.__rows, 'aclose', None)
+            if close:
+                await close()
+        finally:
+            await self.__done(GeneratorExit())
+
+    def __del__(self):
+        if self.__finish is None:
+            return
+        try:
+            asyncio.get_running_loop().create_task(self.aclose())
+        except RuntimeError:
+            pass
+
+
+def is_stream(x) -> bool:
+    return isinstance(x, (ResultStream, AsyncResultStream))
+
+
+def has_streams(response) -> bool:
+    if isinstance(response, list):
+        return any(has_streams(x) for x in response)
+    return isinstance(response, dict) and is_stream(response.get('result'))
+
+
+def _envelope(response: dict, dumps):
+    # ответ без result, result пишется между head и tail
+    head = '{"jsonrpc": "2.0", "result": ['
+    tail = '], "id": ' + dumps(response.get('id')) + ', "error": '
+    return head, tail
+
+
+def _failure(e):
+    if isinstance(e, ErrorRPC):
+        return {"code": e.code, "message": e.args[0]}
+    return {"code": ERR_INTERNAL[0], "message": e.__class__.__name__ + ': ' + '\n'.join(str(x) for x in e.args)}
+
+
+def iterencode(response, dumps=json.dumps, chunk_rows: int = 500):
+    """
+    Кодирование ответа RPC в JSON по частям. Потоковый result пишется по мере чтения строк,
+    так что в памяти одновременно не больше chunk_rows строк. Если чтение строк прервалось ошибкой,
+    массив result закрывается, а ошибка пишется в error
+    """
+    if isinstance(response, list):
+        yield '['
+        for n, x in enumerate(response):
+            if n > 0:
+                yield ', '
+            yield from iterencode(x, dumps, chunk_rows)
+        yield ']'
+        return
+    if not isinstance(response, dict) or not isinstance(response.get('result'), ResultStream):
+        yield dumps(response)
+        return
+
+    head, tail = _envelope(response, dumps)
+    yield head
+    buf, first, error = [], True, None
+    try:
+        for x in response['result']:
+            buf.append(dumps(x))
+            if len(buf) >= chunk_rows:
+                yield ('' if first else ', ') + ', '.join(buf)
+                buf, first = [], False
+    except Exception as e:
+        error = _failure(e)
+    if buf:
+        yield ('' if first else ', ') + ', '.join(buf)
+    yield tail + dumps(error) + '}'
+
+
+async def aiterencode(response, dumps=json.dumps, chunk_rows: int = 500):
+    """
+    Асинхронный вариант iterencode для ответов RPC.acall
+    """
+    if isinstance(response, list):
+        yield '['
+        for n, x in enumerate(response):
+            if n > 0:
+                yield ', '
+            async for y in aiterencode(x, dumps, chunk_rows):
+                yield y
+        yield ']'
+        return
+    if not isinstance(response, dict) or not is_stream(response.get('result')):
+        yield dumps(response)
+        return
+    if isinstance(response['result'], ResultStream):
+        for x in iterencode(response, dumps, chunk_rows):
+            yield x
+        return
+
+    head, tail = _envelope(response, dumps)
+    yield head
+    buf, first, error = [], True, None
+    try:
+        async for x in response['result']:
+            buf.append(dumps(x))
+            if len(buf) >= chunk_rows:
+                yield ('' if first else ', ') + ', '.join(buf)
+                buf, first = [], False
+    except Exception as e:
+        error = _failure(e)
+    if buf:
+        yield ('' if first else ', ') + ', '.join(buf)
+    yield tail + dumps(error) + '}'
+
+
+def collect(response):
+    """
+    Ответ с прочитанными в список потоковыми результатами - для кодеков, которые не пишут ответ по частям.
+    Ошибка чтения строк, как и в iterencode, пишется в error рядом с уже прочитанными строками
+    """
+    if isinstance(response, list):
+        return [collect(x) for x in response]
+    if not isinstance(response, dict) or not isinstance(response.get('result'), ResultStream):
+        return response
+    rows, error = [], None
+    try:
+        for x in response['result']:
+            rows.append(x)
+    except Exception as e:
+        error = _failure(e)
+    return dict(response, result=rows, error=error)
+
+
+async def acollect(response):
+    """
+    Асинхронный вариант collect для ответов RPC.acall
+    """
+    if isinstance(response, list):
+        return [await acollect(x) for x in response]
+    if not isinstance(response, dict) or not isinstance(response.get('result'), AsyncResultStream):
+        return collect(response)
+    rows, error = [], None
+    try:
+        async for x in response['result']:
+            rows.append(x)
+    except Exception as e:
+        error = _failure(e)
+    return dict(response, result=rows, error=error)
@@ -0,0 +1,119 @@
+import contextvars
+from .err import *
+from .cache import invalidate
+
+# транзакция, в которой выполняется текущий вызов, см. RPC.transaction
+current = contextvars.ContextVar('transaction', default=None)
+
+
+def close(aliases: dict, error):
+    # фиксация или откат соединений, при ошибке фиксации откатываются все
+    if error is None:
+        try:
+            for x in aliases:
+                aliases[x].commit()
+            return
+        except Exception as e:
+            error = e
+    for x in aliases:
+        aliases[x].rollback()
+    if not isinstance(error, GeneratorExit):
+        raise error
+
+
+async def aclose(aliases: dict, error):
+    if error is None:
+        try:
+            for x in aliases:
+                await aliases[x].commit()
+            return
+        except Exception as e:
+            error = e
+    for x in aliases:
+        await aliases[x].rollback()
+    if not isinstance(error, GeneratorExit):
+        raise error
+
+
+class Transaction:
+    """
+    Общая транзакция для нескольких вызовов SQL методов: одно соединение на алиас, одна фиксация при выходе
+    из области, при ошибке любого вызова откатывается все. Внутри области методы не читают из реплик,
+    не используют кэш результатов и не отдают строки потоком.
+        with rpc.transaction():
+            rpc('add_order', ...)
+            rpc('add_items', ...)
+    В async коде - async with rpc.transaction(). Вложенная область присоединяется к внешней
+    """
+
+    def __init__(self):
+        self.aliases = {}
+        self.writes = set()  # таблицы из writes методов, кэш по ним сбрасывается после фиксации
+        self.error = None
+        self.__scopes = []  # (внешняя транзакция, токен contextvar) на каждый вход в область
+
+    def check(self):
+        if self.error is not None:
+            raise ErrorRPC(ERR_SERVER, '+Transaction is rolled back: %s' % self.error)
+
+    def fail(self, error: Exception):
+        if self.error is None:
+            self.error = error
+
+    def __enter(self):
+        outer = current.get()
+        self.__scopes.append((outer, current.set(outer if outer is not None else self)))
+
+    def __exit(self):
+        outer, token = self.__scopes.pop()
+        current.reset(token)
+        return outer
+
+    def __finished(self):
+        self.aliases = {}
+        if self.error is None and self.writes:
+            invalidate(self.writes)
+        self.writes = set()
+
+    def __enter__(self):
+        self.__enter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        outer = self.__exit()
+        if outer is not None:
+            # вложенная область: фиксирует внешняя
+            if exc is not None:
+                outer.fail(exc)
+            return False
+        if exc is not None:
+            self.fail(exc)
+        try:
+            close(self.aliases, self.error)
+        except Exception as e:
+            if exc is None:
+                raise e
+        finally:
+            self.__finished()
+        return False
+
+    async def __aenter__(self):
+        self.__enter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        outer = self.__exit()
+        if outer is not None:
+            if exc is not None:
+                outer.fail(exc)
+            return False
+        if exc is not None:
+            self.fail(exc)
+        try:
+            await aclose(self.aliases, self.error)
+        except Exception as e:
+            if exc is None:
+                raise e
+        finally:
+            self.__finished()
+        return False
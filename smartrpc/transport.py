@@ -0,0 +1,510 @@
+import io, sys, zlib, socket, threading, itertools, traceback, http.server
+from .stream import iterencode, aiterencode, has_streams, is_stream
+from .rpc import RPC
+from .codec import Codec
+
+# сжимать ответы не меньше этого размера, мелкие ответы сжатие только замедляет
+COMPRESS_MIN = 4096
+# непрочитанное приложением тело запроса такого размера дочитывается, чтобы сохранить keep-alive соединение
+DRAIN_MAX = 64 * 1024
+
+
+def accept_encoding(header: str):
+    """
+    Сжатие ответа по заголовку Accept-Encoding: gzip, deflate или None
+    """
+    allowed = set()
+    for x in (header or '').lower().split(','):
+        name, _, params = x.strip().partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        allowed.add(name.strip())
+    for x in ('gzip', 'deflate'):
+        if x in allowed:
+            return x
+
+
+def binary_codecs() -> dict:
+    """
+    Кодеки по Content-Type запроса, кроме JSON: MessagePack, если установлен msgpack
+    """
+    try:
+        c = Codec.get('msgpack')
+    except ImportError:
+        return {}
+    return {x: c for x in ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')}
+
+
+def compressor(encoding: str, level: int = 6):
+    # deflate в HTTP - это формат zlib, gzip - с заголовком gzip
+    return zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+
+
+def compress(data: bytes, encoding: str, level: int = 6) -> bytes:
+    c = compressor(encoding, level)
+    return c.compress(data) + c.flush()
+
+
+def close_streams(response):
+    # клиент ушел, не дочитав ответ: потоковые результаты закрываются, транзакции откатываются
+    for x in response if isinstance(response, list) else (response,):
+        if isinstance(x, dict) and is_stream(x.get('result')) and hasattr(x['result'], 'close'):
+            x['result'].close()
+
+
+async def aclose_streams(response):
+    for x in response if isinstance(response, list) else (response,):
+        if isinstance(x, dict) and is_stream(x.get('result')):
+            close = getattr(x['result'], 'aclose', None) or x['result'].close
+            ret = close()
+            if ret is not None:
+                await ret
+
+
+class HTTPApp:
+    """
+    Общие настройки WSGI и ASGI приложений
+    """
+    max_body = 10 * 1024 * 1024
+
+    def __init__(self, rpc: RPC, max_body: int = max_body, compress_min: int = COMPRESS_MIN,
+                 compress_level: int = 6, content_type: str = 'application/json', codecs: dict = None):
+        """
+        :param rpc: RPC, в который передается тело запроса
+        :param max_body: лимит размера запроса, больше - ответ 413
+        :param compress_min: сжимать ответы от этого размера, если клиент принимает gzip или deflate.
+        потоковые ответы сжимаются всегда. None - не сжимать
+        :param content_type: Content-Type ответов в JSON
+        :param codecs: Content-Type запроса -> Codec, в котором разбирается запрос и кодируется ответ.
+        по умолчанию binary_codecs(), остальные запросы - в JSON кодеке RPC
+        """
+        self.rpc = rpc
+        self.max_body = max_body
+        self.compress_min = compress_min
+        self.compress_level = compress_level
+        self.content_type = content_type
+        self.codecs = binary_codecs() if codecs is None else codecs
+
+    def codec(self, content_type: str):
+        # кодек запроса, None - JSON кодек RPC
+        return self.codecs.get((content_type or '').partition(';')[0].strip().lower()) if self.codecs else None
+
+    def encoding(self, header: str):
+        return accept_encoding(header) if self.compress_min is not None else None
+
+    def body(self, response, encoding):
+        """
+        Статус, заголовки и тело для ответа RPC, которые не пишутся по частям. None - ответа нет (уведомления)
+        """
+        if response is None:
+            return '204 No Content', [], b''
+        return self.packed(self.rpc.codec.dumpb(response), encoding, self.content_type)
+
+    def packed(self, data: bytes, encoding, content_type: str):
+        """
+        Статус, заголовки и тело для уже закодированного ответа. Пустой ответ - уведомления
+        """
+        if not data:
+            return '204 No Content', [], b''
+        headers = [('Content-Type', content_type), ('Vary', 'Accept-Encoding')]
+        if encoding and len(data) >= self.compress_min:
+            data = compress(data, encoding, self.compress_level)
+            headers.append(('Content-Encoding', encoding))
+        headers.append(('Content-Length', str(len(data))))
+        return '200 OK', headers, data
+
+    def stream_headers(self, encoding) -> list:
+        headers = [('Content-Type', self.content_type), ('Vary', 'Accept-Encoding')]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        return headers
+
+
+class WSGIApp(HTTPApp):
+    """
+    WSGI приложение: тело POST запроса передается в RPC как есть. Потоковые результаты SQL методов
+    пишутся по мере чтения из БД (см. RPC.stream). Keep-alive обеспечивает сервер: у непотоковых
+    ответов всегда есть Content-Length
+    """
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') != 'POST':
+            start_response('405 Method Not Allowed', [('Allow', 'POST'), ('Content-Length', '0')])
+            return []
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or -1)
+        except ValueError:
+            length = -1
+        if length > self.max_body:
+            start_response('413 Payload Too Large', [('Content-Length', '0')])
+            return []
+        body = environ['wsgi.input'].read(length if length >= 0 else self.max_body + 1)
+        if len(body) > self.max_body:
+            start_response('413 Payload Too Large', [('Content-Length', '0')])
+            return []
+
+        encoding = self.encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        codec = self.codec(environ.get('CONTENT_TYPE'))
+        if codec is not None:
+            status, headers, data = self.packed(self.rpc.handle_bytes(body, codec), encoding, codec.content_type)
+            start_response(status, headers)
+            return [data] if data else []
+        response = self.rpc(body)
+        if has_streams(response):
+            start_response('200 OK', self.stream_headers(encoding))
+            return self.__stream(response, encoding)
+        status, headers, data = self.body(response, encoding)
+        start_response(status, headers)
+        return [data] if data else []
+
+    def __stream(self, response, encoding):
+        c = compressor(encoding, self.compress_level) if encoding else None
+        try:
+            for x in iterencode(response, self.rpc.codec.dumps):
+                x = x.encode('utf-8')
+                if c is not None:
+                    x = c.compress(x)
+                if x:
+                    yield x
+            if c is not None:
+                yield c.flush()
+        finally:
+            close_streams(response)
+
+
+class ASGIApp(HTTPApp):
+    """
+    ASGI приложение, вызовы через RPC.acall. При старте сервера (lifespan) функции, зарегистрированные
+    строкой, импортируются в фоне (см. RPC.preload)
+    """
+
+    def __init__(self, rpc, preload: bool = True, **kwargs):
+        HTTPApp.__init__(self, rpc, **kwargs)
+        self.preload = preload
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.__lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if scope.get('method') != 'POST':
+            return await self.__empty(send, 405, [(b'allow', b'POST')])
+        headers = dict((x.lower(), y) for x, y in scope.get('headers') or ())
+        try:
+            length = int(headers.get(b'content-length', -1))
+        except ValueError:
+            length = -1
+        if length > self.max_body:
+            return await self.__empty(send, 413)
+
+        body, more = [], True
+        size = 0
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            x = message.get('body', b'')
+            size += len(x)
+            if size > self.max_body:
+                return await self.__empty(send, 413)
+            body.append(x)
+            more = message.get('more_body', False)
+
+        encoding = self.encoding(headers.get(b'accept-encoding', b'').decode('latin-1'))
+        codec = self.codec(headers.get(b'content-type', b'').decode('latin-1'))
+        if codec is not None:
+            data = await self.rpc.ahandle_bytes(b''.join(body), codec)
+            status, headers, data = self.packed(data, encoding, codec.content_type)
+        else:
+            response = await self.rpc.acall(b''.join(body))
+            if has_streams(response):
+                return await self.__stream(send, response, encoding)
+            status, headers, data = self.body(response, encoding)
+        await send({'type': 'http.response.start', 'status': int(status[:3]), 'headers': encode_headers(headers)})
+        await send({'type': 'http.response.body', 'body': data})
+
+    async def __stream(self, send, response, encoding):
+        c = compressor(encoding, self.compress_level) if encoding else None
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': encode_headers(self.stream_headers(encoding))})
+            async for x in aiterencode(response, self.rpc.codec.dumps):
+                x = x.encode('utf-8')
+                if c is not None:
+                    x = c.compress(x)
+                if x:
+                    await send({'type': 'http.response.body', 'body': x, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': c.flush() if c is not None else b''})
+        finally:
+            await aclose_streams(response)
+
+    @staticmethod
+    async def __empty(send, status: int, headers=()):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-length', b'0')] + list(headers)})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def __lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.preload:
+                    self.rpc.preload(background=True)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def encode_headers(headers) -> list:
+    return [(x.lower().encode('latin-1'), y.encode('latin-1')) for x, y in headers]
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP/1.1 с keep-alive для WSGI приложения: ответы без Content-Length пишутся с Transfer-Encoding: chunked
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 75  # сколько держать простаивающее keep-alive соединение
+
+    def do_POST(self):
+        self.__run()
+
+    do_GET = do_PUT = do_DELETE = do_PATCH = do_HEAD = do_POST
+
+    def __run(self):
+        self.server.begin(self.connection)
+        try:
+            self.__handle()
+        finally:
+            if self.server.end(self.connection):
+                self.close_connection = True
+
+    def __handle(self):
+        app = self.server.app
+        length = self.headers.get('Content-Length')
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            body = self.__chunked(getattr(app, 'max_body', HTTPApp.max_body))
+            if body is None:
+                self.__error(413)
+                return
+            length = len(body)
+        else:
+            length = int(length) if length and length.isdigit() else 0
+            body = None
+        stream = RequestBody(self.rfile, length) if body is None else RequestBody(io.BytesIO(body), length)
+        path, _, query = self.path.partition('?')
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'CONTENT_LENGTH': str(length),
+            'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+            'SERVER_NAME': self.server.server_address[0],
+            'SERVER_PORT': str(self.server.server_address[1]),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0] if self.client_address else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': stream,
+            'wsgi.errors': io.StringIO(),
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for x, y in self.headers.items():
+            environ.setdefault('HTTP_' + x.upper().replace('-', '_'), y)
+
+        state = {}
+
+        def start_response(status, headers, exc_info=None):
+            state['status'], state['headers'] = status, headers
+
+        result, chunks = None, ()
+        try:
+            result = app(environ, start_response)
+            # PEP 3333: приложение может вызвать start_response только при первой итерации
+            chunks = iter(result)
+            first = next(chunks, None)
+            if 'status' not in state:
+                raise RuntimeError('WSGI application did not call start_response')
+        except Exception:
+            traceback.print_exc()
+            self.__close(result)
+            self.__error(500)
+            return
+        try:
+            code, _, reason = state['status'].partition(' ')
+            self.send_response(int(code), reason)
+            headers = state['headers']
+            chunked = not any(x.lower() == 'content-length' for x, y in headers)
+            for x, y in headers:
+                self.send_header(x, y)
+            if chunked and self.request_version != 'HTTP/1.1':
+                # клиент HTTP/1.0: конец ответа - закрытие соединения
+                chunked = False
+                self.close_connection = True
+            elif chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+            if 0 < stream.remaining <= DRAIN_MAX:
+                stream.read()
+            if stream.remaining > 0 or self.server.stopping:
+                # тело запроса не прочитано (например, 413) или сервер останавливается - соединение дальше не нужно
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            self.end_headers()
+            for x in itertools.chain((first,), chunks) if first is not None else chunks:
+                if not x:
+                    continue
+                if chunked:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(x), x))
+                else:
+                    self.wfile.write(x)
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except Exception:
+            # заголовки уже отправлены: ответ обрывается вместе с соединением
+            self.close_connection = True
+            raise
+        finally:
+            self.__close(result)
+
+    @staticmethod
+    def __close(result):
+        close = getattr(result, 'close', None)
+        if close:
+            close()
+
+    def __error(self, code: int):
+        self.close_connection = True
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+
+    def __chunked(self, limit: int):
+        # тело с Transfer-Encoding: chunked, None - больше limit
+        ret, size = [], 0
+        while True:
+            n = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+            if n == 0:
+                while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(ret)
+            size += n
+            if size > limit:
+                return None
+            ret.append(self.rfile.read(n))
+            self.rfile.readline()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RequestBody:
+    """
+    wsgi.input, который не дает прочитать больше Content-Length: за телом в keep-alive соединении
+    идет следующий запрос
+    """
+
+    def __init__(self, rfile, length: int):
+        self.__rfile = rfile
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b''
+        ret = self.__rfile.read(size)
+        self.remaining -= len(ret)
+        return ret
+
+    def readline(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        ret = self.__rfile.readline(size)
+        self.remaining -= len(ret)
+        return ret
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, app, bind_and_activate: bool = True):
+        self.app = app
+        self.active = 0  # выполняющиеся запросы
+        self.stopping = False
+        self.__idle = set()  # соединения, которые ждут следующего запроса
+        self.__lock = threading.Lock()
+        http.server.ThreadingHTTPServer.__init__(self, address, RequestHandler, bind_and_activate)
+
+    def finish_request(self, request, client_address):
+        with self.__lock:
+            self.__idle.add(request)
+        try:
+            http.server.ThreadingHTTPServer.finish_request(self, request, client_address)
+        finally:
+            with self.__lock:
+                self.__idle.discard(request)
+
+    def begin(self, connection):
+        with self.__lock:
+            self.active += 1
+            self.__idle.discard(connection)
+
+    def end(self, connection) -> bool:
+        """
+        Запрос выполнен. True - сервер останавливается, соединение надо закрыть
+        """
+        with self.__lock:
+            self.active -= 1
+            if not self.stopping:
+                self.__idle.add(connection)
+            return self.stopping
+
+    def close_idle(self):
+        """
+        Плавная остановка: простаивающие keep-alive соединения закрываются сразу,
+        остальные - после ответа на выполняющийся запрос (с Connection: close)
+        """
+        with self.__lock:
+            self.stopping = True
+            idle, self.__idle = self.__idle, set()
+        for x in idle:
+            try:
+                # поток соединения, ждущий следующий запрос, получит конец потока и завершится
+                x.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def handle_error(self, request, client_address):
+        # клиент закрыл соединение - не ошибка сервера
+        if not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            http.server.ThreadingHTTPServer.handle_error(self, request, client_address)
+
+
+def make_server(rpc_or_app, host: str = '127.0.0.1', port: int = 8000, **options) -> HTTPServer:
+    """
+    Многопоточный HTTP/1.1 сервер с keep-alive. rpc_or_app - RPC (тогда options - параметры WSGIApp),
+    либо готовое WSGI приложение
+    """
+    app = WSGIApp(rpc_or_app, **options) if isinstance(rpc_or_app, RPC) else rpc_or_app
+    return HTTPServer((host, port), app)
+
+
+def serve(rpc_or_app, host: str = '127.0.0.1', port: int = 8000, **options):
+    server = make_server(rpc_or_app, host, port, **options)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,201 @@
+"""
+Замеры горячих путей: разбор и диспетчеризация вызовов, маппинг параметров, разбор SQL скриптов,
+выборки из SQLite в памяти.
+
+    python bench.py                          # все замеры
+    python bench.py --quick                  # без выборки в 1M строк и с меньшим числом повторов
+    python bench.py --out new.json           # сохранить результаты
+    python bench.py --compare bench_baseline.json [--threshold 0.25]
+
+При --compare код возврата 1, если какой-то замер медленнее базового больше чем на threshold.
+Код возврата 1 и без --compare, если метрики замедляют dispatch.dict больше чем на --metrics-overhead.
+Время - минимум из повторов на одну операцию, в секундах. Сравнивать имеет смысл замеры с одной машины
+"""
+import argparse, json, platform, sys, os, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from smartrpc import RPC, DBAdapter
+from smartrpc.methods import PythonMethod, SQLMethod
+from smartrpc.metrics import MethodStats
+
+ROWS = "with recursive r(i) as (select 1 union all select i + 1 from r where i < %d) " \
+       "select i as id, 'name ' || i as name, i * 0.5 as value from r"
+
+
+def bench(name: str, fn, repeat: int = 5, number: int = None) -> dict:
+    timer = timeit.Timer(fn)
+    if number is None:
+        number, t = timer.autorange()
+        number = max(number, 1)
+    times = timer.repeat(repeat=repeat, number=number)
+    ret = {"seconds": min(times) / number, "number": number, "repeat": repeat}
+    print('%-40s %12.3f us  (%d x %d)' % (name, ret['seconds'] * 1e6, repeat, number))
+    return ret
+
+
+def make_rpc(**kwargs) -> RPC:
+    rpc = RPC(**kwargs)
+    rpc.env.set_db_alias('mem', 'sqlite3', ':memory:')
+    rpc.add_python_method(lambda a, b: a - b, 'sub')
+    rpc.add_sql_method('rows', '@@mem\n' + ROWS % 10)
+    rpc.add_sql_method('one', '@@mem\nselect %(x)s as x', mapping={'x': {'to': 'x'}})
+    return rpc
+
+
+def dispatch_cases(repeat):
+    ret = {}
+    for suffix, rpc in (('', make_rpc(metrics=True)), ('.nometrics', make_rpc(metrics=False))):
+        msg = {"jsonrpc": "2.0", "method": "sub", "params": [5, 3], "id": 1}
+        txt = json.dumps(msg)
+        ret['dispatch.dict' + suffix] = bench('dispatch.dict' + suffix, lambda: rpc(msg), repeat)
+        ret['dispatch.str' + suffix] = bench('dispatch.str' + suffix, lambda: rpc(txt), repeat)
+        ret['dispatch.args' + suffix] = bench('dispatch.args' + suffix, lambda: rpc('sub', 5, 3), repeat)
+        ret['dispatch.bytes' + suffix] = bench('dispatch.bytes' + suffix,
+                                               lambda: rpc.handle_bytes(txt.encode('utf-8')), repeat)
+    stats = MethodStats()
+
+    def record():
+        # замеры одного вызова python метода, как в RPC.__dispatch и PythonMethod.__call__
+        stats.count()
+        if stats.sampled():
+            stats.observe('call', 2e-5)
+        if stats.sampled_stages():
+            stats.timed(1e-6, 1e-5)
+    ret['dispatch.metrics.record'] = bench('dispatch.metrics.record', record, repeat)
+    rpc = make_rpc()
+    batch = [{"jsonrpc": "2.0", "method": "sub", "params": [n, 1], "id": n} for n in range(20)]
+    ret['dispatch.batch20'] = bench('dispatch.batch20', lambda: rpc(batch), repeat)
+    ret['dispatch.sql'] = bench('dispatch.sql', lambda: rpc('one', x=1), repeat)
+    ret['dispatch.sql.rows10'] = bench('dispatch.sql.rows10', lambda: rpc('rows'), repeat)
+    return ret
+
+
+def mapping_cases(repeat):
+    rpc = RPC(metrics=False)
+    f2 = lambda a, b: a - b
+    f1 = lambda x: x
+    fe = lambda x, env: x
+    f3 = lambda a, b, c: a
+    cases = (
+        ('args.list', PythonMethod(rpc, f2, RPC.MAP_ARGS), (5, 3), {}),
+        ('args.dict', PythonMethod(rpc, f2, RPC.MAP_ARGS), (), {'a': 5, 'b': 3}),
+        ('json', PythonMethod(rpc, f1, RPC.MAP_JSON), (), {'a': 5, 'b': 3}),
+        ('json_env', PythonMethod(rpc, fe, RPC.MAP_JSON_ENV), (), {'a': 5, 'b': 3}),
+        ('named', PythonMethod(rpc, f2, {'X': {'to': 'a'}, 'Y': {'to': 'b', 'default': 1}}), (), {'X': 5}),
+        ('positional', PythonMethod(rpc, f2, {'X': {'to': 1, 'default': 2}, 'Y': {'to': 0}}), (), {'Y': 5}),
+        ('positional.sparse', PythonMethod(rpc, f3, {'X': {'to': 0}, 'Y': {'to': 2}}), (), {'X': 5, 'Y': 3}),
+        ('callable', PythonMethod(rpc, f2, lambda m: (m['params']['a'], m['params']['b'])),
+         ({'params': {'a': 5, 'b': 3}},), {}),
+    )
+    ret = {}
+    for name, method, args, kwargs in cases:
+        ret['mapping.' + name] = bench('mapping.' + name, lambda: method(*args, **kwargs), repeat)
+    return ret
+
+
+def script(aliases: int, queries: int) -> str:
+    ret = []
+    for n in range(aliases):
+        ret.append('@@alias%d' % n)
+        for m in range(queries):
+            ret.append("/* запрос %d */ select id, name from test where name = 'a;b' and id > %%(id)s;" % m)
+            ret.append("update test set name = 'x' where id = %(id)s;")
+    return '\n'.join(ret)
+
+
+def parse_cases(repeat):
+    rpc = RPC(metrics=False)
+    ret = {}
+    for aliases, queries in ((1, 1), (10, 10), (50, 40)):
+        name = 'parse.%dx%d' % (aliases, queries)
+        query = script(aliases, queries)
+        ret[name] = bench(name, lambda: SQLMethod(rpc, query, None, RPC.MAP_ARGS), repeat)
+    return ret
+
+
+def dicts_cases(repeat, quick):
+    adapter = DBAdapter.get('sqlite3', ':memory:')
+    ret = {}
+    for rows in (1000, 100000) if quick else (1000, 100000, 1000000):
+        name = 'sqlite.dicts%s' % ('%dk' % (rows // 1000) if rows < 1000000 else '%dm' % (rows // 1000000))
+        query = ROWS % rows
+        ret[name] = bench(name, lambda: adapter.dicts(query), repeat if rows < 100000 else min(repeat, 3),
+                          None if rows < 100000 else 1)
+    adapter.rollback()
+    return ret
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    ok = True
+    print('\n%-40s %12s %12s %8s' % ('', 'baseline', 'now', 'ratio'))
+    for name, x in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        ratio = x['seconds'] / old['seconds'] if old['seconds'] else 1.0
+        mark = ''
+        if ratio > 1 + threshold:
+            mark, ok = '  REGRESSION', False
+        print('%-40s %10.3f us %10.3f us %7.2fx%s' % (name, old['seconds'] * 1e6, x['seconds'] * 1e6, ratio, mark))
+    return ok
+
+
+def metrics_overhead(limit: float, rounds: int = 60, attempts: int = 3) -> bool:
+    """
+    Во сколько включенные метрики замедляют самый короткий путь вызова. Короткие серии вызовов с метриками
+    и без чередуются, чтобы на замер не влияли изменения частоты процессора и фоновая нагрузка.
+    Замер над лимитом повторяется до attempts раз: шум бывает разовым, настоящее замедление - нет
+    """
+    msg = {"jsonrpc": "2.0", "method": "sub", "params": [5, 3], "id": 1}
+    on, off = make_rpc(metrics=True), make_rpc(metrics=False)
+    for _ in range(attempts):
+        t_on = t_off = float('inf')
+        for _ in range(rounds):
+            t_on = min(t_on, timeit.timeit(lambda: on(msg), number=2000))
+            t_off = min(t_off, timeit.timeit(lambda: off(msg), number=2000))
+        overhead = t_on / t_off - 1
+        print('\nmetrics overhead on dispatch.dict: %.0f%% (limit %.0f%%)' % (overhead * 100, limit * 100))
+        if overhead <= limit:
+            return True
+    return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SmartRPC benchmarks')
+    parser.add_argument('--quick', action='store_true', help='skip the 1M rows case, fewer repeats')
+    parser.add_argument('--out', help='write results as JSON')
+    parser.add_argument('--compare', help='baseline JSON to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown, 0.25 = 25%%')
+    parser.add_argument('--metrics-overhead', type=float, default=0.2,
+                        help='allowed slowdown of dispatch.dict with metrics, 0.2 = 20%%')
+    parser.add_argument('--filter', default='', help='run only benchmarks with this prefix')
+    args = parser.parse_args(argv)
+    repeat = 3 if args.quick else 5
+
+    results = {}
+    for prefix, fn in (('dispatch', lambda: dispatch_cases(repeat)), ('mapping', lambda: mapping_cases(repeat)),
+                       ('parse', lambda: parse_cases(repeat)), ('sqlite', lambda: dicts_cases(repeat, args.quick))):
+        if prefix.startswith(args.filter) or args.filter.startswith(prefix):
+            results.update({x: y for x, y in fn().items() if x.startswith(args.filter)})
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({
+                "python": platform.python_version(),
+                "implementation": platform.python_implementation(),
+                "machine": platform.machine(),
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+    ok = True
+    if 'dispatch'.startswith(args.filter) or args.filter.startswith('dispatch'):
+        ok = metrics_overhead(args.metrics_overhead)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        ok = compare(results, baseline, args.threshold) and ok
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,10 @@
-import unittest
+import unittest, asyncio, json, time, datetime, decimal
 from smartrpc import RPC, DBAdapter
+from smartrpc.env import BaseEnv
+from smartrpc.err import ErrorRPC
+from smartrpc.codec import Codec
+from smartrpc.statement import Statement, StatementCache
+from smartrpc.script import tokenize, ScriptCache
 
 rpc = RPC()
 
@@ -16,6 +21,11 @@ def substract(minued, subtrahed):
 def test(x, env):
     return [x, env]
 
+@rpc.python_method(name='ASUB')
+async def asubstract(minued, subtrahed):
+    await asyncio.sleep(0)
+    return minued - subtrahed
+
 @rpc.sql_method
 def fn_sql():
     rpc.env.set_db_alias('tSQL', 'sqlite3', 'test_db.sqlite')
@@ -67,6 +77,17 @@ class Tests(unittest.TestCase):
         })
         print(x)
 
+    def test_mapping_plans(self):
+        r = RPC()
+        r.add_python_method(lambda *x: x, 'sparse', {'A': {'to': 2}, 'B': {'to': 0, 'default': 5}})
+        r.add_python_method(lambda **x: x, 'named', {'A': {'to': 'a'}, 'B': {'default': 1}})
+        r.add_python_method(lambda x: x, 'json', RPC.MAP_JSON)
+        r.add_python_method(lambda x, y: x + y, 'fn', lambda m: (m['params']['a'], m['params']['b']))
+        self.assertEqual(r('sparse', A=1), (5, None, 1))
+        self.assertEqual(r('named', A=2), {'a': 2, 'B': 1})
+        self.assertEqual(r('json', 1, 2), (1, 2))
+        self.assertEqual(r({"jsonrpc": "2.0", "method": "fn", "params": {"a": 1, "b": 2}, "id": 1})['result'], 3)
+
     def test_simple(self):
         x = rpc('SUB', X=3, Y=7)
         print(x)
@@ -114,5 +135,706 @@ class Tests(unittest.TestCase):
         x = rpc('fn_sql')
         print(x)
 
+    def test_batch(self):
+        x = rpc([
+            {"jsonrpc": "2.0", "method": "substract", "params": [42, 23], "id": 1},
+            {"jsonrpc": "2.0", "method": "substract", "params": [23, 42]},
+            {"jsonrpc": "2.0", "method": "unknown", "id": "3"},
+            1,
+            {"jsonrpc": "2.0", "method": "SUB", "params": {"X": 3, "Y": 7}, "id": 4},
+        ])
+        print(x)
+        self.assertEqual([r['id'] for r in x], [1, "3", None, 4])
+        self.assertEqual(x[0]['result'], 19)
+        self.assertEqual(x[1]['error']['code'], -32601)
+        self.assertEqual(x[2]['error']['code'], -32600)
+        self.assertEqual(x[3]['result'], 4)
+
+        self.assertIsNone(rpc('[{"jsonrpc": "2.0", "method": "substract", "params": [1, 2]}]'))
+        self.assertEqual(rpc('[]')['error']['code'], -32600)
+
+    def test_acall(self):
+        async def calls():
+            return await asyncio.gather(
+                rpc.acall({"jsonrpc": "2.0", "method": "ASUB", "params": [42, 23], "id": 1}),
+                rpc.acall('SUB', X=3, Y=7),
+                rpc.acall('fn_sql'),
+                rpc.acall('[{"jsonrpc": "2.0", "method": "substract", "params": [1, 2], "id": 3}]'),
+            )
+        x = asyncio.run(calls())
+        print(x)
+        self.assertEqual(x[0]['result'], 19)
+        self.assertEqual(x[1], 4)
+        self.assertEqual(x[2], rpc('fn_sql'))
+        self.assertEqual(x[3][0]['result'], -1)
+        self.assertEqual(rpc('ASUB', 5, 3), 2)
+
+    def test_stream(self):
+        rpc.env.set_db_alias('MEM', 'sqlite3', ':memory:')
+        rpc.add_sql_method('series', """
+        @@MEM
+        with recursive r(n) as (select 1 union all select n + 1 from r where n < %(count)s) select n from r
+        """, stream=True)
+
+        x = rpc('series', count=2500)
+        self.assertEqual(sum(1 for _ in x), 2500)
+        self.assertEqual(rpc.env.pool('MEM').idle, 1)
+
+        x = json.loads(''.join(rpc.stream({"jsonrpc": "2.0", "method": "series", "params": {"count": 2500}, "id": 7})))
+        self.assertEqual(x['id'], 7)
+        self.assertEqual(x['result'][-1], {'n': 2500})
+
+        async def astream():
+            return ''.join([x async for x in rpc.astream('{"jsonrpc": "2.0", "method": "series", "params": {"count": 3}, "id": 8}')])
+        x = json.loads(asyncio.run(astream()))
+        print(x)
+        self.assertEqual(x['result'], [{'n': 1}, {'n': 2}, {'n': 3}])
+        self.assertEqual(rpc.env.pool('MEM').idle, 1)
+
+    def test_statement(self):
+        st = Statement("select * from test where id = %(id)s or name = '%(name)s' or id = %(id)s and name like 'a%%'")
+        self.assertEqual(st.compile('named')[0],
+                         "select * from test where id = :id or name = :name or id = :id and name like 'a%'")
+        self.assertEqual(st.compile('dollar'), (
+            "select * from test where id = $1 or name = $2 or id = $1 and name like 'a%'", ('id', 'name')))
+        self.assertEqual(st.bind('qmark', {'id': 1, 'name': 'x'})[1], [1, 'x', 1])
+        self.assertEqual(st.bind('pyformat', {'id': 1, 'name': 'x', 'z': 0})[1], {'id': 1, 'name': 'x'})
+        with self.assertRaises(ErrorRPC):
+            st.bind('named', {'id': 1})
+
+        a = DBAdapter.get('sqlite3', 'test_db.sqlite')
+        self.assertEqual(a.dicts('select * from test where id = %(id)s', id=2), [{'id': 2, 'name': 'sasd'}])
+        self.assertEqual(a.dicts("select * from test where name = '%(name)s'", name="' or 1=1 --"), [])
+        # %% - это % и без параметров, и с ними
+        self.assertEqual(Statement("select '5%%'").compile('pyformat')[0], "select '5%'")
+        self.assertEqual(a.dicts("select '5%%' as p"), [{'p': '5%'}])
+        self.assertEqual(a.dicts("select '5%%' as p, %(a)s as a", a=1), [{'p': '5%', 'a': 1}])
+        self.assertEqual(a.dicts(Statement("select '5%%' as p")), [{'p': '5%'}])
+        # параметр внутри литерала драйвер не подставит - ошибка при регистрации метода
+        r = RPC()
+        r.env.set_db_alias('S', 'sqlite3', 'test_db.sqlite')
+        with self.assertRaises(ErrorRPC) as e:
+            r.add_sql_method('like', "@@S\nselect * from test where name like '%(p)s%%'")
+        self.assertEqual(e.exception.code, -32700)
+        r.add_sql_method('like', "@@S\n-- it's a prefix\nselect * from test where name like %(p)s || '%%'")
+        self.assertEqual(r('like', p='sa'), [{'id': 2, 'name': 'sasd'}])
+        a.rollback()
+
+    def test_statement_cache(self):
+        freed = []
+        cache = StatementCache(2, freed.append)
+        a, b = cache.add('select 1'), cache.add('select 2')
+        self.assertEqual(cache.get('select 1'), a)
+        self.assertIsNone(cache.get('select 3'))
+        cache.add('select 3')
+        self.assertEqual(freed, [b])  # вытеснен давно не использованный
+        self.assertEqual((cache.hits, cache.misses, cache.evictions, len(cache)), (1, 1, 1, 2))
+        self.assertTrue(cache.dirty)
+        cache.committed()
+        self.assertFalse(cache.dirty)
+
+    def test_cache(self):
+        r = RPC()
+        r.env.set_db_alias('C', 'sqlite3', ':memory:', pool={'max_size': 1})
+        a = r.env.connect('C')
+        a.dml('create table ref(id int, name text)')
+        a.commit()
+        r.add_sql_method('ref_list', "@@C\nselect * from ref order by id", cache=60)
+        r.add_sql_method('ref_add', "@@C\ninsert into ref values(%(id)s, %(name)s)")
+
+        self.assertEqual(r('ref_list'), [])
+        a = r.env.connect('C')
+        a.dml("insert into ref values(1, 'a')")
+        self.assertEqual(r('ref_list'), [])  # до commit кэш не сбрасывается
+        a.commit()
+        self.assertEqual(len(r('ref_list')), 1)
+        r('ref_add', id=2, name='b')
+        self.assertEqual(len(r('ref_list')), 2)
+
+        calls = []
+
+        @r.python_method(name='slow', cache=60)
+        def slow(x):
+            calls.append(x)
+            time.sleep(0.05)
+            return x * 2
+
+        x = r([{"jsonrpc": "2.0", "method": "slow", "params": [21], "id": n} for n in range(8)])
+        self.assertEqual([y['result'] for y in x], [42] * 8)
+        self.assertEqual(calls, [21])
+        self.assertEqual(r('slow', x=3), 6)
+        self.assertEqual(len(calls), 2)
+
+        # изменение результата одним вызовом не видно другим
+        x = r('ref_list')
+        x[0]['name'] = 'changed'
+        x.append(None)
+        self.assertEqual(r('ref_list'), [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}])
+
+    def test_handle_bytes(self):
+        for codec in (None, Codec.get('json'), Codec.best()):
+            r = RPC(codec=codec)
+            r.add_python_method(lambda: [datetime.date(2020, 1, 2), decimal.Decimal('1.10'), b'\x00'], 'types')
+            r.add_python_method(lambda a, b: a - b, 'sub')
+            x = r.handle_bytes(b'[{"jsonrpc": "2.0", "method": "sub", "params": [5, 3], "id": 1},'
+                               b' {"jsonrpc": "2.0", "method": "types", "id": 2}]')
+            self.assertIsInstance(x, bytes)
+            print(r.codec.module_name(), x)
+            x = json.loads(x)
+            self.assertEqual(x[0]['result'], 2)
+            self.assertEqual(x[1]['result'], ['2020-01-02', '1.10', 'AA=='])
+            self.assertEqual(r.handle_bytes(b'{"jsonrpc": "2.0", "method": "sub", "params": [5, 3]}')[:1], b'{')
+            self.assertEqual(r.handle_bytes(b'[{"jsonrpc": "2.0", "method": "sub", "params": [5, 3]}]'), b'')
+            self.assertEqual(json.loads(r.handle_bytes(b'{'))['error']['code'], -32700)
+
+    @unittest.skipUnless(__import__('importlib').util.find_spec('msgpack'), 'no msgpack')
+    def test_msgpack(self):
+        import io, msgpack
+        from smartrpc.transport import WSGIApp
+        codec = Codec.get('msgpack')
+        r = RPC()
+        r.env.set_db_alias('MP', 'sqlite3', ':memory:')
+        r.add_sql_method('blob', "@@MP\nselect x'00ff' b, 1 n")
+        r.add_sql_method('blobs', "@@MP\nselect x'00ff' b", stream=True)
+        r.add_python_method(lambda: [datetime.datetime(2020, 1, 2, 3, 4, 5), decimal.Decimal('1.10'),
+                                     memoryview(b'\x01')], 'types')
+        x = codec.loads(r.handle_bytes(msgpack.packb([{"jsonrpc": "2.0", "method": x, "id": n}
+                                                      for n, x in enumerate(('blob', 'types', 'blobs'))]), codec))
+        self.assertEqual(x[0]['result'], [{'b': b'\x00\xff', 'n': 1}])
+        self.assertEqual(x[1]['result'], [datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+                                          decimal.Decimal('1.10'), b'\x01'])
+        self.assertEqual(x[2]['result'], [{'b': b'\x00\xff'}])
+        self.assertEqual(r.env.pool('MP').idle, 1)
+        self.assertEqual(codec.loads(r.handle_bytes(b'\xc1', codec))['error']['code'], -32700)
+        x = asyncio.run(r.ahandle_bytes(msgpack.packb({"jsonrpc": "2.0", "method": "blobs", "id": 1}), codec))
+        self.assertEqual(codec.loads(x)['result'], [{'b': b'\x00\xff'}])
+
+        state = {}
+        body = msgpack.packb({"jsonrpc": "2.0", "method": "blob", "id": 1})
+        x = WSGIApp(r)({'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'application/msgpack',
+                        'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)},
+                       lambda status, headers: state.update(headers))
+        self.assertEqual(state['Content-Type'], 'application/msgpack')
+        self.assertEqual(codec.loads(b''.join(x))['result'][0]['b'], b'\x00\xff')
+
+    def test_format(self):
+        rpc.add_sql_method('test_rows', "@@SQL3\nselect * from test order by id", format='rows')
+        rpc.env.set_db_alias('SQL3', 'sqlite3', 'test_db.sqlite')
+        x = rpc('test_rows')
+        print(x)
+        self.assertEqual(x['columns'], ['id', 'name'])
+        self.assertEqual([list(y) for y in x['rows']], [[1, 'aaaa'], [2, 'sasd']])
+
+        x = rpc({"jsonrpc": "2.0", "method": "test_rows", "format": "arrays", "id": 1})['result']
+        self.assertEqual(x['arrays'], [[1, 2], ['aaaa', 'sasd']])
+        x = rpc({"jsonrpc": "2.0", "method": "test_rows", "format": "dicts", "id": 1})['result']
+        self.assertEqual(x[0], {'id': 1, 'name': 'aaaa'})
+        x = rpc({"jsonrpc": "2.0", "method": "test_rows", "format": "xml", "id": 1})
+        self.assertEqual(x['error']['code'], -32602)
+
+    def test_rows(self):
+        import sys
+        from smartrpc.rows import row_factory, make_rows
+        f = [{'name': x} for x in ('id', 'name', 'from', 'count(*)')]
+        self.assertIs(row_factory(f), row_factory([dict(x) for x in f]))
+        x = make_rows([(1, 'a', 2, 3), (2, 'b', 4, 5)], f)
+        self.assertEqual(x, [{'id': 1, 'name': 'a', 'from': 2, 'count(*)': 3}, {'id': 2, 'name': 'b', 'from': 4, 'count(*)': 5}])
+        y = make_rows([(n, 'a', n, n) for n in range(100)], f)  # таблица ключей одна на все строки
+        self.assertLess(sum(map(sys.getsizeof, y)), sum(sys.getsizeof(dict(x)) for x in y))
+        x[0]['extra'] = 1
+        self.assertEqual(list(x[1]), ['id', 'name', 'from', 'count(*)'])
+        self.assertEqual(make_rows([(1, 2)], [{'name': 'a'}, {'name': 'a'}]), [{'a': 2}])
+        self.assertEqual(make_rows([(1,)], [{'name': '__class__'}]), [{'__class__': 1}])
+        self.assertEqual(rpc.env.connect('SQL3').dicts('select * from test order by id')[0], {'id': 1, 'name': 'aaaa'})
+
+    def test_pool(self):
+        env = BaseEnv()
+        env.set_db_alias('P', 'sqlite3', 'test_db.sqlite', pool={'max_size': 2, 'wait_timeout': 0.1})
+        pool = env.pool('P')
+
+        a = env.connect('P')
+        print(a.one('select name from test where id = ?', (2,)))
+        a.commit()
+        b = env.connect('P')
+        b.one('select 1')
+        self.assertEqual(pool.size, 1)  # соединение взято из пула, а не открыто заново
+        c = env.connect('P')
+        c.one('select 1')
+        self.assertEqual(pool.size, 2)
+        with self.assertRaises(ErrorRPC):
+            env.connect('P').one('select 1')
+        b.rollback()
+        c.commit()
+        self.assertEqual(pool.idle, 2)
+        pool.close()
+        self.assertEqual(pool.size, 0)
+
+    def test_metrics(self):
+        r = RPC(metrics=True)
+        r.add_python_method(lambda a, b: a - b, 'sub')
+        r.add_sql_method('one', "@@M\nselect name from test where id = %(id)s", mapping={'id': {'to': 'id'}})
+        r.env.set_db_alias('M', 'sqlite3', 'test_db.sqlite')
+        r('sub', 5, 3)
+        r({"jsonrpc": "2.0", "method": "sub", "params": [1], "id": 1})
+        r({"jsonrpc": "2.0", "method": "one", "params": {"id": 2}, "id": 2})
+        r({"jsonrpc": "2.0", "method": "nope", "id": 3})
+        x = r('rpc.stats')
+        print(x)
+        self.assertEqual(x['sub']['calls'], 2)
+        self.assertEqual(x['sub']['errors'], {'-32602': 1})
+        self.assertEqual(set(x['one']['stages']), {'call', 'alias#0', 'sql#1', 'commit'})
+        self.assertEqual(x['']['errors'], {'-32601': 1})
+        self.assertIn('smartrpc_calls_total{method="sub"} 2', r.metrics.prometheus())
+        r.metrics.reset()  # счетчики обнуляются на месте, методы пишут в них дальше
+        r('sub', 5, 3)
+        self.assertEqual(r('rpc.stats')['sub']['calls'], 1)
+        self.assertIsNone(RPC().metrics)  # по умолчанию выключены
+
+    def test_parallel(self):
+        r = RPC()
+        r.env.set_db_alias('A', 'sqlite3', 'test_db.sqlite')
+        r.env.set_db_alias('B', 'sqlite3', 'test_db.sqlite')
+        r.add_sql_method('dash', """
+            @@parallel
+            @@A
+            select name from test where id = 1
+            @@B
+            select count(*) as n from test
+            @@end
+        """)
+        expected = {'A': [{'name': 'aaaa'}], 'B': [{'n': 2}]}
+        self.assertEqual(r('dash'), expected)
+        self.assertEqual(asyncio.run(r.acall('dash')), expected)
+        self.assertEqual(r.env.pool('A').idle, 1)
+
+        r.add_sql_method('after', "@@parallel\n@@A\nselect 1 as x\n@@end\n@@B\nselect 2 as y")
+        self.assertEqual(r('after'), [{'y': 2}])
+        with self.assertRaises(ErrorRPC):
+            r.add_sql_method('bad', "@@parallel\n@@A\nselect 1\n@@A\nselect 2")
+
+    def test_script(self):
+        query = """
+            @@A
+            select '-- not a comment
+              @@B' as x -- comment
+            from t /* comment */ where a = 1
+            @@B
+            update t set x = 1"""
+        expected = [('@', 'A'), ('sql', "select '-- not a comment\n              @@B' as x from t  where a = 1"),
+                    ('@', 'B'), ('sql', 'update t set x = 1')]
+        self.assertEqual(tokenize(query), expected)
+
+        import tempfile
+        with tempfile.TemporaryDirectory() as path:
+            cache = ScriptCache(path)
+            self.assertEqual(cache.get(query), expected)
+            self.assertEqual(ScriptCache(path).get(query), expected)
+            self.assertEqual(cache.misses, 1)
+            r = RPC(script_cache=path)
+            r.env.set_db_alias('S', 'sqlite3', 'test_db.sqlite')
+            r.add_sql_method('s', "@@S\nselect name from test where id = 2")
+            r.add_sql_method('s2', "@@S\nselect name from test where id = 2")
+            self.assertEqual(r('s'), [{'name': 'sasd'}])
+            self.assertEqual(r.script_cache.hits, 1)
+
+    def test_lazy(self):
+        import sys, threading
+        sys.modules.pop('colorsys', None)
+        r = RPC()
+        r.add_python_method('operator:sub')
+        r.add_python_method('colorsys.rgb_to_hsv', 'hsv')
+        r.add_python_method('nope.module:fn', 'nope')
+        self.assertNotIn('colorsys', sys.modules)
+
+        threads = [threading.Thread(target=r, args=('sub', 5, 3)) for x in range(8)]
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+        self.assertEqual(r('sub', 5, 3), 2)
+        self.assertEqual(asyncio.run(r.acall('sub', 7, 3)), 4)
+
+        r.preload(background=True).join()
+        self.assertIn('colorsys', sys.modules)
+        self.assertEqual(r({"jsonrpc": "2.0", "method": "nope", "id": 1})['error']['code'], -32000)
+        with self.assertRaises(ErrorRPC):
+            r.preload()
+
+    def test_bulk(self):
+        import tempfile, os
+        with tempfile.TemporaryDirectory() as path:
+            r = RPC()
+            r.env.set_db_alias('D', 'sqlite3', os.path.join(path, 'bulk.sqlite'))
+            db = r.env.connect('D')
+            db.dml('create table t (id integer primary key, name text)')
+            report = db.dml_many('insert into t (id, name) values (%(id)s, %(name)s)',
+                                 ({'id': n, 'name': str(n)} for n in range(2500)), chunk_size=1000)
+            db.commit()
+            self.assertEqual(report, {'rows': 2500, 'chunks': 3, 'errors': []})
+
+            rows = [{'id': 3000 + n, 'name': 'x'} for n in range(10)] + [{'id': 1, 'name': 'dup'}]
+            with self.assertRaises(ErrorRPC):
+                db.dml_many('insert into t (id, name) values (%(id)s, %(name)s)', rows)
+            report = db.dml_many('insert into t (id, name) values (%(id)s, %(name)s)', rows, 5, on_error='skip')
+            db.commit()
+            self.assertEqual((report['rows'], report['chunks']), (10, 3))
+            self.assertEqual([(x['chunk'], x['offset'], x['size']) for x in report['errors']], [(2, 10, 1)])
+            self.assertEqual(r.env.connect('D').one('select count(*) from t'), 2510)
+
+            r.add_sql_method('load', "@@D\ninsert into t (id, name) values (%(id)s, %(name)s)", bulk=True)
+            x = r({"jsonrpc": "2.0", "method": "load", "params": [{'id': 5000, 'name': 'a'}, {'id': 5001, 'name': 'b'}],
+                   "id": 1})
+            self.assertEqual(x['result'], {'rows': 2, 'chunks': 1, 'errors': []})
+            x = asyncio.run(r.acall({"jsonrpc": "2.0", "method": "load", "params": {"rows": [{'id': 5000}]},
+                                     "id": 1}))
+            self.assertEqual(x['error']['code'], -32602)
+            self.assertEqual(r.env.connect('D').one('select count(*) from t'), 2512)
+            r.env.pool('D').close()
+
+    def test_replicas(self):
+        import tempfile, os
+        with tempfile.TemporaryDirectory() as path:
+            r = RPC()
+            for name in ('main', 'r1', 'r2'):
+                r.env.set_db_alias(name, 'sqlite3', os.path.join(path, name + '.sqlite'))
+                db = r.env.connect(name)
+                db.dml('create table w (name text)')
+                db.dml('insert into w values (%(name)s)', name=name)
+                db.commit()
+            r.env.set_db_alias('bad', 'sqlite3', os.path.join(path, 'no', 'such.sqlite'))
+            r.env.set_db_group('G', 'main', ['r1', 'r2', 'bad'], retry_after=60)
+            r.add_sql_method('who', '@@G\nselect name from w')
+            r.add_sql_method('put', '@@G\ninsert into w values (%(name)s)\n@@G\nselect count(*) as n from w',
+                             mapping={'name': {'to': 'name'}})
+            r.add_sql_method('lock', '@@G\nselect name from w', readonly=False)
+            got = [r({"jsonrpc": "2.0", "method": "who", "id": n}) for n in range(6)]
+            # чтение с недоступной реплики повторяется на исправной, а она исключается из группы
+            self.assertEqual({x['result'][0]['name'] for x in got}, {'r1', 'r2'})
+            self.assertEqual([x['healthy'] for x in r.env.group('G').state()], [True, True, True, False])
+            self.assertEqual({r('who')[0]['name'] for n in range(4)}, {'r1', 'r2'})
+            self.assertEqual(r('put', name='x')[0]['n'], 2)
+            self.assertEqual(r('lock')[0]['name'], 'main')
+            self.assertEqual(asyncio.run(r.acall('who'))[0]['name'] in ('r1', 'r2'), True)
+            # в async вызовах тоже: реплика снова в группе и снова отказывает
+            r.env.group('G').replicas[-1].ejected_until = 0.0
+
+            async def calls():
+                return await asyncio.gather(*(r.acall('who') for n in range(3)))
+            got = asyncio.run(calls())
+            self.assertEqual({x[0]['name'] for x in got} <= {'r1', 'r2'}, True)
+            self.assertEqual(r.env.group('G').state()[-1]['healthy'], False)
+            self.assertEqual(sum(x['outstanding'] for x in r.env.group('G').state()), 0)
+            for name in ('main', 'r1', 'r2'):
+                r.env.pool(name).close()
+
+    def test_transaction(self):
+        import tempfile, os
+        with tempfile.TemporaryDirectory() as path:
+            r = RPC()
+            r.env.set_db_alias('T', 'sqlite3', os.path.join(path, 'tx.sqlite'))
+            db = r.env.connect('T')
+            db.dml('create table t (id integer primary key)')
+            db.commit()
+            r.add_sql_method('put', '@@T\ninsert into t values (%(id)s)', mapping={'id': {'to': 'id'}})
+            r.add_sql_method('count', '@@T\nselect count(*) as n from t', cache=60)
+            self.assertEqual(r('count')[0]['n'], 0)
+            with r.transaction():
+                r('put', id=1)
+                r('put', id=2)
+                # тот же алиас - то же соединение: видны незафиксированные строки, кэш не используется
+                self.assertEqual(r('count')[0]['n'], 2)
+            self.assertEqual(r.env.connect('T').one('select count(*) from t'), 2)
+            with self.assertRaises(Exception):
+                with r.transaction():
+                    r('put', id=3)
+                    r('put', id=1)
+            self.assertEqual(r.env.connect('T').one('select count(*) from t'), 2)
+
+            batch = [{"jsonrpc": "2.0", "method": "put", "params": {"id": n}, "id": n, "transaction": True}
+                     for n in (4, 5)]
+            self.assertEqual([x['error'] for x in r(batch)], [None, None])
+            batch.append({"jsonrpc": "2.0", "method": "put", "params": {"id": 4}, "id": 6})
+            ret = asyncio.run(r.acall([dict(x, id=x['id'] + 10, params={"id": x['params']['id'] + 10})
+                                       if x['id'] != 6 else x for x in batch]))
+            self.assertEqual([x['error']['code'] for x in ret], [-32000, -32000, -32603])
+            self.assertEqual(r.env.connect('T').one('select count(*) from t'), 4)
+            self.assertEqual(r('count')[0]['n'], 4)
+
+            # обычный пакет внутри области тоже в ее транзакции
+            batch = [{"jsonrpc": "2.0", "method": "put", "params": {"id": n}, "id": n} for n in (20, 21)]
+            with self.assertRaises(ValueError):
+                with r.transaction():
+                    self.assertEqual([x['error'] for x in r(batch)], [None, None])
+                    raise ValueError('rollback')
+
+            async def abatch():
+                async with r.transaction():
+                    self.assertEqual([x['error'] for x in await r.acall(batch)], [None, None])
+                    raise ValueError('rollback')
+            with self.assertRaises(ValueError):
+                asyncio.run(abatch())
+            self.assertEqual(r.env.connect('T').one('select count(*) from t'), 4)
+            r.env.pool('T').close()
+
+    def test_limits(self):
+        import threading
+        r = RPC()
+        started, done = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            done.wait(5)
+            return 1
+
+        async def aslow():
+            await asyncio.sleep(0.05)
+            return 2
+
+        r.add_python_method(slow, 'slow', limit={'max_inflight': 1})
+        r.add_python_method(aslow, 'aslow', limit={'max_inflight': 1, 'max_queue': 1, 'queue_timeout': 5})
+        t = threading.Thread(target=r, args=('slow',))
+        t.start()
+        started.wait(5)
+        self.assertEqual(r({"jsonrpc": "2.0", "method": "slow", "id": 1})['error']['code'], -32702)
+        done.set()
+        t.join()
+        self.assertEqual(r('slow'), 1)
+
+        async def calls():
+            return await r.acall([{"jsonrpc": "2.0", "method": "aslow", "id": n} for n in range(3)])
+        ret = asyncio.run(calls())
+        self.assertEqual(sorted(str(x['result'] or x['error']['code']) for x in ret), ['-32702', '2', '2'])
+
+        r.env.set_db_alias('L', 'sqlite3', ':memory:', limit={'max_inflight': 1, 'queue_timeout': 0.05})
+        a, b = r.env.connect('L'), r.env.connect('L')
+        a.one('select 1')
+        with self.assertRaises(ErrorRPC) as e:
+            b.one('select 1')
+        self.assertEqual(e.exception.code, -32702)
+        a.commit()
+        self.assertEqual(b.one('select 1'), 1)
+        b.commit()
+
+    def test_single_flight(self):
+        import threading
+        r = RPC()
+        runs = []
+
+        def slow(x):
+            runs.append(x)
+            time.sleep(0.2)
+            if x < 0:
+                raise ValueError('negative')
+            return [x]
+
+        async def aslow(x):
+            runs.append(x)
+            await asyncio.sleep(0.1)
+            return x * 2
+
+        r.add_python_method(slow, 'slow', single_flight=True)
+        r.add_python_method(aslow, 'aslow', single_flight=True)
+        for x in (1, -1):
+            ret = []
+            threads = [threading.Thread(target=lambda: ret.append(r({"jsonrpc": "2.0", "method": "slow",
+                                                                    "params": [x], "id": 1})))
+                       for n in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(runs, [x])
+            self.assertEqual(len({json.dumps(y) for y in ret}), 1)
+            runs.clear()
+        self.assertEqual(ret[0]['error']['code'], -32603)
+
+        # ожидавшие вызовы получают копии: изменение результата одним не видно другим
+        ret = []
+        threads = [threading.Thread(target=lambda: ret.append(r('slow', x=7))) for n in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ret[0].append(8)
+        self.assertEqual(ret[1:], [[7], [7]])
+        runs.clear()
+
+        async def calls():
+            return await asyncio.gather(*(r.acall('aslow', n % 2) for n in range(6)))
+        self.assertEqual(asyncio.run(calls()), [0, 2] * 3)
+        self.assertEqual(sorted(runs), [0, 1])
+        self.assertEqual(r.flights.shared, 4 + 2 + 4)
+
+        async def arows(x):
+            await asyncio.sleep(0.05)
+            return [x]
+
+        async def mutated():
+            ret = await r.acall('arows', 1)
+            ret.append('MUTATED')
+            return ret
+
+        # первый вызов меняет свой результат, ожидавшие получили копии до этого
+        r.add_python_method(arows, 'arows', single_flight=True)
+
+        async def rows():
+            return await asyncio.gather(mutated(), r.acall('arows', 1), r.acall('arows', 1))
+        self.assertEqual(asyncio.run(rows()), [[1, 'MUTATED'], [1], [1]])
+
+    def test_timeout(self):
+        r = RPC()
+        r.env.set_db_alias('S', 'sqlite3', 'test_db.sqlite')
+        r.add_sql_method('spin', "@@S\nwith recursive c(i) as (select 1 union all select i + 1 from c) "
+                                 "select count(*) as n from c", timeout=5)
+        r.add_sql_method('quick', '@@S\nselect 1 as x')
+
+        async def nap():
+            await asyncio.sleep(5)
+
+        r.add_python_method(nap, 'nap')
+        t = time.monotonic()
+        x = r({"jsonrpc": "2.0", "method": "spin", "id": 1, "timeout": 0.2})
+        self.assertEqual(x['error']['code'], -32703)
+        x = asyncio.run(r.acall({"jsonrpc": "2.0", "method": "spin", "id": 1, "timeout": 0.2}))
+        self.assertEqual(x['error']['code'], -32703)
+        x = asyncio.run(r.acall({"jsonrpc": "2.0", "method": "nap", "id": 1, "timeout": 0.2}))
+        self.assertEqual(x['error']['code'], -32703)
+        self.assertLess(time.monotonic() - t, 3)
+        # прерванные соединения не вернулись в пул
+        self.assertEqual(r.env.pool('S').size, 0)
+        self.assertEqual(r({"jsonrpc": "2.0", "method": "quick", "id": 1, "timeout": 1})['result'], [{'x': 1}])
+        self.assertEqual(r({"jsonrpc": "2.0", "method": "quick", "id": 1, "timeout": -1})['error']['code'], -32602)
+        r.env.pool('S').close()
+
+    @unittest.skipUnless(hasattr(__import__('os'), 'fork'), 'no fork')
+    def test_fork(self):
+        import os
+        env = BaseEnv()
+        env.set_db_alias('F', 'sqlite3', 'test_db.sqlite')
+        a = env.connect('F')
+        a.one('select 1')
+        a.commit()
+        self.assertEqual(env.pool('F').idle, 1)
+        pid = os.fork()
+        if pid == 0:
+            # соединения родителя в дочернем процессе не выдаются
+            os._exit(0 if env.pool('F').size == 0 and env.connect('F').one('select 1') == 1 else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(env.pool('F').idle, 1)
+
+    def test_transport(self):
+        import threading, http.client, gzip
+        from smartrpc.transport import make_server
+        server = make_server(rpc, port=0, max_body=1000, compress_min=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            c = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+            for n in range(2):  # одно keep-alive соединение
+                c.request('POST', '/', json.dumps({"jsonrpc": "2.0", "method": "substract", "params": [5, n], "id": n}))
+                x = c.getresponse()
+                self.assertEqual(json.loads(x.read())['result'], 5 - n)
+            c.request('POST', '/', json.dumps({"jsonrpc": "2.0", "method": "fn_sql", "id": 1}),
+                      {'Accept-Encoding': 'gzip'})
+            x = c.getresponse()
+            self.assertEqual(x.getheader('Content-Encoding'), 'gzip')
+            self.assertEqual(json.loads(gzip.decompress(x.read()))['result'][0]['id'], 1)
+            c.request('POST', '/', 'x' * 2000)
+            x = c.getresponse()
+            x.read()
+            self.assertEqual(x.status, 413)
+            c.request('POST', '/', json.dumps({"jsonrpc": "2.0", "method": "substract", "params": [5, 1], "id": 1}))
+            self.assertEqual(json.loads(c.getresponse().read())['result'], 4)
+            c.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        def deferred(environ, start_response):
+            # start_response при первой итерации (PEP 3333)
+            start_response('200 OK', [('Content-Length', '2')])
+            yield b'ok'
+
+        def failing(environ, start_response):
+            raise ValueError('boom')
+
+        for app, status, body in ((deferred, 200, b'ok'), (failing, 500, b'')):
+            server = make_server(app, port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                c = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+                c.request('POST', '/', b'{}')
+                x = c.getresponse()
+                self.assertEqual((x.status, x.read()), (status, body))
+                if status == 500:
+                    self.assertEqual(x.getheader('Connection'), 'close')
+                c.close()
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    @unittest.skipUnless(hasattr(__import__('os'), 'fork'), 'no fork')
+    def test_prefork(self):
+        import os, signal, socket, threading, http.client
+        from smartrpc.prefork import PreforkServer
+        r = RPC()
+        r.python_method(name='pid')(os.getpid)
+        r.python_method(name='slow')(lambda: time.sleep(0.5) or os.getpid())
+        server = PreforkServer(r, port=0, workers=2, graceful_timeout=5)
+        port = server.address[1]
+        master = os.fork()
+        if master == 0:
+            code = 1
+            try:
+                server.run()
+                code = 0
+            finally:
+                os._exit(code)
+
+        def call(method, c=None):
+            c = c or http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            c.request('POST', '/', json.dumps({"jsonrpc": "2.0", "method": method, "id": 1}))
+            x = c.getresponse()
+            return json.loads(x.read())['result'], x
+
+        def workers(count, exclude=(), timeout=10.0):
+            # новые соединения распределяются между воркерами
+            seen, deadline = set(), time.monotonic() + timeout
+            while len(seen - set(exclude)) < count and time.monotonic() < deadline:
+                try:
+                    seen.add(call('pid')[0])
+                except (OSError, http.client.HTTPException):
+                    time.sleep(0.05)
+            return seen - set(exclude)
+
+        try:
+            pids = workers(2)
+            self.assertEqual(len(pids), 2)
+            # убитый воркер заменяется новым
+            dead = pids.pop()
+            os.kill(dead, signal.SIGKILL)
+            self.assertEqual(len(workers(1, exclude=(dead, ) + tuple(pids))), 1)
+
+            # остановка: выполняющийся запрос завершается, простаивающее keep-alive соединение закрывается
+            idle = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            call('pid', idle)
+            slow = {}
+            t = threading.Thread(target=lambda: slow.update(zip(('result', 'response'), call('slow'))))
+            t.start()
+            time.sleep(0.2)
+            os.kill(master, signal.SIGTERM)
+            idle.sock.settimeout(5)
+            self.assertEqual(idle.sock.recv(1), b'')
+            t.join(5)
+            self.assertIn('result', slow)
+            self.assertEqual(slow['response'].getheader('Connection'), 'close')
+            idle.close()
+            self.assertEqual(os.waitpid(master, 0)[1], 0)
+            master = None
+        finally:
+            if master is not None:
+                os.kill(master, signal.SIGKILL)
+                os.waitpid(master, 0)
+            server.stop()
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file